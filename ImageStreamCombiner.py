@@ -1,17 +1,32 @@
 import logging
+import multiprocessing
+import os
 import sys
+import threading
 from pathlib import Path
+from zipfile import BadZipFile
 from PySide6 import QtWidgets as QtW
 from PySide6 import QtCore as QtC
 import toml
 from PySide6.QtCore import QSettings
-from PySide6.QtGui import QDropEvent, QDragEnterEvent, QDragMoveEvent, QColor
+from PySide6.QtGui import (
+    QDropEvent,
+    QDragEnterEvent,
+    QDragMoveEvent,
+    QColor,
+    QImage,
+    QPixmap,
+    QWheelEvent,
+)
 
 from combine_imagestream_files.dataset import DataSet, Channel
 from combine_imagestream_files.imagestreamzip import ImageStreamZip
+from combine_imagestream_files.preview import Preview
 from ui import MainWidget
 from ui.customwidgets import QLogHandler, configure_logging
 
+SOURCESUFFIXES = (".zip", ".tar", ".tgz", ".gz")  # or a folder
+
 
 class ImageStreamCombiner(QtW.QMainWindow):
     def __init__(self, *args, **kwargs):
@@ -38,9 +53,138 @@ class ImageStreamCombiner(QtW.QMainWindow):
 
     def closeEvent(self, event):
         self.settings.setValue("geometry", self.saveGeometry())
+        exportthread = self.mainwidget.exportthread
+        if exportthread is not None:
+            exportthread.cancel()
+            exportthread.wait()
+        for scanthread in self.mainwidget.findChildren(ScanThread):
+            scanthread.cancel()
+            scanthread.wait()
+        for montagethread in self.mainwidget.findChildren(MontageThread):
+            montagethread.wait()
+        if self.mainwidget.preview is not None:
+            self.mainwidget.preview.close()
+
+
+class ExportThread(QtC.QThread):
+    progress = QtC.Signal(str, int, int)
+
+    def __init__(
+        self,
+        isz: ImageStreamZip,
+        folder: Path,
+        pixelsize: float,
+        logger,
+        processes: bool = False,
+    ):
+        super().__init__()
+        self.isz = isz
+        self.folder = folder
+        self.pixelsize = pixelsize
+        self.logger = logger
+        self.processes = processes  # a process per dataset instead of threads
+        self.cancelled = threading.Event()
+        self.percentage = -1
+
+    def run(self):
+        cpus = os.cpu_count() or 1
+        self.isz.writetiffs(
+            self.folder,
+            self.pixelsize,
+            self.logger,
+            workers=1 if self.processes else cpus,
+            progress=self.report,
+            cancel=self.cancelled,
+            incremental=True,
+            processes=cpus if self.processes else 1,
+        )
+
+    def report(self, datasetname: str, done: int, total: int):
+        percentage = 100 * done // total
+        if percentage != self.percentage:  # do not flood the event loop
+            self.percentage = percentage
+            self.progress.emit(datasetname, done, total)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class ScanThread(QtC.QThread):
+    """
+    Lists the datasets of a source, so the window does not hang on archives with
+    hundreds of thousands of members. The cells missing channels are counted
+    when the scan is done, and the zipfile is opened for the preview, still on
+    this thread.
+    """
+
+    progress = QtC.Signal(int, object)  # members, cells and channels per dataset
+
+    def __init__(self, pth: Path, logger, parent=None):
+        super().__init__(parent)
+        self.pth = pth
+        self.logger = logger
+        self.isz = ImageStreamZip()
+        self.cancelled = threading.Event()
+        self.incomplete = {}  # cells without all channels, per dataset
+        self.missing = {}  # cells without each channel, per dataset
+        self.preview = None
+
+    def run(self):
+        try:
+            self.isz.loadfile(self.pth, progress=self.report, cancel=self.cancelled)
+            if not self.isz:
+                return
+            self.preview = Preview(self.isz)
+            self.preview.open()
+        except (OSError, ValueError, BadZipFile) as e:
+            self.logger.error(f"Cannot load {self.pth}: {e}")
+            self.isz.loaded = False
+            return
+        for name, dataset in self.isz.datasets.items():
+            complete = dataset.completecells(dataset.channels)
+            self.incomplete[name] = len(complete) - int(complete.sum())
+            self.missing[name] = dataset.missingcells()
+
+    def report(self, members: int):
+        self.progress.emit(
+            members,
+            {
+                name: (len(dataset.stems), dataset.getnchannels())
+                for name, dataset in self.isz.datasets.items()
+            },
+        )
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class MontageThread(QtC.QThread):
+    """
+    Renders a page of the preview, so decoding the cells does not block the
+    window
+    """
+
+    rendered = QtC.Signal(QImage)
+
+    def __init__(
+        self, preview: Preview, dataset: DataSet, first: int, count: int, parent=None
+    ):
+        super().__init__(parent)
+        self.preview = preview
+        self.dataset = dataset
+        self.first = first  # not start, which starts the thread
+        self.count = count
+
+    def run(self):
+        montage = self.preview.montage(self.dataset, self.first, self.count)
+        height, width = montage.shape
+        image = QImage(montage.data, width, height, width, QImage.Format_Grayscale8)
+        self.rendered.emit(image.copy())
 
 
 class MyMainWidget(QtW.QWidget):
+    PREVIEWCELLS = 6  # cells on one page of the preview
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.ui = MainWidget()
@@ -63,7 +207,16 @@ class MyMainWidget(QtW.QWidget):
         self.ui.pb_toalldatasets.clicked.connect(self.toalldatasets)
         self.ui.pb_save.clicked.connect(self.save)
         self.ui.pb_load.clicked.connect(self.load)
+        self.ui.pb_cancel.clicked.connect(self.cancel)
+        self.ui.sb_preview.valueChanged.connect(self.showpreview)
         self.isz = ImageStreamZip()
+        self.exportthread = None
+        self.scanthread = None
+        self.datasetitems = {}  # list item of each dataset
+        self.missing = {}  # cells without each channel, per dataset
+        self.preview = None
+        self.montagethread = None
+        self.previewpending = False  # render again when the montage is done
         self._restore_state()
         self.logger.info("Main widget initialized...")
 
@@ -75,6 +228,9 @@ class MyMainWidget(QtW.QWidget):
         self.current_dir = pth
         self.settings.setValue("current_dir", str(pth))
 
+    def wheelEvent(self, event: QWheelEvent):
+        QtC.QCoreApplication.sendEvent(self.ui.sb_preview, event)
+
     def dragMoveEvent(self, event: QDragMoveEvent):
         event.accept()
 
@@ -86,20 +242,47 @@ class MyMainWidget(QtW.QWidget):
             urllist = event.mimeData().urls()
             url = Path(str(urllist[0].toLocalFile()))
             self.logger.info(f"Got: {url}")
-            if url.suffix == ".zip":
+            if url.suffix in SOURCESUFFIXES or url.is_dir():
                 self._setin(url)
             if url.suffix == ".toml":
                 self._load(url)
 
     def run(self):
-        if not self.isz:
+        if not self.isz or self.exportthread is not None:
             return
         self.logger.info("Start saving tiff files...")
-        self.isz.writetiffs(
-            self.current_dir, float(self.ui.dsb_pixelsize.value()), self.logger
+        # export a copy, so the channels can be edited during the export
+        self.exportthread = ExportThread(
+            self.isz.copy(),
+            self.current_dir,
+            float(self.ui.dsb_pixelsize.value()),
+            self.logger,
+            self.ui.cb_processes.isChecked(),
         )
+        self.exportthread.progress.connect(self.exportprogress)
+        self.exportthread.finished.connect(self.exportfinished)
+        self.ui.pb_run.setEnabled(False)
+        self.ui.pb_cancel.setEnabled(True)
+        self.ui.pgb_export.setValue(0)
+        self.exportthread.start()
+
+    def exportprogress(self, datasetname: str, done: int, total: int):
+        self.ui.pgb_export.setMaximum(total)
+        self.ui.pgb_export.setValue(done)
+        self.ui.pgb_export.setFormat(f"{datasetname}: %p%")
+
+    def exportfinished(self):
+        self.exportthread = None
+        self.ui.pb_run.setEnabled(True)
+        self.ui.pb_cancel.setEnabled(False)
+        self.ui.pgb_export.setFormat("%p%")
         self.logger.info("Finished saving tiff files...")
 
+    def cancel(self):
+        if self.exportthread is not None:
+            self.logger.info("Cancelling...")
+            self.exportthread.cancel()
+
     def save(self):
         if not self.isz:
             return
@@ -175,6 +358,9 @@ class MyMainWidget(QtW.QWidget):
         if not self.isz:
             return
         dataset = item.data(256)  # type: DataSet
+        if dataset is None:  # still scanning
+            return
+        missing = self.missing.get(dataset.name, {})
         self.ui.lw_channels.clear()
         self.ui.lw_channelnrs.clear()
         for channel in dataset.channels:
@@ -184,7 +370,48 @@ class MyMainWidget(QtW.QWidget):
             nritem = QtW.QListWidgetItem(f"{channel.index}")
             color = QColor(0, 255, 0, 127) if channel else QColor(255, 0, 0, 127)
             nritem.setBackground(color)
+            if missing.get(channel.index):
+                nritem.setToolTip(f"Missing in {missing[channel.index]} cells")
             self.ui.lw_channelnrs.addItem(nritem)
+        previewpage = min(self.PREVIEWCELLS, len(dataset.stems))
+        self.ui.sb_preview.setRange(0, len(dataset.stems) - previewpage)
+        self.ui.sb_preview.setPageStep(previewpage)
+        self.showpreview()
+
+    def showpreview(self):
+        """
+        Show a page of cells of the current dataset, a row for each cell and a
+        column for each channel, to check the channels before exporting
+        """
+        item = self.ui.lw_datasets.currentItem()
+        if self.preview is None or item is None or item.data(256) is None:
+            return
+        if self.montagethread is not None:  # only the last page is rendered
+            self.previewpending = True
+            return
+        self.montagethread = MontageThread(
+            self.preview,
+            item.data(256),
+            self.ui.sb_preview.value(),
+            self.PREVIEWCELLS,
+            self,
+        )
+        self.montagethread.rendered.connect(self.montagerendered)
+        self.montagethread.finished.connect(self.montagefinished)
+        self.montagethread.finished.connect(self.montagethread.deleteLater)
+        self.montagethread.start()
+
+    def montagerendered(self, image: QImage):
+        if self.sender() is self.montagethread:
+            self.ui.l_preview.setPixmap(QPixmap.fromImage(image))
+
+    def montagefinished(self):
+        if self.sender() is not self.montagethread:
+            return
+        self.montagethread = None
+        if self.previewpending:
+            self.previewpending = False
+            self.showpreview()
 
     def channelchanged(self, item: QtW.QListWidgetItem):
         if not self.isz:
@@ -200,7 +427,10 @@ class MyMainWidget(QtW.QWidget):
 
     def setin(self):
         file = QtW.QFileDialog.getOpenFileName(
-            self, "Set Zip File", str(self.current_dir), "*.zip"
+            self,
+            "Set Zip File",
+            str(self.current_dir),
+            " ".join(f"*{suffix}" for suffix in SOURCESUFFIXES),
         )
         if not file[0]:
             self.logger.warning("No ZipFile Selected...")
@@ -209,26 +439,88 @@ class MyMainWidget(QtW.QWidget):
         self._setin(pth)
 
     def _setin(self, pth: Path):
-        if pth.exists() and pth.suffix == ".zip":
-            self.current_dir = pth.parent
-            self.isz.loadfile(pth)
-            self.ui.l_filein.setText(str(self.isz))
-            for x in self.isz.datasets.keys():
-                newitem = QtW.QListWidgetItem(
-                    f"{x} : ({len(self.isz.datasets[x].groupedfiles)} cells {self.isz.datasets[x].getnchannels()} channels)"
-                )
-                newitem.setData(256, self.isz.datasets[x])
-                self.ui.lw_datasets.addItem(newitem)
-            self.ui.lw_datasets.sortItems()
+        if pth.exists() and (pth.suffix in SOURCESUFFIXES or pth.is_dir()):
+            if self.scanthread is not None:
+                # stops after its current batch, and is deleted when finished
+                self.scanthread.cancel()
+            self.isz = ImageStreamZip()  # not loaded until the scan is done
+            self.missing = {}
+            if self.montagethread is not None:
+                # the preview is closed once its last page is rendered
+                self.montagethread.finished.connect(self.preview.close)
+                self.montagethread = None
+                self.previewpending = False
+            elif self.preview is not None:
+                self.preview.close()
+            self.preview = None
+            self.ui.l_preview.clear()
+            self.datasetitems = {}
+            self.ui.lw_datasets.clear()
+            self.ui.lw_channels.clear()
+            self.ui.lw_channelnrs.clear()
+            self.ui.l_filein.setText(f"Scanning {pth.name}...")
             self._setcurrentdir(pth.parent)
-            self.updateui()
-            if len(self.isz.datasets) == 0:
-                self.logger.warning(
-                    "Did not find any datasets in this zipfile. Are the files in subfolders?"
-                )
+            self.scanthread = ScanThread(pth, self.logger, self)
+            self.scanthread.progress.connect(self.scanprogress)
+            self.scanthread.finished.connect(self.scanfinished)
+            self.scanthread.finished.connect(self.scanthread.deleteLater)
+            self.scanthread.start()
         else:
             self.logger.error(f"Cannot load {pth}")
 
+    def scanprogress(self, members: int, counts: dict):
+        if self.sender() is not self.scanthread:  # a scan that was cancelled
+            return
+        self.ui.l_filein.setText(
+            f"Scanning {self.scanthread.pth.name}: {members} files..."
+        )
+        for x, (cells, channels) in counts.items():
+            if x not in self.datasetitems:
+                self.datasetitems[x] = QtW.QListWidgetItem()
+                self.ui.lw_datasets.addItem(self.datasetitems[x])
+            self.datasetitems[x].setText(f"{x} : ({cells} cells {channels} channels)")
+        self.ui.lw_datasets.sortItems()
+        self.updateui()
+
+    def scanfinished(self):
+        if self.sender() is not self.scanthread:  # a scan that was cancelled
+            if self.sender().preview is not None:
+                self.sender().preview.close()
+            return
+        scanthread = self.scanthread
+        self.scanthread = None
+        if not scanthread.isz:
+            self.ui.l_filein.setText("")
+            return
+        self.isz = scanthread.isz
+        self.missing = scanthread.missing
+        self.preview = scanthread.preview
+        self.ui.l_filein.setText(str(self.isz))
+        for x, dataset in self.isz.datasets.items():
+            if x not in self.datasetitems:  # loaded from the scan index
+                self.datasetitems[x] = QtW.QListWidgetItem()
+                self.ui.lw_datasets.addItem(self.datasetitems[x])
+            text = (
+                f"{x} : ({len(dataset.stems)} cells {dataset.getnchannels()} channels"
+            )
+            incomplete = scanthread.incomplete[x]
+            if incomplete:
+                missing = ", ".join(
+                    f"{count} without channel {index}"
+                    for index, count in self.missing[x].items()
+                    if count
+                )
+                self.logger.warning(f"{x}: {incomplete} cells miss channels: {missing}")
+                text = f"{text}, {incomplete} incomplete"
+            self.datasetitems[x].setText(f"{text})")
+            self.datasetitems[x].setData(256, dataset)
+        self.ui.lw_datasets.sortItems()
+        self.updateui()
+        if len(self.isz.datasets) == 0:
+            self.logger.warning(
+                "Did not find any datasets in this zipfile. Are the files in subfolders?"
+            )
+
     def updateui(self):
         self.ui.lw_datasets.update()
         self.ui.lw_channels.update()
@@ -242,4 +534,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # the processes of a frozen executable
     main()
@@ -0,0 +1,59 @@
+"""
+Speed and error of the median methods against the exact np.median.
+
+Run: python benchmarks/bench_median.py [ncells] [nchannels]
+"""
+
+import sys
+import time
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from combine_imagestream_files.median import TILEMEDIANS, DatasetMedians
+from combine_imagestream_files.synthetic import maketile
+
+
+def maketiles(ncells: int, nchannels: int) -> list[list[npt.NDArray[Any]]]:
+    """
+    uint16 tiles that look like ImageStream cells
+    """
+    rng = np.random.default_rng(0)
+    cells = []
+    for _ in range(ncells):
+        h, w = rng.integers(30, 120, 2)
+        shape = (int(h), int(w))
+        cells.append([maketile(rng, shape, np.uint16, ch) for ch in range(nchannels)])
+    return cells
+
+
+def main() -> None:
+    ncells = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nchannels = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    cells = maketiles(ncells, nchannels)
+    results = {}
+    for method, func in TILEMEDIANS.items():
+        start = time.perf_counter()
+        medians = np.array([[func(tile) for tile in cell] for cell in cells])
+        collected = DatasetMedians(ncells, nchannels, method)
+        for row, cellmedians in enumerate(medians):
+            collected.add(row, cellmedians.tolist())
+        dsmedians = collected.value()
+        results[method] = (time.perf_counter() - start, medians, dsmedians)
+    reftime, refmedians, refdsmedians = results["exact"]
+    print(f"{ncells} cells, {nchannels} channels")
+    print(
+        f"{'method':>10} {'time (s)':>9} {'speedup':>8} "
+        f"{'max tile err':>13} {'max dataset err':>16}"
+    )
+    for method, (seconds, medians, dsmedians) in results.items():
+        print(
+            f"{method:>10} {seconds:9.3f} {reftime / seconds:8.2f} "
+            f"{np.abs(medians - refmedians).max():13.2f} "
+            f"{np.abs(dsmedians - refdsmedians).max():16.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
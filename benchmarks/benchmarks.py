@@ -0,0 +1,304 @@
+"""
+asv benchmarks of the scan, decode, median and write stages, of the preview
+and of the startup of the command line, on synthetic zipfiles.
+
+Run: asv run (or asv dev for a quick run against the working tree)
+"""
+
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+import numpy as np
+from tifffile import TiffFile
+
+from combine_imagestream_files.channelmap import ChannelMap
+from combine_imagestream_files.imagestreamzip import ImageStreamZip, _placecell
+from combine_imagestream_files.index import ScanIndex
+from combine_imagestream_files.live import LiveExport
+from combine_imagestream_files.median import TILEMEDIANS
+from combine_imagestream_files.preview import Preview
+from combine_imagestream_files.synthetic import maketile, makezip
+from combine_imagestream_files.zipreader import ZipFollower, ZipReader
+
+CELLS = 500
+CHANNELS = 6
+COMPRESSIONS = {"stored": ZIP_STORED, "deflated": ZIP_DEFLATED}
+
+
+def makezips() -> dict[str, str]:
+    """
+    One synthetic zipfile for each zip compression, in the current folder
+    """
+    return {
+        name: str(
+            makezip(
+                Path(f"bench_{name}.zip"),
+                datasets=1,
+                cells=CELLS,
+                channels=CHANNELS,
+                compression=compression,
+                missing=0.01,
+            )
+        )
+        for name, compression in COMPRESSIONS.items()
+    }
+
+
+def loadzip(zipfile: str) -> ImageStreamZip:
+    """
+    Load a zipfile, without the scan index, and name all channels
+    """
+    isz = ImageStreamZip()
+    isz.loadfile(zipfile, useindex=False)
+    for dataset in isz.datasets.values():
+        for channel in dataset.channels:
+            channel.name = f"Ch{channel.index}"
+    return isz
+
+
+class Startup:
+    """
+    Import and startup time, each in a fresh interpreter
+    """
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def timeraw_import(self, zipfiles: dict[str, str]) -> str:
+        return "import combine_imagestream_files"
+
+    def timeraw_import_imagestreamzip(self, zipfiles: dict[str, str]) -> str:
+        return "from combine_imagestream_files import ImageStreamZip"
+
+    def timeraw_list(self, zipfiles: dict[str, str]) -> str:
+        return (
+            "from pathlib import Path\n"
+            "from combine_imagestream_files.start import listdatasets\n"
+            f"listdatasets(Path({zipfiles['deflated']!r}))"
+        )
+
+
+class Scan:
+    params = list(COMPRESSIONS)
+    param_names = ["zip"]
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(self, zipfiles: dict[str, str], name: str) -> None:
+        ScanIndex.indexpath(Path(zipfiles[name])).unlink(missing_ok=True)
+        ImageStreamZip().loadfile(zipfiles[name])  # writes the index
+
+    def time_loadfile(self, zipfiles: dict[str, str], name: str) -> None:
+        ImageStreamZip().loadfile(zipfiles[name], useindex=False)
+
+    def time_loadfile_index(self, zipfiles: dict[str, str], name: str) -> None:
+        ImageStreamZip().loadfile(zipfiles[name])
+
+    def time_opensource(self, zipfiles: dict[str, str], name: str) -> None:
+        ZipReader(Path(zipfiles[name])).close()
+
+    def time_follow(self, zipfiles: dict[str, str], name: str) -> None:
+        with ZipFollower(Path(zipfiles[name])) as reader:
+            reader.follow()
+
+
+class Decode:
+    params = list(COMPRESSIONS)
+    param_names = ["zip"]
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(self, zipfiles: dict[str, str], name: str) -> None:
+        self.zipfile = Path(zipfiles[name])
+        self.isz = loadzip(zipfiles[name])
+
+    def time_decode(self, zipfiles: dict[str, str], name: str) -> None:
+        with ZipReader(self.zipfile) as reader:
+            for member in reader.infos:
+                with reader.open(member) as fh, TiffFile(fh) as tfile:
+                    tfile.asarray()
+
+    def track_decode_cells_per_s(self, zipfiles: dict[str, str], name: str) -> float:
+        dataset = next(iter(self.isz.datasets.values()))
+        channels = dataset.getchannels()
+        complete = dataset.completecells(channels)
+        files = [file for file, c in zip(dataset.stems, complete) if c]
+        with ZipReader(self.zipfile) as reader:
+            start = time.perf_counter()
+            for file in files:
+                self.isz._readcell(reader, dataset, file, channels)
+            return len(files) / (time.perf_counter() - start)
+
+    track_decode_cells_per_s.unit = "cells/s"
+
+
+class Median:
+    params = list(TILEMEDIANS)
+    param_names = ["method"]
+
+    def setup(self, method: str) -> None:
+        rng = np.random.default_rng(0)
+        self.tiles = [
+            maketile(rng, (int(h), int(w)), np.uint16, 1)
+            for h, w in rng.integers(30, 120, (CELLS, 2))
+        ]
+
+    def time_tilemedians(self, method: str) -> None:
+        func = TILEMEDIANS[method]
+        for tile in self.tiles:
+            func(tile)
+
+
+class Place:
+    params = [120, 250]
+    param_names = ["canvas"]
+
+    def setup(self, canvas: int) -> None:
+        rng = np.random.default_rng(0)
+        self.cells = [
+            [
+                maketile(rng, (int(h), int(w)), np.uint16, ch)
+                for ch, (h, w) in enumerate(rng.integers(30, canvas, (CHANNELS, 2)))
+            ]
+            for _ in range(CELLS)
+        ]
+        self.fills = [np.uint16(200)] * CHANNELS
+        self.data = np.zeros((CELLS, CHANNELS, canvas, canvas), dtype=np.uint16)
+
+    def time_placecell(self, canvas: int) -> None:
+        for frame, tiles in zip(self.data, self.cells):
+            _placecell(frame, tiles, self.fills)
+
+
+class Montage:
+    params = list(COMPRESSIONS)
+    param_names = ["zip"]
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(self, zipfiles: dict[str, str], name: str) -> None:
+        self.isz = loadzip(zipfiles[name])
+        self.dataset = next(iter(self.isz.datasets.values()))
+        self.preview = Preview(self.isz)
+        self.preview.montage(self.dataset, 0, 8)  # opens the zipfile
+
+    def teardown(self, zipfiles: dict[str, str], name: str) -> None:
+        self.preview.close()
+
+    def time_montage_page(self, zipfiles: dict[str, str], name: str) -> None:
+        self.preview.cache.clear()
+        self.preview.montage(self.dataset, 0, 8)
+
+    def time_montage_page_cached(self, zipfiles: dict[str, str], name: str) -> None:
+        self.preview.montage(self.dataset, 0, 8)
+
+
+class Write:
+    params = (["imagej", "ometiff", "zarr"], [False, True])
+    param_names = ["format", "streaming"]
+    timeout = 300
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(
+        self, zipfiles: dict[str, str], outputformat: str, streaming: bool
+    ) -> None:
+        self.isz = loadzip(zipfiles["deflated"])
+        self.folder = tempfile.mkdtemp()
+
+    def teardown(
+        self, zipfiles: dict[str, str], outputformat: str, streaming: bool
+    ) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_writetiffs(
+        self, zipfiles: dict[str, str], outputformat: str, streaming: bool
+    ) -> None:
+        self.isz.writetiffs(
+            self.folder, 1.0, streaming=streaming, outputformat=outputformat
+        )
+
+    def peakmem_writetiffs(
+        self, zipfiles: dict[str, str], outputformat: str, streaming: bool
+    ) -> None:
+        self.isz.writetiffs(
+            self.folder, 1.0, streaming=streaming, outputformat=outputformat
+        )
+
+
+class WriteSharded:
+    params = ([None, 64], [None, "zlib"])
+    param_names = ["shardsize", "compression"]
+    timeout = 300
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(
+        self, zipfiles: dict[str, str], shardsize: int | None, compression: str | None
+    ) -> None:
+        self.isz = loadzip(zipfiles["deflated"])
+        self.folder = tempfile.mkdtemp()
+
+    def teardown(
+        self, zipfiles: dict[str, str], shardsize: int | None, compression: str | None
+    ) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_writetiffs(
+        self, zipfiles: dict[str, str], shardsize: int | None, compression: str | None
+    ) -> None:
+        self.isz.writetiffs(
+            self.folder, 1.0, workers=4, compression=compression, shardsize=shardsize
+        )
+
+
+class WriteMeasurements:
+    params = [None, "csv", "npz"]
+    param_names = ["measurements"]
+    timeout = 300
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(self, zipfiles: dict[str, str], measurements: str | None) -> None:
+        self.isz = loadzip(zipfiles["deflated"])
+        self.folder = tempfile.mkdtemp()
+
+    def teardown(self, zipfiles: dict[str, str], measurements: str | None) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_writetiffs(
+        self, zipfiles: dict[str, str], measurements: str | None
+    ) -> None:
+        self.isz.writetiffs(self.folder, 1.0, workers=4, measurements=measurements)
+
+
+class Live:
+    """
+    A live export of a zipfile that is already complete, to compare with Write
+    """
+
+    timeout = 300
+
+    def setup_cache(self) -> dict[str, str]:
+        return makezips()
+
+    def setup(self, zipfiles: dict[str, str]) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.channelmap = ChannelMap({i: f"Ch{i}" for i in range(1, CHANNELS + 1)})
+
+    def teardown(self, zipfiles: dict[str, str]) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_live_export(self, zipfiles: dict[str, str]) -> None:
+        LiveExport(
+            zipfiles["deflated"], self.folder, 1.0, self.channelmap, workers=4
+        ).run()
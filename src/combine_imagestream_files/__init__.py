@@ -1,2 +1,16 @@
-from .imagestreamzip import ImageStreamZip
-from .start import main
+from typing import Any
+
+__all__ = ["ImageStreamZip", "main"]
+
+
+def __getattr__(name: str) -> Any:
+    # imported on first use, so the command line starts without numpy and tifffile
+    if name == "ImageStreamZip":
+        from .imagestreamzip import ImageStreamZip
+
+        return ImageStreamZip
+    if name == "main":
+        from .start import main
+
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
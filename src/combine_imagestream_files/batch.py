@@ -0,0 +1,393 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from .channelmap import ChannelMap
+from .imagestreamzip import ImageStreamZip
+from .options import OUTPUTFORMATS, addexportoptions, writeoptions
+from .stats import ExportStats
+
+# zipfiles and tarfiles that are found in folders and watched
+ARCHIVES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+# the stacks of a dataset: its stack, or those of the split and buckets layouts
+# (see DataSet.getlayout), each possibly in shards (see ShardIndex.shardname)
+STACKSUFFIX = r"(_oversized|_\d+x\d+)?(_shard\d{4})?"
+
+
+def get_args() -> argparse.Namespace:
+    """
+    Get the arguments from the commandline
+    :return:
+    """
+    myparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    myparser.add_argument(
+        "inputs",
+        type=str,
+        nargs="*",
+        help="Zipfiles, tarfiles, folders with a subfolder for each dataset, glob "
+        "patterns, or folders with any of these.",
+    )
+    myparser.add_argument(
+        "-w",
+        type=str,
+        help="Watch this folder and combine every zipfile or tarfile that appears "
+        "in it.",
+        default="",
+    )
+    myparser.add_argument(
+        "-t",
+        type=float,
+        help="Seconds between two scans of the watched folder",
+        default=10.0,
+    )
+    myparser.add_argument(
+        "-j",
+        type=int,
+        help="Number of worker threads, shared by all zipfiles",
+        default=1,
+    )
+    myparser.add_argument(
+        "-a",
+        type=int,
+        help="Number of zipfiles that are combined at the same time",
+        default=1,
+    )
+    addexportoptions(myparser)
+    myparser.add_argument(
+        "-f",
+        action="store_true",
+        help="Also combine datasets whose output is up to date",
+    )
+    myparser.add_argument(
+        "-o",
+        type=str,
+        help="Write the JSON summary to this file instead of printing it",
+        default="",
+    )
+    myparser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Add the time spent in each stage and counters to each summary",
+    )
+    myparser.add_argument(
+        "-l",
+        type=str,
+        help="LogLevel: 0 error (default), 1 warning, 2 info",
+        default=0,
+    )
+    return myparser.parse_args()
+
+
+def findsources(inputs: list[str], suffix: str = ".ome.tif") -> list[Path]:
+    """
+    Expand the inputs to a list of sources: zipfiles, tarfiles and folders
+    with a subfolder for each dataset. A folder without such subfolders is
+    searched for zipfiles and tarfiles, and its subfolders for such folders.
+    :param inputs: sources, glob patterns or folders with sources
+    :param suffix: suffix of the files that are cells
+    :return: the sources, without duplicates
+    """
+    sources: dict[Path, None] = {}
+    for pattern in inputs:
+        for match in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            pth = Path(match)
+            if pth.is_dir() and _isexport(pth, suffix):
+                sources[pth.resolve()] = None
+            elif pth.is_dir():
+                for source in _findsources(pth, suffix):
+                    sources[source.resolve()] = None
+            elif _isarchive(pth):
+                sources[pth.resolve()] = None
+            else:
+                logging.error(f"Cannot find a zipfile, tarfile or folder: {match}")
+    return list(sources)
+
+
+def _findsources(folder: Path, suffix: str) -> list[Path]:
+    """
+    The zipfiles and tarfiles in a folder and its subfolders, and the
+    subfolders of the folder with a subfolder of cells. These are not searched,
+    as they can hold very many files.
+    :param folder: the folder
+    :param suffix: suffix of the files that are cells
+    :return: the sources
+    """
+    sources: list[Path] = []
+    for root, dirs, files in os.walk(folder):
+        if Path(root) == folder:
+            exports = [d for d in dirs if _isexport(Path(root, d), suffix)]
+            sources.extend(Path(root, d) for d in exports)
+            dirs[:] = [d for d in dirs if d not in exports]
+        sources.extend(Path(root, f) for f in files if f.lower().endswith(ARCHIVES))
+    return sorted(sources)
+
+
+def _isarchive(pth: Path) -> bool:
+    return pth.name.lower().endswith(ARCHIVES) and pth.is_file()
+
+
+def _isexport(pth: Path, suffix: str) -> bool:
+    """
+    :return: whether pth is a folder with a subfolder of cells
+    """
+    return pth.is_dir() and any(
+        folder.is_dir() and next(folder.glob(f"*{suffix}"), None) is not None
+        for folder in pth.iterdir()
+    )
+
+
+def outputs(folder: Path, datasetname: str, outputformat: str) -> list[Path]:
+    """
+    Existing output of a dataset, including the extra stacks of the split and
+    buckets layouts and shards
+    :param folder: output folder
+    :param datasetname: name of the dataset
+    :param outputformat: output format
+    :return: the output files
+    """
+    extension = OUTPUTFORMATS[outputformat]
+    pattern = re.compile(re.escape(datasetname) + STACKSUFFIX + re.escape(extension))
+    candidates = folder.glob(f"{glob.escape(datasetname)}*{extension}")
+    return sorted(pth for pth in candidates if pattern.fullmatch(pth.name))
+
+
+def outdated(isz: ImageStreamZip, folder: Path, outputformat: str) -> list[str]:
+    """
+    Datasets whose output is missing or older than the zipfile
+    :param isz: the loaded zipfile
+    :param folder: output folder
+    :param outputformat: output format
+    :return: names of the datasets
+    """
+    mtime = isz.sourcetype.modified(isz.zipfile)
+    datasets = []
+    for datasetname in isz.datasets:
+        outpths = outputs(folder, datasetname, outputformat)
+        if not outpths or any(pth.stat().st_mtime < mtime for pth in outpths):
+            datasets.append(datasetname)
+    return datasets
+
+
+def datasetbytes(isz: ImageStreamZip, datasets: list[str]) -> int:
+    """
+    Size of the members of some datasets in the zipfile, compressed
+    :param isz: the loaded zipfile
+    :param datasets: names of the datasets
+    :return: the size in bytes
+    """
+    if not datasets:
+        return 0
+    names = set(datasets)
+    with isz.opensource() as source:
+        return sum(
+            info.compress_size
+            for name, info in source.infos.items()
+            if name.partition("/")[0] in names
+        )
+
+
+def combine(
+    zipfile: Path,
+    pixelsize: float,
+    pool: ThreadPoolExecutor,
+    workers: int,
+    force: bool = False,
+    outputformat: str = "imagej",
+    layout: str = "pad",
+    sizepercentile: float = 100.0,
+    profile: bool = False,
+    channelmap: ChannelMap | None = None,
+    **options: Any,
+) -> dict[str, Any]:
+    """
+    Combine the outdated datasets of one zipfile
+    :param zipfile: the zipfile
+    :param pixelsize: pixelsize in um
+    :param pool: thread pool shared by all zipfiles
+    :param workers: number of threads in the pool
+    :param force: also combine datasets that are up to date
+    :param outputformat: output format
+    :param layout: layout of the datasets, one of LAYOUTS
+    :param sizepercentile: canvas size percentile of the layout
+    :param profile: add the stats of the export to the summary
+    :param channelmap: names of the channels to export, which override the
+        channel maps next to the zipfile
+    :param options: passed to ImageStreamZip.writetiffs, e.g. streaming,
+        median, compression, incremental, processes, memory, shardsize and
+        measurements
+    :return: summary of the zipfile, with the error instead if it could not
+        be combined
+    """
+    logger = logging.getLogger(zipfile.name)
+    start = time.perf_counter()
+    stats = ExportStats(enabled=profile)
+    try:
+        isz = ImageStreamZip()
+        with stats.stage("scan"):
+            isz.loadfile(zipfile)
+        channelmap = ChannelMap.find(zipfile, list(isz.datasets), channelmap)
+        for datasetname in channelmap.apply(isz.datasets, logger):
+            logger.warning(f"No channel map for {datasetname}")
+        for dataset in isz.datasets.values():
+            dataset.setlayout(layout, sizepercentile)
+        datasets = (
+            list(isz.datasets) if force else outdated(isz, zipfile.parent, outputformat)
+        )
+        written = []
+        if datasets:
+            written = isz.writetiffs(
+                zipfile.parent,
+                pixelsize,
+                logger,
+                workers=workers,
+                datasets=datasets,
+                pool=pool,
+                outputformat=outputformat,
+                stats=stats,
+                **options,
+            )
+        seconds = time.perf_counter() - start
+        exported = [
+            d
+            for d in datasets
+            if set(outputs(zipfile.parent, d, outputformat)) & set(written)
+        ]
+        cells = sum(len(isz.datasets[d].stems) for d in exported)
+        megabytes = datasetbytes(isz, exported) / 2**20
+    except Exception as e:  # one bad archive does not stop the others
+        logger.error(f"Cannot combine {zipfile}: {e!r}")
+        return {
+            "zipfile": str(zipfile),
+            "error": repr(e),
+            "datasets": 0,
+            "written": [],
+            "uptodate": 0,
+            "cells": 0,
+            "seconds": round(time.perf_counter() - start, 3),
+            "cells_per_s": 0.0,
+            "mb_per_s": 0.0,
+        }
+    summary = {
+        "zipfile": str(zipfile),
+        "datasets": len(isz.datasets),
+        "written": [str(pth) for pth in written],
+        "uptodate": len(isz.datasets) - len(datasets),
+        "cells": cells,
+        "seconds": round(seconds, 3),
+        "cells_per_s": round(cells / seconds, 1) if seconds > 0 else 0.0,
+        "mb_per_s": round(megabytes / seconds, 2) if seconds > 0 else 0.0,
+    }
+    if profile:
+        summary["profile"] = stats.report()
+    return summary
+
+
+def combineall(
+    zipfiles: list[Path],
+    pixelsize: float,
+    workers: int = 1,
+    concurrent: int = 1,
+    **options: Any,
+) -> list[dict[str, Any]]:
+    """
+    Combine many zipfiles, with one thread pool for all of them
+    :param zipfiles: the zipfiles
+    :param pixelsize: pixelsize in um
+    :param workers: number of threads decoding and placing tiles
+    :param concurrent: number of zipfiles that are combined at the same time
+    :param options: passed to combine, e.g. force, outputformat, layout,
+        sizepercentile, profile, channelmap and the options of writetiffs.
+        processes and memory apply to the datasets of each zipfile.
+    :return: summary of each zipfile, see combine
+    """
+    workers = max(workers, 1)
+    with (
+        ThreadPoolExecutor(max_workers=workers) as pool,
+        ThreadPoolExecutor(max_workers=max(concurrent, 1)) as archives,
+    ):
+        return list(
+            archives.map(
+                lambda zipfile: combine(zipfile, pixelsize, pool, workers, **options),
+                zipfiles,
+            )
+        )
+
+
+def watch(folder: Path, interval: float, **kwargs: Any) -> None:
+    """
+    Combine the zipfiles and tarfiles that appear in a folder, until
+    interrupted. A zipfile is combined once its size did not change between two
+    scans, and again on the next scan if that failed.
+    :param folder: the watched folder
+    :param interval: seconds between two scans
+    :param kwargs: passed to combineall
+    :return:
+    """
+    sizes: dict[Path, int] = {}
+    combined: dict[Path, float] = {}  # modification time when last combined
+    while True:
+        ready = []
+        for zipfile in _findsources(folder, ".ome.tif"):
+            if zipfile.is_dir():  # has no end to wait for, see start --follow
+                continue
+            stat = zipfile.stat()
+            if sizes.get(zipfile) == stat.st_size and (
+                combined.get(zipfile) != stat.st_mtime
+            ):
+                ready.append((zipfile, stat.st_mtime))
+            sizes[zipfile] = stat.st_size
+        summaries = combineall([zipfile for zipfile, _ in ready], **kwargs)
+        for (zipfile, mtime), summary in zip(ready, summaries):
+            if "error" not in summary:
+                combined[zipfile] = mtime
+            print(json.dumps(summary), flush=True)
+        time.sleep(interval)
+
+
+def main() -> None:
+    args = get_args()
+    loglevels = [logging.ERROR, logging.WARNING, logging.INFO]
+    loglevel = loglevels[int(args.l)]
+    logging.basicConfig(level=loglevel)
+    options: dict[str, Any] = {
+        "pixelsize": args.p,
+        "workers": args.j,
+        "concurrent": args.a,
+        "force": args.f,
+        "layout": args.layout,
+        "sizepercentile": args.percentile,
+        "profile": args.profile,
+        "channelmap": ChannelMap.load(args.c) if args.c else None,
+        **writeoptions(args),
+    }
+    if args.w:
+        watch(Path(args.w), args.t, **options)
+        return
+    start = time.perf_counter()
+    summaries = combineall(findsources(args.inputs), **options)
+    seconds = time.perf_counter() - start
+    cells = sum(summary["cells"] for summary in summaries)
+    summary = {
+        "zipfiles": summaries,
+        "cells": cells,
+        "seconds": round(seconds, 3),
+        "cells_per_s": round(cells / seconds, 1) if seconds > 0 else 0.0,
+    }
+    if args.o:
+        with open(args.o, "w") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Channel names read from a file, so datasets can be exported without the user
+interface. Kept free of numpy, like options.
+"""
+
+import json
+import logging
+import tomllib
+from collections.abc import Mapping
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from combine_imagestream_files.dataset import DataSet
+
+CHANNELMAPSUFFIXES = (".toml", ".json")
+
+
+class ChannelMap:
+    """
+    Names of the channels to export, in the format the user interface saves:
+    a channels table with a name for each channel index. A datasets table can
+    give the channels of single datasets, e.g. [datasets.Sample1.channels] in
+    TOML. Channels without a name, or with an empty name, are not exported.
+    """
+
+    def __init__(
+        self,
+        channels: dict[int, str] | None = None,
+        datasets: dict[str, dict[int, str]] | None = None,
+    ) -> None:
+        """
+        :param channels: name of each channel, for all datasets
+        :param datasets: name of each channel, for single datasets
+        """
+        self.channels = channels
+        self.datasets = datasets if datasets is not None else {}
+
+    def __bool__(self) -> bool:
+        return self.channels is not None or len(self.datasets) > 0
+
+    @classmethod
+    def load(cls, pth: Path | str) -> "ChannelMap":
+        """
+        Load a channel map
+        :param pth: TOML or JSON file
+        :return: the channel map
+        """
+        pth = Path(pth)
+        with open(pth, "rb") as f:
+            if pth.suffix == ".json":
+                data = json.load(f)
+            else:
+                data = tomllib.load(f)
+        try:
+            channels = data.get("channels")
+            return cls(
+                None if channels is None else _names(channels),
+                {
+                    str(name): _names(dataset["channels"])
+                    for name, dataset in data.get("datasets", {}).items()
+                },
+            )
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"{pth} is not a channel map: {e!r}") from e
+
+    @classmethod
+    def find(
+        cls, source: Path | str, datasetnames: list[str], explicit: "ChannelMap | None"
+    ) -> "ChannelMap":
+        """
+        The channel map of a zipfile, from the files next to it: <zipfile>.toml
+        for all datasets, and <dataset>.toml, as saved by the user interface,
+        for one dataset. A dataset overrides the zipfile. JSON files work as
+        well. These are defaults: the explicit channel map overrides them.
+        :param source: the zipfile, folder or tarfile
+        :param datasetnames: names of its datasets
+        :param explicit: channel map that was asked for, e.g. on the command line
+        :return: the channel map
+        """
+        source = Path(source)
+        channelmap = cls()
+        stem = source.name if source.is_dir() else source.stem.removesuffix(".tar")
+        for name in [stem, *datasetnames]:
+            for suffix in CHANNELMAPSUFFIXES:
+                pth = source.parent / f"{name}{suffix}"
+                if pth.is_file():
+                    found = cls.load(pth)
+                    if name == stem:
+                        channelmap.update(found)
+                    elif found.channels is not None:
+                        channelmap.datasets[name] = found.channels
+                    break
+        if explicit is not None:
+            channelmap.update(explicit)
+        return channelmap
+
+    def update(self, other: "ChannelMap") -> None:
+        """
+        Override this channel map with another one. Channels for all datasets
+        also override the channels of single datasets in this one.
+        :param other: the other channel map
+        :return:
+        """
+        if other.channels is not None:
+            self.channels = dict(other.channels)
+            self.datasets = {}
+        self.datasets.update(other.datasets)
+
+    def get(self, datasetname: str) -> dict[int, str] | None:
+        """
+        :param datasetname: name of the dataset
+        :return: name of each channel, or None if the dataset is not mapped
+        """
+        return self.datasets.get(datasetname, self.channels)
+
+    def apply(
+        self,
+        datasets: Mapping[str, "DataSet"],
+        logger: logging.Logger = logging.getLogger("isz"),
+    ) -> list[str]:
+        """
+        Name the channels of the datasets. Channels that are not in the map get
+        an empty name, so only the mapped channels are read and exported.
+        :param datasets: the datasets
+        :param logger: logs the mapped channels that a dataset does not have
+        :return: names of the datasets that are not mapped, and keep their names
+        """
+        unmapped = []
+        for datasetname, dataset in datasets.items():
+            names = self.get(datasetname)
+            if names is None:
+                unmapped.append(datasetname)
+                continue
+            indices = {channel.index for channel in dataset.channels}
+            for index, name in names.items():
+                if name and index not in indices:
+                    logger.warning(f"{datasetname} does not have channel {index}")
+            for channel in dataset.channels:
+                channel.name = names.get(channel.index, "")
+        return unmapped
+
+
+def _names(channels: Mapping[Any, Any]) -> dict[int, str]:
+    """
+    :param channels: name of each channel index, with string or integer keys
+    :return: name of each channel index
+    """
+    return {
+        int(index): "" if name == "--" else str(name)
+        for index, name in channels.items()
+    }
@@ -1,7 +1,13 @@
-import copy
-from typing import Any
+from collections.abc import MutableMapping
+from typing import Any, Iterator
 
 import numpy as np
+import numpy.typing as npt
+
+from combine_imagestream_files.options import LAYOUTS
+
+BUCKETSTEP = 32  # size step between the buckets of the buckets layout
+MAXCHANNELS = 64  # channels of a cell are stored as bits of a uint64
 
 
 class Channel:
@@ -27,15 +33,33 @@ class Channel:
 class DataSet:
     def __init__(self, name: str = "") -> None:
         self.name: str = name
-        self.groupedfiles: dict[str, list[int]] = {}  # channels for each cell
+        self.stems: list[str] = []  # stem of each cell
+        self._masks = np.zeros(0, dtype=np.uint64)  # channels of each cell, grows
+        self._rows: dict[str, int] | None = None  # row of each stem, when needed
         self.channels: list[Channel] = []  # name for each channel
-        self.medians: list[int] = []  # median for each channel
+        self.medians: npt.NDArray[np.float64] = np.zeros(0)  # median for each channel
         self.size = (0, 0)  # max width and max height
         self.datatype: np.dtype[Any]
+        self.layout = "pad"  # one of LAYOUTS
+        self.sizepercentile = 100.0  # canvas size percentile of crop and split
 
     def __str__(self) -> str:
         return self.name
 
+    @property
+    def masks(self) -> npt.NDArray[np.uint64]:
+        """
+        Channels of each cell: bit i is set if the cell has channel i
+        """
+        return self._masks[: len(self.stems)]
+
+    @property
+    def groupedfiles(self) -> "GroupedFiles":
+        """
+        Channels for each cell, as a dictionary view on stems and masks
+        """
+        return GroupedFiles(self)
+
     def setchannels(self, channels: list[Channel]) -> None:
         self.channels = channels
 
@@ -53,20 +77,92 @@ class DataSet:
             print(f"WARNING: Found {len(channel)} channels when setting channelname.")
 
     def addfile(self, file: str) -> None:
-        nparts = file.split("_")
-        ch = int(nparts[-1][2::])  # Ch1 Ch11
-        if ch not in [x.index for x in self.channels]:
-            self.channels.append(Channel(ch, ""))
-            self.channels.sort()
-        stem = "_".join(nparts[0:-1])
-        if stem in self.groupedfiles:
-            self.groupedfiles[stem].append(ch)
-        else:
-            self.groupedfiles[stem] = [ch]
+        stem, _, ch = file.rpartition("_")
+        self.addfiles([stem], [int(ch[2::])])  # Ch1 Ch11
+
+    def addfiles(self, stems: list[str], channels: list[int]) -> None:
+        """
+        Add many files at once
+        :param stems: stem of the cell of each file
+        :param channels: channel index of each file
+        :return:
+        """
+        if any(not 0 <= ch < MAXCHANNELS for ch in set(channels)):
+            raise ValueError(f"Channel indices must be smaller than {MAXCHANNELS}")
+        rows = self._getrows()
+        indices = np.empty(len(stems), dtype=np.intp)
+        for i, stem in enumerate(stems):
+            row = rows.get(stem)
+            if row is None:
+                row = rows[stem] = len(self.stems)
+                self.stems.append(stem)
+            indices[i] = row
+        if len(self._masks) < len(self.stems):
+            masks = np.zeros(max(len(self.stems), 2 * len(self._masks)), np.uint64)
+            masks[: len(self._masks)] = self._masks
+            self._masks = masks
+        bits = np.left_shift(np.uint64(1), np.asarray(channels, dtype=np.uint64))
+        np.bitwise_or.at(self._masks, indices, bits)
+        present = [x.index for x in self.channels]
+        for ch in sorted(set(channels)):
+            if ch not in present:
+                self.channels.append(Channel(ch, ""))
+        self.channels.sort()
+
+    def setcells(self, stems: list[str], masks: npt.NDArray[np.uint64]) -> None:
+        """
+        Set all cells at once, e.g. from a stored scan
+        :param stems: stem of each cell
+        :param masks: channels of each cell as bitmask
+        :return:
+        """
+        self.stems = list(stems)
+        self._masks = np.array(masks, dtype=np.uint64)
+        self._rows = None
+        self.channels = [Channel(ch, "") for ch in _channelsof(self.masks)]
+
+    def removecells(self, remove: npt.NDArray[np.bool_]) -> None:
+        """
+        Remove cells
+        :param remove: for each cell, whether it is removed
+        :return:
+        """
+        self._masks = self.masks[~remove]
+        self.stems = [stem for stem, r in zip(self.stems, remove) if not r]
+        self._rows = None
+
+    def completecells(self, channels: list[Channel]) -> npt.NDArray[np.bool_]:
+        """
+        :param channels: the channels
+        :return: for each cell, whether it has all channels
+        """
+        required = np.uint64(0)
+        for channel in channels:
+            required |= np.uint64(1) << np.uint64(channel.index)
+        complete: npt.NDArray[np.bool_] = (self.masks & required) == required
+        return complete
+
+    def missingcells(self) -> dict[int, int]:
+        """
+        :return: for each channel, the number of cells that do not have it
+        """
+        masks = self.masks
+        return {
+            channel.index: int(
+                np.count_nonzero(
+                    (masks >> np.uint64(channel.index)) & np.uint64(1) == 0
+                )
+            )
+            for channel in self.channels
+        }
+
+    def _getrows(self) -> dict[str, int]:
+        if self._rows is None:
+            self._rows = {stem: row for row, stem in enumerate(self.stems)}
+        return self._rows
 
     def sort(self) -> None:
-        for k in self.groupedfiles:
-            self.groupedfiles[k].sort()
+        pass  # the channels of a cell are a bitmask, which is always sorted
 
     def checkchannels(self, channels: list[Channel]) -> bool:
         """
@@ -74,15 +170,109 @@ class DataSet:
         :param channels:
         :return:
         """
-        allexist = True
-        for k in self.groupedfiles:
-            if not all(x.index in self.groupedfiles[k] for x in channels):
-                print(f"{k} only has {self.groupedfiles[k]}")
-                allexist = False
-        return allexist
+        complete = self.completecells(channels)
+        for row in np.flatnonzero(~complete):
+            print(f"{self.stems[row]} only has {_channelsof(self.masks[row])}")
+        return bool(np.all(complete))
+
+    def setlayout(self, layout: str, sizepercentile: float = 100.0) -> None:
+        """
+        Set how cells of different sizes are combined
+        pad: pad all cells to the largest cell
+        crop: crop the cells that are larger than the size percentile
+        split: write the cells that are larger than the size percentile to a
+            separate _oversized stack
+        buckets: write a separate stack for each size, in steps of BUCKETSTEP
+        :param layout: one of LAYOUTS
+        :param sizepercentile: percentile of the cell sizes that is the canvas
+            size of crop and split
+        :return:
+        """
+        if layout not in LAYOUTS:
+            raise ValueError(f"Layout {layout} is not one of {LAYOUTS}")
+        if not 0 < sizepercentile <= 100:
+            raise ValueError(f"Size percentile {sizepercentile} is not in (0, 100]")
+        self.layout = layout
+        self.sizepercentile = sizepercentile
+
+    def getlayout(
+        self, shapes: npt.NDArray[np.int_]
+    ) -> list[tuple[str, npt.NDArray[np.intp], tuple[int, int]]]:
+        """
+        Divide the cells over stacks according to the layout
+        :param shapes: (cells, channels, 2) shape of each tile
+        :return: suffix of the stack name, cells and canvas size of each stack
+        """
+        sizes = shapes.max(axis=1)  # size of each cell
+        cells = np.arange(len(sizes))
+        if self.layout == "buckets":
+            buckets = -(-sizes // BUCKETSTEP) * BUCKETSTEP
+            stacks = []
+            for bucket in np.unique(buckets, axis=0):
+                incells = cells[np.all(buckets == bucket, axis=1)]
+                stacks.append(
+                    (f"_{bucket[0]}x{bucket[1]}", incells, _maxsize(sizes[incells]))
+                )
+            return stacks
+        if self.layout == "pad":
+            return [("", cells, _maxsize(sizes))]
+        canvas = np.ceil(np.percentile(sizes, self.sizepercentile, axis=0))
+        canvassize = (int(canvas[0]), int(canvas[1]))
+        if self.layout == "crop":
+            return [("", cells, canvassize)]
+        fits = np.all(sizes <= canvas, axis=1)
+        return [
+            (suffix, incells, _maxsize(sizes[incells]))
+            for suffix, incells in (("", cells[fits]), ("_oversized", cells[~fits]))
+            if len(incells) > 0
+        ]
 
     def getnchannels(self) -> int:
         return len(self.getchannels())
 
     def getnvalidchannels(self) -> int:
         return len(self.getvalidchannels())
+
+
+class GroupedFiles(MutableMapping[str, list[int]]):
+    """
+    The cells of a DataSet as a dictionary of the channels of each stem
+    """
+
+    def __init__(self, dataset: DataSet) -> None:
+        self.dataset = dataset
+
+    def __getitem__(self, stem: str) -> list[int]:
+        return _channelsof(self.dataset.masks[self.dataset._getrows()[stem]])
+
+    def __setitem__(self, stem: str, channels: list[int]) -> None:
+        row = self.dataset._getrows().get(stem)
+        if row is not None:
+            self.dataset.masks[row] = 0
+        self.dataset.addfiles([stem] * len(channels), channels)
+
+    def __delitem__(self, stem: str) -> None:
+        row = self.dataset._getrows()[stem]
+        self.dataset.removecells(np.arange(len(self.dataset.stems)) == row)
+
+    def __contains__(self, stem: object) -> bool:
+        return stem in self.dataset._getrows()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.dataset.stems)
+
+    def __len__(self) -> int:
+        return len(self.dataset.stems)
+
+
+def _channelsof(masks: npt.NDArray[np.uint64] | np.uint64) -> list[int]:
+    """
+    :param masks: one or more channel bitmasks
+    :return: the channel indices that are set in any of the masks
+    """
+    union = int(np.bitwise_or.reduce(np.atleast_1d(masks), initial=0))
+    return [ch for ch in range(MAXCHANNELS) if union >> ch & 1]
+
+
+def _maxsize(sizes: npt.NDArray[np.int_]) -> tuple[int, int]:
+    return int(sizes[:, 0].max()), int(sizes[:, 1].max())
@@ -1,9 +1,54 @@
+import copy
+import functools
+import itertools
+import importlib.util
 import logging
+import math
+import multiprocessing
+import queue
+import shutil
+import threading
+import time
+import warnings
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.synchronize import Event as ProcessEvent
 from pathlib import Path
-from zipfile import ZipFile
+from typing import IO, Any, Callable, Iterator, cast
 import numpy as np
-from tifffile import TiffFile, imwrite
-from combine_imagestream_files.dataset import DataSet
+import numpy.typing as npt
+from tifffile import TiffFile, TiffFileError, imwrite, memmap
+from combine_imagestream_files.dataset import Channel, DataSet
+from combine_imagestream_files.index import ScanIndex
+from combine_imagestream_files.manifest import Manifest, memberskey
+from combine_imagestream_files.measurements import (
+    measurementspath,
+    measurementtable,
+    writemeasurements,
+)
+from combine_imagestream_files.median import TILEMEDIANS, DatasetMedians
+from combine_imagestream_files.omezarr import ZARRCOMPRESSORS, writeomezarr
+from combine_imagestream_files.options import (
+    COMPRESSIONS,
+    MEASUREFORMATS,
+    OUTPUTFORMATS,
+)
+from combine_imagestream_files.parallel import budgeted, imap
+from combine_imagestream_files.shards import ShardIndex
+from combine_imagestream_files.stats import NOSTATS, ExportStats, physicalmemory
+from combine_imagestream_files.sources import (
+    MemoryFile,
+    Source,
+    groupmembers,
+    sourcetype,
+)
+from combine_imagestream_files.zipreader import ZipReader
+
+BIGTIFFSIZE = 2**32 - 2**25  # larger stacks are written as BigTIFF
+RESUMESTEP = 256  # cells between two checkpoints of a resumable export
+# padded stack size relative to the tiles, when the shapes are not scanned yet
+PADDINGFACTOR = 2.0
 
 
 class ImageStreamZip:
@@ -12,6 +57,8 @@ class ImageStreamZip:
         self.zipfile: Path = Path()
         self.datasets: dict[str, DataSet] = {}
         self.loaded: bool = False
+        self.sourcetype: type[Source] = ZipReader  # reads the members of zipfile
+        self.index: ScanIndex | None = None
 
     def __bool__(self) -> bool:
         return self.loaded
@@ -19,136 +66,1131 @@ class ImageStreamZip:
     def __str__(self) -> str:
         return self.zipfile.stem
 
-    def loadfile(self, zipfile: Path | str) -> None:
+    def copy(self) -> "ImageStreamZip":
+        """
+        Copy with its own datasets, so channels can be edited while the copy is
+        being written. The scan index is shared.
+        :return: the copy
+        """
+        isz = copy.copy(self)
+        isz.datasets = copy.deepcopy(self.datasets)
+        return isz
+
+    def loadfile(
+        self,
+        zipfile: Path | str,
+        useindex: bool = True,
+        progress: Callable[[int], None] | None = None,
+        cancel: threading.Event | None = None,
+    ) -> None:
+        """
+        List the datasets and cells in a zipfile, or in a folder or tarfile with
+        the same layout: a subfolder for each dataset. The members are listed in
+        batches, and the datasets grow with each batch.
+        :param zipfile: the zipfile, folder or tarfile
+        :param useindex: use and update the scan index stored next to the zipfile
+        :param progress: called with the number of members listed after each
+            batch, e.g. to show the datasets while they grow
+        :param cancel: stop the scan after the current batch when this is set;
+            the zipfile is then not loaded
+        :return:
+        """
         self.zipfile = Path(zipfile)
         self.datasets = {}
-        with ZipFile(self.zipfile, "r") as archive:
-            for file in archive.namelist():
-                if file[-1] == r"/":  # it is a folder
-                    pass
-                else:
-                    if (
-                        len(file.split(r"/")) != 2
-                    ):  # File is not in a subfolder of the root. Ignore.
-                        continue
-                    (folder, name) = file.split(r"/")
-                    if name.endswith(self.suffix):
-                        if folder not in self.datasets:
-                            self.datasets[folder] = DataSet(folder)
-                        self.datasets[folder].addfile(
-                            name[0 : len(name) - len(self.suffix)]
-                        )
-            for d in self.datasets:
-                self.datasets[d].sort()
-            self.loaded = True
+        self.index = None
+        self.loaded = False
+        self.sourcetype = sourcetype(self.zipfile)
+        if useindex:
+            key = self.sourcetype.key(self.zipfile)
+            self.index = ScanIndex.load(ScanIndex.indexpath(self.zipfile), key)
+            if self.index is not None:
+                for folder, (stems, masks) in self.index.getcells().items():
+                    self.datasets[folder] = DataSet(folder)
+                    self.datasets[folder].setcells(stems, masks)
+                self.loaded = True
+                if progress is not None:
+                    progress(len(self.index.names))
+                return
+        members = 0
+        names: list[str] = []  # of the members that are cells
+        for batch in self.sourcetype.iterscan(self.zipfile):
+            if cancel is not None and cancel.is_set():
+                return
+            cells, cellnames = groupmembers(batch, self.suffix)
+            for folder, (stems, channels) in cells.items():
+                if folder not in self.datasets:
+                    self.datasets[folder] = DataSet(folder)
+                self.datasets[folder].addfiles(stems, channels)
+            names.extend(cellnames)
+            members += len(batch)
+            if progress is not None:
+                progress(members)
+        self.loaded = True
+        if useindex:
+            self.index = ScanIndex(
+                key,
+                {
+                    d: (self.datasets[d].stems, self.datasets[d].masks)
+                    for d in self.datasets
+                },
+                names,
+            )
+            self._saveindex()
+
+    def opensource(self) -> Source:
+        """
+        Open the zipfile, folder or tarfile for reading members
+        :return: the opened source
+        """
+        return self.sourcetype(self.zipfile)
+
+    def _saveindex(self, logger: logging.Logger = logging.getLogger("isz")) -> None:
+        if self.index is None or self.index.partial or not self.index.changed:
+            return
+        try:
+            self.index.save(ScanIndex.indexpath(self.zipfile))
+        except OSError as e:
+            logger.warning(f"Cannot save the scan index of {self}: {e}")
 
     def writetiffs(
         self,
         folder: Path | str,
         pixelsize: float,
         logger: logging.Logger = logging.getLogger("isz"),
-    ) -> None:
+        workers: int = 1,
+        streaming: bool = False,
+        median: str = "exact",
+        datasets: list[str] | None = None,
+        pool: ThreadPoolExecutor | None = None,
+        outputformat: str = "imagej",
+        compression: str | None = None,
+        progress: Callable[[str, int, int], None] | None = None,
+        cancel: threading.Event | ProcessEvent | None = None,
+        stats: ExportStats | None = None,
+        incremental: bool = False,
+        processes: int = 1,
+        memory: float | None = None,
+        shardsize: int | None = None,
+        measurements: str | None = None,
+    ) -> list[Path]:
+        """
+        Write a tiff file for each dataset with valid channels, or more than one
+        for the split and buckets layouts (see DataSet.setlayout) or shards
+        :param folder: output folder
+        :param pixelsize: pixelsize in um
+        :param logger: logger for progress and errors
+        :param workers: number of threads decoding and placing tiles
+        :param streaming: write one cell at a time instead of assembling the
+            whole stack in memory. Every tile is decoded twice.
+        :param median: how the medians used as background are computed, one of
+            median.TILEMEDIANS
+        :param datasets: names of the datasets to write (default all)
+        :param pool: thread pool to use instead of starting one with workers
+            threads, e.g. to share it between zipfiles. Not used with processes.
+        :param outputformat: one of OUTPUTFORMATS
+        :param compression: None or one of COMPRESSIONS
+        :param progress: called after every cell with the name of the dataset,
+            the number of cells done and the total number of cells. Streaming and
+            incremental imagej exports count every cell twice.
+        :param cancel: stop the export after the current cell when this is set
+        :param stats: collects the time spent in each stage, counters and a
+            summary of each dataset
+        :param incremental: record a manifest of each dataset, skip datasets
+            whose members, channels and settings did not change, and resume
+            interrupted uncompressed imagej exports at the cell they stopped
+        :param processes: write this many datasets at the same time, each in its
+            own process with workers threads, largest datasets first
+        :param memory: estimated memory in bytes that the datasets written at
+            the same time may use together (default half the physical memory)
+        :param shardsize: split each stack into shards of this many cells, named
+            <stack>_shard0000 and so on, that are written at the same time, and
+            save a ShardIndex of the cells of each dataset
+        :param measurements: also write the area, mean, integrated, maximum and
+            median intensity of each channel of each cell, measured while the
+            tiles are decoded, to <dataset>.measurements.<format>, one of
+            MEASUREFORMATS
+        :return: the files that were written
+        """
+        options = WriteOptions(
+            pixelsize,
+            logger,
+            workers,
+            streaming,
+            median,
+            outputformat,
+            compression,
+            progress,
+            cancel,
+            stats,
+            incremental,
+            shardsize,
+            measurements,
+        )
         logger.info(f"Writing tiffile for {self}")
-        with ZipFile(self.zipfile, "r") as archive:
+        logging.getLogger("tifffile").setLevel(
+            logging.ERROR
+        )  # otherwise you get many "FILLORDER" errors.
+        if datasets is None:
+            datasets = list(self.datasets)
+        if processes > 1 and len(datasets) > 1:
+            return self._writeprocesses(folder, datasets, options, processes, memory)
+        written: list[Path] = []
+        with (
+            self.opensource() as reader,
+            (
+                nullcontext(pool)
+                if pool is not None
+                else ThreadPoolExecutor(max_workers=options.workers)
+            ) as pool,
+        ):
             for datasetname in self.datasets:
+                if datasetname not in datasets:
+                    continue
                 logger.info(f"Writing tiffile for {datasetname}")
                 dataset = self.datasets[datasetname]
                 channels = dataset.getvalidchannels()
                 if len(channels) == 0:
                     logger.warning(f"No valid channels for {datasetname}")
                     continue
-                # Getting Median/Size/datatype
-                mw = 0
-                mh = 0
-                medians = np.zeros(
-                    (len(dataset.groupedfiles), len(channels)),
-                    dtype=float,
-                )
-                logging.getLogger("tifffile").setLevel(
-                    logging.ERROR
-                )  # otherwise you get many "FILLORDER" errors.
-                checkdatatype = True
-                clearfiles = []
-                for i, file in enumerate(dataset.groupedfiles):  # Each cell
-                    skipfile = False
-                    for j, channel in enumerate(channels):  # Each channel
-                        if channel.index not in dataset.groupedfiles[file]:
-                            logger.error(
-                                f"{file} does not have {channel.index}. Skipping file."
-                            )
-                            skipfile = True
-                    if skipfile:
-                        clearfiles.append(file)
+                manifest = None
+                if incremental:
+                    manifest = self._manifest(reader, folder, dataset, options)
+                    if manifest.complete:
+                        logger.info(f"{datasetname} did not change, skipping")
                         continue
-                    for j, channel in enumerate(channels):  # Each channel
-                        with TiffFile(
-                            archive.open(
-                                f"{dataset}/{file}_Ch{channel.index}{self.suffix}"
-                            )
-                        ) as tfile:
-                            page = tfile.pages[0]
-                            if checkdatatype:
-                                dataset.datatype = page.asarray().dtype
-                                checkdatatype = False
-                            if page.shape[0] > mw:
-                                mw = page.shape[0]
-                            if page.shape[1] > mh:
-                                mh = page.shape[1]
-                            medians[i, j] = np.median(page.asarray())
-                for clearfile in clearfiles:
-                    del dataset.groupedfiles[clearfile]
-                dataset.medians = np.median(medians, axis=0)
-                dataset.size = (mw, mh)
-
-                # Writing Tiff
-                outpth = Path(folder, f"{dataset}.tif")
-                outpth.parent.mkdir(parents=True, exist_ok=True)
-
-                data = np.zeros(
+                start = time.perf_counter()
+                try:
+                    self._writedataset(
+                        reader,
+                        pool,
+                        dataset,
+                        channels,
+                        folder,
+                        options,
+                        written,
+                        manifest,
+                    )
+                    options.stats.adddataset(
+                        datasetname,
+                        len(dataset.stems),
+                        time.perf_counter() - start,
+                    )
+                    if manifest is not None:
+                        manifest.complete = True
+                        manifest.save()
+                except ExportCancelled:
+                    logger.warning(f"Export cancelled at {datasetname}")
+                    break
+                finally:
+                    self._saveindex(logger)
+        return written
+
+    def _writeprocesses(
+        self,
+        folder: Path | str,
+        datasets: list[str],
+        options: "WriteOptions",
+        processes: int,
+        memory: float | None,
+    ) -> list[Path]:
+        """
+        Write datasets in a pool of processes, see writetiffs. The log records
+        and progress of the processes are handed to the logger and progress
+        callback of this process.
+        :param folder: output folder
+        :param datasets: names of the datasets to write
+        :param options: settings of the export
+        :param processes: number of processes
+        :param memory: memory budget in bytes
+        :return: the files that were written
+        """
+        logger = options.logger
+        if memory is None:
+            memory = (physicalmemory() or math.inf) / 2
+        subsets = []
+        weights = []
+        needs = []
+        with self.opensource() as reader:
+            for datasetname in datasets:
+                weight, need = self._estimate(
+                    reader, self.datasets[datasetname], options
+                )
+                logger.info(
+                    f"{datasetname}: {weight / 2**20:.1f} MB of members, "
+                    f"needs about {need / 2**20:.1f} MB"
+                )
+                subsets.append(self._subset(datasetname))
+                weights.append(weight)
+                needs.append(need)
+        context = multiprocessing.get_context("spawn")  # forking threads is unsafe
+        records: multiprocessing.Queue[logging.LogRecord] = context.Queue()
+        events: multiprocessing.Queue[tuple[str, int, int]] = context.Queue()
+        cancel = context.Event()
+        listener = QueueListener(records, _ForwardHandler())
+
+        def poll() -> bool:
+            while options.progress is not None:
+                try:
+                    options.progress(*events.get_nowait())
+                except queue.Empty:
+                    break
+            if options.cancel is not None and options.cancel.is_set():
+                cancel.set()
+            return not cancel.is_set()
+
+        settings = {
+            "pixelsize": options.pixelsize,
+            "logger": logger.name,
+            "workers": options.workers,
+            "streaming": options.streaming,
+            "median": options.median,
+            "outputformat": options.outputformat,
+            "compression": options.compression,
+            "incremental": options.incremental,
+            "shardsize": options.shardsize,
+            "measurements": options.measurements,
+            "stats": (options.stats.enabled, options.stats.trace),
+        }
+        written: dict[str, list[Path]] = {}
+        listener.start()
+        try:
+            with ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=context,
+                initializer=_initprocess,
+                initargs=(
+                    records,
+                    events if options.progress is not None else None,
+                    cancel,
+                    logger.getEffectiveLevel(),
+                ),
+            ) as pool:
+                for isz, (pths, stats, index) in budgeted(
+                    pool,
+                    functools.partial(_writeprocess, folder, settings),
+                    subsets,
+                    weights,
+                    needs,
+                    memory,
+                    processes,
+                    poll,
+                ):
+                    written[next(iter(isz.datasets))] = pths
+                    options.stats.merge(stats)
+                    if self.index is not None and index is not None:
+                        self.index.update(index)
+            poll()
+        finally:
+            listener.stop()
+            self._saveindex(logger)
+        if cancel.is_set():
+            logger.warning(f"Export of {self} cancelled")
+        return [pth for datasetname in datasets for pth in written.get(datasetname, [])]
+
+    def _subset(self, datasetname: str) -> "ImageStreamZip":
+        """
+        Copy with only one dataset, and only its part of the index
+        :param datasetname: name of the dataset
+        :return: the copy
+        """
+        isz = copy.copy(self)
+        isz.datasets = {datasetname: self.datasets[datasetname]}
+        if self.index is not None:
+            isz.index = self.index.subset(f"{datasetname}/")
+        return isz
+
+    def _estimate(
+        self, reader: Source, dataset: DataSet, options: "WriteOptions"
+    ) -> tuple[int, float]:
+        """
+        Size of a dataset and the memory needed to write it. The stack is sized
+        from the shapes in the index, or guessed from the size of the members if
+        they have not been scanned.
+        :param reader: reader of the zipfile
+        :param dataset: the dataset
+        :param options: settings of the export
+        :return: compressed size of the members of the complete cells in bytes,
+            and the estimated peak memory in bytes
+        """
+        channels = dataset.getvalidchannels()
+        complete = dataset.completecells(channels)
+        names = [
+            self._membername(dataset, stem, channel)
+            for stem, c in zip(dataset.stems, complete)
+            if c
+            for channel in channels
+        ]
+        cells = int(complete.sum())
+        if not channels or cells == 0:
+            return 0, 0.0
+        infos = [reader.infos[name] for name in names if name in reader.infos]
+        weight = sum(info.compress_size for info in infos)
+        tiles = sum(info.file_size for info in infos)  # about the decoded tiles
+        shapes = None if self.index is None else self.index.getshapes(names)
+        if shapes is None:
+            stack = PADDINGFACTOR * tiles
+        else:
+            sizes, dtypes = shapes
+            itemsize = max(np.dtype(dtype).itemsize for dtype in dtypes)
+            stack = cells * len(channels) * itemsize * float(np.prod(sizes.max(0)))
+        if options.streaming:  # a window of cells in flight, and a frame
+            return weight, (4 * options.workers + 1) * stack / cells
+        return weight, tiles + stack
+
+    def _writedataset(
+        self,
+        reader: Source,
+        pool: ThreadPoolExecutor,
+        dataset: DataSet,
+        channels: list[Channel],
+        folder: Path | str,
+        options: "WriteOptions",
+        written: list[Path],
+        manifest: Manifest | None = None,
+    ) -> None:
+        """
+        Combine the complete cells of one dataset into TCYX stacks, one for
+        each stack of the layout of the dataset, or for each shard of them
+        :param written: the stacks that were written are appended to this
+        :param manifest: records the cells that are written, for resuming
+        """
+        logger = options.logger
+        streaming = options.streaming
+        window = 4 * options.workers
+        stats = options.stats
+        resumable = manifest is not None and options.resumable
+        # for reporting progress: streaming and resumable exports write in a
+        # second pass over the cells
+        passes = 2 if streaming or resumable else 1
+        # Skipping cells that miss a channel
+        complete = dataset.completecells(channels)
+        for skipped in np.flatnonzero(~complete):  # Each incomplete cell
+            mask = int(dataset.masks[skipped])
+            for channel in channels:  # Each channel
+                if not mask >> channel.index & 1:
+                    logger.error(
+                        f"{dataset.stems[skipped]} does not have {channel.index}. "
+                        "Skipping file."
+                    )
+        rows = np.flatnonzero(complete).tolist()
+        measure = options.measurements is not None
+        medians = DatasetMedians(
+            len(dataset.stems), len(channels), options.median, keep=measure
+        )
+        dataset.removecells(~complete)
+        if len(rows) == 0:
+            logger.warning(f"No complete cells in {dataset}")
+            return
+
+        # Decoding every tile, getting Median/Size/datatype/Maximum
+
+        # the index has no measurements, so measured cells are always decoded
+        def decodecell(file: str) -> _Cell:
+            return self._scancell(
+                reader,
+                dataset,
+                file,
+                channels,
+                options.median,
+                streaming and not measure,
+                stats,
+                measure,
+            )
+
+        tiles = []
+        shapes = np.zeros((len(rows), len(channels), 2), dtype=int)
+        # the maximum of each tile rather than a running maximum per channel, as
+        # the split and buckets layouts and shards need the range of a subset
+        maxima: npt.NDArray[Any] = np.zeros(0)
+        sums = np.zeros((len(rows), len(channels)))  # sum of each tile
+        for i, (row, cell) in enumerate(
+            zip(rows, imap(pool, decodecell, dataset.stems, window))
+        ):
+            if i == 0:
+                maxima = np.zeros((len(rows), len(channels)), cell.maxima[0].dtype)
+            shapes[i] = cell.shapes
+            medians.add(row, cell.medians)
+            maxima[i] = cell.maxima
+            if measure:
+                sums[i] = cell.sums
+            if not streaming:
+                tiles.append(cell.tiles)
+            options.checkpoint(dataset.name, i + 1, passes * len(rows))
+        dataset.datatype = maxima.dtype
+        dataset.medians = medians.value()
+        dataset.size = (int(shapes[..., 0].max()), int(shapes[..., 1].max()))
+        fills = [
+            np.asarray(median).astype(dataset.datatype) for median in dataset.medians
+        ]
+
+        files = dataset.stems
+        done = len(rows)  # cells written in the second pass (for progress)
+        lock = threading.Lock()
+
+        def advance(n: int) -> None:
+            nonlocal done
+            with lock:
+                done += n
+                current = done
+            options.checkpoint(dataset.name, current, passes * len(rows))
+
+        layout = dataset.getlayout(shapes)
+        # the crop layout cuts off the border of the tiles that are larger than
+        # the canvas, so their maxima are taken again over the part that is
+        # placed. Only these cells are read again when streaming.
+        placedmaxima = maxima.copy()
+        for _, cells, size in layout:
+            for i in cells[np.any(shapes[cells] > size, axis=(1, 2))]:
+                celltiles = (
+                    self._readcell(reader, dataset, files[i], channels, stats)
+                    if streaming
+                    else tiles[i]
+                )
+                placedmaxima[i] = [_crop(tile, *size).max() for tile in celltiles]
+
+        # name, cells, canvas size and display ranges of each stack or shard
+        jobs: list[tuple[str, npt.NDArray[np.intp], tuple[int, int], list[Any]]] = []
+        for suffix, cells, size in layout:
+            # find ranges for each channel, the same for all shards of a stack
+            ranges = []
+            for ch in range(len(channels)):
+                ranges.append(dataset.medians[ch])
+                chmax = placedmaxima[cells, ch].max()
+                if np.any(shapes[cells, ch, :] < size):  # padded with the median
+                    chmax = max(chmax, fills[ch])
+                ranges.append(chmax)
+            if options.shardsize is None:
+                jobs.append((f"{dataset.name}{suffix}", cells, size, ranges))
+                continue
+            for shard, start in enumerate(range(0, len(cells), options.shardsize)):
+                jobs.append(
                     (
-                        len(dataset.groupedfiles),
-                        dataset.getnvalidchannels(),
-                        dataset.size[0],
-                        dataset.size[1],
+                        ShardIndex.shardname(f"{dataset.name}{suffix}", shard),
+                        cells[start : start + options.shardsize],
+                        size,
+                        ranges,
+                    )
+                )
+
+        def writejob(
+            job: tuple[str, npt.NDArray[np.intp], tuple[int, int], list[Any]],
+        ) -> Path:
+            name, cells, size, ranges = job
+            outpth = self.outputpath(folder, name, options.outputformat)
+            outpth.parent.mkdir(parents=True, exist_ok=True)
+            shape = (len(cells), dataset.getnvalidchannels(), size[0], size[1])
+            if manifest is not None and resumable:
+
+                def fillframe(frame: npt.NDArray[Any], k: int) -> None:
+                    if streaming:
+                        celltiles = self._readcell(
+                            reader, dataset, files[cells[k]], channels, stats
+                        )
+                    else:
+                        celltiles, tiles[cells[k]] = tiles[cells[k]], []
+                    with stats.stage("place", dataset.name):
+                        _placecell(frame, celltiles, fills)
+
+                with stats.stage("write", dataset.name):
+                    self._writememmap(
+                        outpth,
+                        shape,
+                        dataset,
+                        ranges,
+                        options,
+                        pool,
+                        manifest,
+                        fillframe,
+                        advance,
+                    )
+            elif streaming:
+
+                def readframe(i: int) -> npt.NDArray[Any]:
+                    frame = np.empty(shape[1:], dtype=dataset.datatype)
+                    celltiles = self._readcell(
+                        reader, dataset, files[i], channels, stats
+                    )
+                    with stats.stage("place", dataset.name):
+                        _placecell(frame, celltiles, fills)
+                    return frame
+
+                def frames() -> Iterator[npt.NDArray[Any]]:
+                    for frame in imap(pool, readframe, cells, window):
+                        yield frame
+                        advance(1)
+
+                self._writestack(
+                    outpth, frames(), shape, dataset, ranges, options, pool
+                )
+            else:
+                data = np.zeros(shape, dtype=dataset.datatype)
+
+                def placecell(i: int) -> None:
+                    with stats.stage("place", dataset.name):
+                        _placecell(data[i], tiles[cells[i]], fills)
+                    tiles[cells[i]] = []
+
+                for _ in pool.map(placecell, range(len(cells))):
+                    pass
+                self._writestack(outpth, data, shape, dataset, ranges, options, pool)
+            if manifest is not None:
+                manifest.outputs[outpth.name] = len(cells)
+            return outpth
+
+        if options.shardsize is None or options.workers == 1:
+            for job in jobs:
+                written.append(writejob(job))
+        else:  # shards are written at the same time, on their own threads
+            with ThreadPoolExecutor(
+                max_workers=min(options.workers, len(jobs))
+            ) as writers:
+                written.extend(writers.map(writejob, jobs))
+        if options.shardsize is not None:
+            index = ShardIndex(
+                ShardIndex.indexpath(folder, dataset.name),
+                dataset.name,
+                [str(x) for x in channels],
+            )
+            for name, cells, _, _ in jobs:
+                index.addshard(
+                    self.outputpath(folder, name, options.outputformat).name,
+                    [files[i] for i in cells],
+                )
+            index.save()
+        if options.measurements is not None:
+            assert medians.table is not None  # kept when measuring
+            stacks = np.empty(len(rows), dtype=object)
+            frames = np.zeros(len(rows), dtype=np.intp)
+            for name, cells, _, _ in jobs:
+                stacks[cells] = self.outputpath(folder, name, options.outputformat).name
+                frames[cells] = np.arange(len(cells))
+            pth = measurementspath(folder, dataset.name, options.measurements)
+            with stats.stage("write", dataset.name):
+                writemeasurements(
+                    pth,
+                    measurementtable(
+                        files,
+                        stacks.tolist(),
+                        frames,
+                        [str(x) for x in channels],
+                        shapes,
+                        sums,
+                        maxima,
+                        medians.table[rows],
                     ),
-                    dtype=dataset.datatype,
                 )
-                for i, file in enumerate(dataset.groupedfiles):
-                    for j, channel in enumerate(channels):
-                        with TiffFile(
-                            archive.open(
-                                f"{dataset}/{file}_Ch{channel.index}{self.suffix}"
-                            )
-                        ) as tfile:
-                            page = tfile.pages[0]
-                            data[i, j, :, :] = dataset.medians[j]
-                            w = page.shape[0]
-                            h = page.shape[1]
-                            offsetx = (dataset.size[0] - w) // 2
-                            offsety = (dataset.size[1] - h) // 2
-                            data[i, j, offsetx : offsetx + w, offsety : offsety + h] = (
-                                page.asarray()
-                            )
-
-                # find ranges for each channel
-                ranges = []
-                for ch in range(data.shape[1]):
-                    ranges.append(dataset.medians[ch])
-                    ranges.append(data[:, ch, :, :].max())
-                medians_str = "\n" + ",".join([str(int(x)) for x in dataset.medians])
-                channelnames = [str(x) for x in dataset.getvalidchannels()]
-                imwrite(
-                    outpth,
-                    data,
-                    imagej=True,
-                    resolution=(1 / pixelsize, 1 / pixelsize),
-                    photometric="minisblack",
-                    metadata={
-                        "spacing": pixelsize,
-                        "unit": "um",
-                        "axes": "TCYX",
-                        "Labels": channelnames * len(dataset.groupedfiles),
-                        "Ranges": [ranges],
-                        "Properties": {"Medians": medians_str},
-                    },
+            if manifest is not None:
+                manifest.outputs[pth.name] = len(rows)
+
+    def _writestack(
+        self,
+        outpth: Path,
+        data: npt.NDArray[Any] | Iterator[npt.NDArray[Any]],
+        shape: tuple[int, int, int, int],
+        dataset: DataSet,
+        ranges: list[Any],
+        options: "WriteOptions",
+        pool: ThreadPoolExecutor,
+    ) -> None:
+        """
+        Write the TCYX stack in the output format
+        :param outpth: output file
+        :param data: the stack, or an iterator over its T-frames
+        :param shape: shape of the stack
+        :param dataset: dataset that is written
+        :param ranges: display range of each channel
+        :param options: settings of the export
+        :param pool: pool used for compressing zarr chunks
+        :return:
+        """
+        try:
+            with options.stats.stage("write", dataset.name):
+                self._writeformat(outpth, data, shape, dataset, ranges, options, pool)
+        except ExportCancelled:  # remove the incomplete output
+            if outpth.is_dir():
+                shutil.rmtree(outpth)
+            else:
+                outpth.unlink(missing_ok=True)
+            raise
+
+    def _writeformat(
+        self,
+        outpth: Path,
+        data: npt.NDArray[Any] | Iterator[npt.NDArray[Any]],
+        shape: tuple[int, int, int, int],
+        dataset: DataSet,
+        ranges: list[Any],
+        options: "WriteOptions",
+        pool: ThreadPoolExecutor,
+    ) -> None:
+        if options.outputformat == "zarr":
+            writeomezarr(
+                outpth,
+                data,
+                shape,
+                dataset.datatype,
+                [str(x) for x in dataset.getvalidchannels()],
+                ranges,
+                options.pixelsize,
+                options.compression,
+                pool,
+                4 * options.workers,
+            )
+            return
+        if not isinstance(data, np.ndarray):  # tifffile takes one plane at a time
+            data = (plane for frame in data for plane in frame)
+        kwargs = self._tiffoptions(outpth, shape, dataset, ranges, options)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "writing nonconformant BigTIFF ImageJ")
+            imwrite(outpth, data, **kwargs)
+
+    def _writememmap(
+        self,
+        outpth: Path,
+        shape: tuple[int, int, int, int],
+        dataset: DataSet,
+        ranges: list[Any],
+        options: "WriteOptions",
+        pool: ThreadPoolExecutor,
+        manifest: Manifest,
+        fillframe: Callable[[npt.NDArray[Any], int], None],
+        advance: Callable[[int], None],
+    ) -> None:
+        """
+        Write an uncompressed imagej TCYX stack through a memory map, a few
+        cells at a time. The cells that are written are recorded in the
+        manifest, so an interrupted export can continue where it stopped.
+        :param outpth: output file
+        :param shape: shape of the stack
+        :param dataset: dataset that is written
+        :param ranges: display range of each channel
+        :param options: settings of the export
+        :param pool: pool that fills the frames
+        :param manifest: manifest of the dataset
+        :param fillframe: fills the CYX frame of the k-th cell of the stack
+        :param advance: called with the number of cells that are written, for
+            progress
+        :return:
+        """
+        done = manifest.outputs.get(outpth.name, 0)
+        data = None
+        if done > 0:
+            try:
+                data = memmap(outpth, mode="r+")
+            except (OSError, ValueError, TiffFileError):
+                pass
+            if data is None or data.shape != shape or data.dtype != dataset.datatype:
+                data = None
+            else:
+                options.logger.info(f"Resuming {outpth.name} at cell {done}")
+        if data is None:
+            done = 0
+            kwargs = self._tiffoptions(outpth, shape, dataset, ranges, options)
+            del kwargs["compression"], kwargs["predictor"], kwargs["maxworkers"]
+            with warnings.catch_warnings():
+                warnings.filterwarnings(
+                    "ignore", "writing nonconformant BigTIFF ImageJ"
+                )
+                data = memmap(outpth, **kwargs)
+            manifest.outputs[outpth.name] = 0
+            manifest.save()
+        else:
+            advance(done)
+        for start in range(done, shape[0], RESUMESTEP):
+            end = min(start + RESUMESTEP, shape[0])
+            for _ in pool.map(lambda k: fillframe(data[k], k), range(start, end)):
+                pass
+            data.flush()
+            manifest.outputs[outpth.name] = end
+            manifest.save()
+            advance(end - start)
+        del data
+
+    def _tiffoptions(
+        self,
+        outpth: Path,
+        shape: tuple[int, int, int, int],
+        dataset: DataSet,
+        ranges: list[Any],
+        options: "WriteOptions",
+    ) -> dict[str, Any]:
+        """
+        Arguments of imwrite for a TCYX stack in the (tiff) output format
+        """
+        pixelsize = options.pixelsize
+        channelnames = [str(x) for x in dataset.getvalidchannels()]
+        datasize = math.prod(shape) * dataset.datatype.itemsize
+        bigtiff = datasize > BIGTIFFSIZE
+        if bigtiff:
+            options.logger.info(f"{outpth.name} is larger than 4 GB, writing BigTIFF")
+        kwargs: dict[str, Any] = {
+            "shape": shape,
+            "dtype": dataset.datatype,
+            "bigtiff": bigtiff,
+            "photometric": "minisblack",
+            "resolution": (1 / pixelsize, 1 / pixelsize),
+            "compression": options.compression,
+            "predictor": True if options.compression else None,
+            "maxworkers": options.workers,
+        }
+        if options.outputformat == "ometiff":
+            kwargs["ome"] = True
+            kwargs["resolutionunit"] = "MICROMETER"
+            kwargs["tile"] = (-(-shape[2] // 16) * 16, -(-shape[3] // 16) * 16)
+            kwargs["metadata"] = {
+                "axes": "TCYX",
+                "Channel": {"Name": channelnames},
+                "PhysicalSizeX": pixelsize,
+                "PhysicalSizeXUnit": "µm",
+                "PhysicalSizeY": pixelsize,
+                "PhysicalSizeYUnit": "µm",
+            }
+        else:
+            medians_str = "\n" + ",".join([str(int(x)) for x in dataset.medians])
+            kwargs["imagej"] = True
+            kwargs["metadata"] = {
+                "spacing": pixelsize,
+                "unit": "um",
+                "axes": "TCYX",
+                "Labels": channelnames * shape[0],
+                "Ranges": tuple(ranges),
+                "Properties": {"Medians": medians_str},
+            }
+        return kwargs
+
+    def _manifest(
+        self,
+        reader: Source,
+        folder: Path | str,
+        dataset: DataSet,
+        options: "WriteOptions",
+    ) -> Manifest:
+        """
+        Manifest of the export of a dataset, over the members of its cells. If a
+        manifest of the same export is stored, its progress is taken over; it is
+        complete if all its outputs still exist.
+        :param reader: reader of the zipfile
+        :param folder: output folder
+        :param dataset: the dataset
+        :param options: settings of the export
+        :return: the manifest
+        """
+        # the members of the cells of the dataset, looked up by name, rather
+        # than every member of the zipfile for every dataset
+        masks = dataset.masks
+        names = [
+            self._membername(dataset, stem, channel)
+            for channel in dataset.getchannels()
+            for stem in itertools.compress(
+                dataset.stems, masks >> np.uint64(channel.index) & np.uint64(1)
+            )
+        ]
+        infos = [reader.infos[name] for name in names if name in reader.infos]
+        settings = {
+            "channels": [[x.index, x.name] for x in dataset.getvalidchannels()],
+            "pixelsize": options.pixelsize,
+            "median": options.median,
+            "outputformat": options.outputformat,
+            "compression": options.compression,
+            "layout": dataset.layout,
+            "sizepercentile": dataset.sizepercentile,
+        }
+        # only set when used, which keeps older manifests valid
+        if options.shardsize is not None:
+            settings["shardsize"] = options.shardsize
+        if options.measurements is not None:
+            settings["measurements"] = options.measurements
+        pth = Manifest.manifestpath(folder, dataset.name)
+        manifest = Manifest(pth, memberskey(infos), settings)
+        stored = Manifest.load(pth)
+        if stored is not None and stored.matches(manifest):
+            manifest.outputs = stored.outputs
+            manifest.complete = stored.complete and all(
+                Path(folder, name).exists() for name in stored.outputs
+            )
+        return manifest
+
+    @staticmethod
+    def outputpath(folder: Path | str, datasetname: str, outputformat: str) -> Path:
+        return Path(folder, f"{datasetname}{OUTPUTFORMATS[outputformat]}")
+
+    def _scancell(
+        self,
+        reader: Source,
+        dataset: DataSet,
+        file: str,
+        channels: list[Channel],
+        median: str,
+        useindex: bool,
+        stats: ExportStats = NOSTATS,
+        measure: bool = False,
+    ) -> "_Cell":
+        """
+        Decode one cell, or take its shapes, medians and maxima from the index
+        :param reader: reader of the zipfile
+        :param dataset: dataset the cell belongs to
+        :param file: stem of the cell
+        :param channels: channels to read
+        :param median: median method
+        :param useindex: skip decoding if the index has all tiles of the cell
+        :param stats: collects the time spent decoding
+        :param measure: also sum each tile
+        :return: the cell, without tiles if it was taken from the index
+        """
+        names = [self._membername(dataset, file, channel) for channel in channels]
+        if useindex and self.index is not None:
+            stored = [self.index.gettile(name, median) for name in names]
+            tileinfos = [x for x in stored if x is not None]
+            if len(tileinfos) == len(names):
+                stats.count("tiles_cached", len(names))
+                return _Cell(
+                    [],
+                    [x[0] for x in tileinfos],
+                    [x[2] for x in tileinfos],
+                    [x[1] for x in tileinfos],
+                )
+        tiles = self._readcell(reader, dataset, file, channels, stats)
+        with stats.stage("median", dataset.name):
+            cell = _Cell.fromtiles(tiles, TILEMEDIANS[median], measure)
+        if self.index is not None:
+            for j, name in enumerate(names):
+                self.index.settile(
+                    name, median, cell.shapes[j], cell.maxima[j], cell.medians[j]
                 )
+        return cell
+
+    def _membername(self, dataset: DataSet, file: str, channel: Channel) -> str:
+        return f"{dataset}/{file}_Ch{channel.index}{self.suffix}"
+
+    def _readcell(
+        self,
+        reader: Source,
+        dataset: DataSet,
+        file: str,
+        channels: list[Channel],
+        stats: ExportStats = NOSTATS,
+    ) -> list[npt.NDArray[Any]]:
+        """
+        Decode the tiles of all channels of one cell
+        :param reader: reader of the zipfile
+        :param dataset: dataset the cell belongs to
+        :param file: stem of the cell
+        :param channels: channels to read
+        :param stats: collects the time spent inflating and decoding
+        :return: the decoded image for each channel
+        """
+        names = [self._membername(dataset, file, channel) for channel in channels]
+        with stats.stage("inflate", dataset.name):
+            data = reader.readmany(names)
+        tiles = []
+        for name, buffer in zip(names, data):
+            with (
+                cast(IO[bytes], MemoryFile(buffer)) as fh,
+                stats.stage("decode", dataset.name),
+                TiffFile(fh) as tfile,
+            ):
+                tiles.append(tfile.pages[0].asarray())
+            if stats.enabled:
+                stats.count("bytes_read", reader.infos[name].compress_size)
+                stats.count("bytes_inflated", reader.infos[name].file_size)
+        stats.count("tiles_decoded", len(channels))
+        return tiles
+
+
+class WriteOptions:
+    """
+    Settings of one writetiffs call
+    """
+
+    def __init__(
+        self,
+        pixelsize: float,
+        logger: logging.Logger,
+        workers: int = 1,
+        streaming: bool = False,
+        median: str = "exact",
+        outputformat: str = "imagej",
+        compression: str | None = None,
+        progress: Callable[[str, int, int], None] | None = None,
+        cancel: threading.Event | ProcessEvent | None = None,
+        stats: ExportStats | None = None,
+        incremental: bool = False,
+        shardsize: int | None = None,
+        measurements: str | None = None,
+    ) -> None:
+        if median not in TILEMEDIANS:
+            raise ValueError(f"Unknown median: {median}")
+        if outputformat not in OUTPUTFORMATS:
+            raise ValueError(f"Unknown output format: {outputformat}")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        if outputformat == "zarr" and compression not in (None, *ZARRCOMPRESSORS):
+            raise ValueError(f"Compression {compression} is not supported for zarr")
+        if shardsize is not None and shardsize < 1:
+            raise ValueError(f"Shard size {shardsize} is smaller than 1")
+        if measurements is not None and measurements not in MEASUREFORMATS:
+            raise ValueError(f"Unknown measurement format: {measurements}")
+        if measurements == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            raise ValueError("Writing parquet measurements needs pyarrow")
+        self.pixelsize = pixelsize
+        self.logger = logger
+        self.workers = max(workers, 1)
+        self.streaming = streaming
+        self.median = median
+        self.outputformat = outputformat
+        self.compression = compression
+        self.progress = progress
+        self.cancel = cancel
+        self.stats = stats if stats is not None else NOSTATS
+        self.incremental = incremental
+        self.shardsize = shardsize
+        self.measurements = measurements
+        # only uncompressed imagej stacks can be written through a memory map
+        self.resumable = outputformat == "imagej" and compression is None
+
+    def checkpoint(self, datasetname: str, done: int, total: int) -> None:
+        """
+        Report progress, called after each cell
+        :raises ExportCancelled: if the export was cancelled
+        """
+        if self.progress is not None:
+            self.progress(datasetname, done, total)
+        if self.cancel is not None and self.cancel.is_set():
+            raise ExportCancelled()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class _ForwardHandler(logging.Handler):
+    """
+    Hands records from other processes to the logger they were logged to
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+# set in each process of _writeprocesses by _initprocess
+_events: "multiprocessing.Queue[tuple[str, int, int]] | None" = None
+_cancel: ProcessEvent | None = None
+
+
+def _initprocess(
+    records: "multiprocessing.Queue[logging.LogRecord]",
+    events: "multiprocessing.Queue[tuple[str, int, int]] | None",
+    cancel: ProcessEvent,
+    level: int,
+) -> None:
+    global _events, _cancel
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(records)]
+    root.setLevel(level)
+    _events = events
+    _cancel = cancel
+
+
+def _writeprocess(
+    folder: Path | str, settings: dict[str, Any], isz: ImageStreamZip
+) -> tuple[list[Path], ExportStats, ScanIndex | None]:
+    """
+    Write the datasets of isz in a process of _writeprocesses
+    :return: the files that were written, the stats, and the index with the
+        members that were decoded
+    """
+    events = _events
+    enabled, trace = settings["stats"]
+    stats = ExportStats(enabled, trace)
+    written = isz.writetiffs(
+        folder,
+        settings["pixelsize"],
+        logging.getLogger(settings["logger"]),
+        workers=settings["workers"],
+        streaming=settings["streaming"],
+        median=settings["median"],
+        outputformat=settings["outputformat"],
+        compression=settings["compression"],
+        progress=None if events is None else lambda *args: events.put(args),
+        cancel=_cancel,
+        stats=stats,
+        incremental=settings["incremental"],
+        shardsize=settings["shardsize"],
+        measurements=settings["measurements"],
+    )
+    return written, stats, isz.index
+
+
+class _Cell:
+    """
+    Tiles of one cell, with the shape, median, maximum and, if measured, the
+    sum of each tile. There are no tiles if the cell was not decoded.
+    """
+
+    def __init__(
+        self,
+        tiles: list[npt.NDArray[Any]],
+        shapes: list[tuple[int, ...]],
+        medians: list[float],
+        maxima: list[Any],
+        sums: list[float] | None = None,
+    ) -> None:
+        self.tiles = tiles
+        self.shapes = shapes
+        self.medians = medians
+        self.maxima = maxima
+        self.sums = sums
+
+    @classmethod
+    def fromtiles(
+        cls,
+        tiles: list[npt.NDArray[Any]],
+        median: Callable[[npt.NDArray[Any]], float],
+        measure: bool = False,
+    ) -> "_Cell":
+        return cls(
+            tiles,
+            [tile.shape for tile in tiles],
+            [median(tile) for tile in tiles],
+            [tile.max() for tile in tiles],
+            [float(tile.sum(dtype=np.float64)) for tile in tiles] if measure else None,
+        )
+
+
+def _crop(tile: npt.NDArray[Any], height: int, width: int) -> npt.NDArray[Any]:
+    """
+    The center of a tile that is larger than the canvas
+    :param tile: the tile
+    :param height: height of the canvas
+    :param width: width of the canvas
+    :return: the tile, or its center if it is larger
+    """
+    cropx = max(tile.shape[0] - height, 0) // 2
+    cropy = max(tile.shape[1] - width, 0) // 2
+    return tile[cropx : cropx + height, cropy : cropy + width]
+
+
+def _placecell(
+    frame: npt.NDArray[Any],
+    tiles: list[npt.NDArray[Any]],
+    fills: list[npt.NDArray[Any]],
+) -> None:
+    """
+    Center the tiles of one cell in a CYX frame, padding with the fill value
+    and cropping tiles that are larger than the frame
+    :param frame: the frame to fill
+    :param tiles: tile for each channel
+    :param fills: padding value for each channel
+    :return:
+    """
+    for j, tile in enumerate(tiles):
+        # filling the whole frame and overwriting it is faster than filling the
+        # four strips around the tile, as a frame is contiguous but a strip is
+        # not (benchmarks.Place: 1.4-2x at 60-400 px canvases)
+        frame[j, :, :] = fills[j]
+        tile = _crop(tile, frame.shape[1], frame.shape[2])  # crop layout
+        w = tile.shape[0]
+        h = tile.shape[1]
+        offsetx = (frame.shape[1] - w) // 2
+        offsety = (frame.shape[2] - h) // 2
+        frame[j, offsetx : offsetx + w, offsety : offsety + h] = tile
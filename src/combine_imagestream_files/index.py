@@ -0,0 +1,211 @@
+import json
+import threading
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+
+def _tostring(array: npt.NDArray[np.uint8]) -> str:
+    return array.tobytes().decode()
+
+
+def _fromstring(string: str) -> npt.NDArray[np.uint8]:
+    return np.frombuffer(string.encode(), dtype=np.uint8)
+
+
+class ScanIndex:
+    """
+    Scan of a zipfile that is stored next to it, so an unchanged zipfile does
+    not have to be listed and decoded again. Holds the cells of each dataset,
+    and the shape, datatype, maximum and medians of each member.
+    """
+
+    VERSION = 2
+
+    def __init__(
+        self,
+        key: str,
+        cells: dict[str, tuple[list[str], npt.NDArray[np.uint64]]],
+        names: list[str],
+    ) -> None:
+        """
+        :param key: key of the zipfile, see Source.key
+        :param cells: stems and channel bitmasks of the cells of each dataset
+        :param names: name of each member
+        """
+        self.key = key
+        self.cells = json.dumps(
+            {name: [stems, masks.tolist()] for name, (stems, masks) in cells.items()}
+        )
+        self.names = names
+        self.rows = {name: i for i, name in enumerate(names)}
+        self.shapes = np.zeros((len(names), 2), dtype=np.int64)
+        self.dtypes = np.zeros(len(names), dtype="U8")
+        self.maxima = np.full(len(names), np.nan)
+        self.medians: dict[str, npt.NDArray[np.float64]] = {}
+        self.changed = True
+        self.partial = False  # a subset, which is never saved
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def indexpath(zipfile: Path) -> Path:
+        return Path(zipfile.parent, f"{zipfile.name}.index.npz")
+
+    @classmethod
+    def load(cls, pth: Path, key: str) -> "ScanIndex | None":
+        """
+        Load an index
+        :param pth: the index file
+        :param key: key of the zipfile, see Source.key
+        :return: the index, or None if it is missing, outdated or unreadable
+        """
+        try:
+            with np.load(pth) as npz:
+                if int(npz["version"]) != cls.VERSION or _tostring(npz["key"]) != key:
+                    return None
+                names = _tostring(npz["names"])
+                index = cls(key, {}, names.split("\n") if names else [])
+                index.cells = _tostring(npz["cells"])
+                index.shapes = npz["shapes"]
+                index.dtypes = npz["dtypes"]
+                index.maxima = npz["maxima"]
+                for method in npz["methods"]:
+                    index.medians[str(method)] = npz[f"medians_{method}"]
+        except (OSError, KeyError, ValueError):
+            return None
+        index.changed = False
+        return index
+
+    def save(self, pth: Path) -> None:
+        arrays: dict[str, Any] = {
+            "version": self.VERSION,
+            "key": _fromstring(self.key),
+            "cells": _fromstring(self.cells),
+            "names": _fromstring("\n".join(self.names)),
+            "shapes": self.shapes,
+            "dtypes": self.dtypes,
+            "maxima": self.maxima,
+            "methods": np.array(list(self.medians), dtype=str),
+        }
+        for method, medians in self.medians.items():
+            arrays[f"medians_{method}"] = medians
+        with open(pth, "wb") as f:
+            np.savez(f, **arrays)
+        self.changed = False
+
+    def getcells(self) -> dict[str, tuple[list[str], npt.NDArray[np.uint64]]]:
+        """
+        :return: stems and channel bitmasks of the cells of each dataset
+        """
+        return {
+            name: (stems, np.array(masks, dtype=np.uint64))
+            for name, (stems, masks) in json.loads(self.cells).items()
+        }
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def subset(self, prefix: str) -> "ScanIndex":
+        """
+        The members whose name starts with prefix, e.g. to send one dataset to
+        another process. The cells are not included.
+        :param prefix: e.g. "<dataset>/"
+        :return: index of these members
+        """
+        rows = [i for i, name in enumerate(self.names) if name.startswith(prefix)]
+        index = ScanIndex(self.key, {}, [self.names[i] for i in rows])
+        index.shapes = self.shapes[rows]
+        index.dtypes = self.dtypes[rows]
+        index.maxima = self.maxima[rows]
+        index.medians = {method: m[rows] for method, m in self.medians.items()}
+        index.changed = False
+        index.partial = True
+        return index
+
+    def update(self, other: "ScanIndex") -> None:
+        """
+        Take over the members that were decoded in another index, e.g. a subset
+        that was used in another process
+        :param other: the other index
+        :return:
+        """
+        if not other.changed:
+            return
+        found = np.flatnonzero(other.dtypes != "")
+        rows = [self.rows.get(other.names[i], -1) for i in found]
+        found = found[np.array(rows, dtype=np.intp) >= 0]
+        rows = [row for row in rows if row >= 0]
+        with self.lock:
+            self.shapes[rows] = other.shapes[found]
+            self.dtypes[rows] = other.dtypes[found]
+            self.maxima[rows] = other.maxima[found]
+            for method, medians in other.medians.items():
+                if method not in self.medians:
+                    self.medians[method] = np.full(len(self.names), np.nan)
+                self.medians[method][rows] = medians[found]
+            self.changed = True
+
+    def getshapes(
+        self, names: list[str]
+    ) -> tuple[npt.NDArray[np.int64], list[str]] | None:
+        """
+        Stored shapes and datatypes of members
+        :param names: names of the members
+        :return: shape and datatype of each member, or None if any member has
+            not been decoded
+        """
+        if any(name not in self.rows for name in names):
+            return None
+        rows = [self.rows[name] for name in names]
+        dtypes = self.dtypes[rows]
+        if np.any(dtypes == ""):
+            return None
+        return self.shapes[rows], dtypes.tolist()
+
+    def gettile(
+        self, name: str, method: str
+    ) -> tuple[tuple[int, int], Any, float] | None:
+        """
+        Stored information of one member
+        :param name: name of the member
+        :param method: median method
+        :return: shape, maximum (as a scalar of the datatype) and median, or None
+            if the member has not been decoded with this median method
+        """
+        row = self.rows.get(name)
+        if row is None or method not in self.medians:
+            return None
+        median = self.medians[method][row]
+        if np.isnan(median) or not self.dtypes[row]:
+            return None
+        maximum = np.array(self.maxima[row], dtype=self.dtypes[row])[()]
+        shape = (int(self.shapes[row, 0]), int(self.shapes[row, 1]))
+        return shape, maximum, float(median)
+
+    def settile(
+        self,
+        name: str,
+        method: str,
+        shape: tuple[int, ...],
+        maximum: Any,
+        median: float,
+    ) -> None:
+        row = self.rows.get(name)
+        if row is None:
+            return
+        with self.lock:
+            if method not in self.medians:
+                self.medians[method] = np.full(len(self.names), np.nan)
+            self.shapes[row] = shape[:2]
+            self.dtypes[row] = np.asarray(maximum).dtype.str
+            self.maxima[row] = maximum
+            self.medians[method][row] = median
+            self.changed = True
@@ -0,0 +1,452 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+from tifffile import (
+    TiffFile,
+    TiffPage,
+    TiffWriter,
+    imagej_description,
+    imagej_metadata_tag,
+)
+
+from combine_imagestream_files.channelmap import ChannelMap
+from combine_imagestream_files.dataset import Channel, DataSet
+from combine_imagestream_files.imagestreamzip import (
+    BIGTIFFSIZE,
+    ImageStreamZip,
+    _Cell,
+    _placecell,
+)
+from combine_imagestream_files.median import TILEMEDIANS, P2Median
+from combine_imagestream_files.parallel import imap
+from combine_imagestream_files.shards import ShardIndex
+from combine_imagestream_files.sources import DirectoryFollower, groupmembers
+from combine_imagestream_files.stats import NOSTATS, ExportStats
+from combine_imagestream_files.zipreader import ZipFollower
+
+INTERVAL = 1.0  # seconds between two looks at the source
+IDLE = 60.0  # stop when the source did not grow for this many seconds
+WARMUP = 64  # cells that set the canvas, before the first frame is written
+
+
+class LiveDataset:
+    """
+    A dataset of a live export. Cells are written as soon as all their channels
+    arrived, so the medians that pad them are a running P² estimate, and the
+    canvas is fixed: the given size, or the largest of the first WARMUP cells.
+    Larger cells are cropped. The display ranges and medians are written when
+    the dataset is finished.
+    """
+
+    def __init__(
+        self,
+        dataset: DataSet,
+        folder: Path,
+        pixelsize: float,
+        canvas: tuple[int, int] | None = None,
+        shardsize: int | None = None,
+        logger: logging.Logger = logging.getLogger("isz"),
+        stats: ExportStats = NOSTATS,
+    ) -> None:
+        """
+        :param dataset: the dataset, with the names of its channels
+        :param folder: output folder
+        :param pixelsize: pixelsize in um
+        :param canvas: size of each frame (default from the first cells)
+        :param shardsize: write shards of this many cells (default one stack,
+            or shards that fit in a classic TIFF if it gets larger than that)
+        :param logger: logger for progress and errors
+        :param stats: collects the time spent writing
+        """
+        self.dataset = dataset
+        self.channels = dataset.getvalidchannels()
+        self.required = 0  # the channels as bitmask
+        for channel in self.channels:
+            self.required |= 1 << channel.index
+        self.folder = folder
+        self.pixelsize = pixelsize
+        self.canvas = canvas
+        self.shardsize = shardsize
+        self.logger = logger
+        self.stats = stats
+        self.arrived: dict[str, int] = {}  # channels of the incomplete cells
+        self.warmup: list[tuple[str, _Cell]] = []
+        self.estimates = [P2Median() for _ in self.channels]
+        self.maxima: list[Any] = [None] * len(self.channels)
+        self.padded = [False] * len(self.channels)
+        self.cropped = 0  # cells larger than the canvas
+        self.datatype: np.dtype[Any] | None = None
+        self.writer: TiffWriter | None = None
+        self.shards: list[tuple[Path, list[str]]] = []  # file and stems of each
+        self.start = time.perf_counter()
+
+    def __str__(self) -> str:
+        return self.dataset.name
+
+    @property
+    def cells(self) -> int:
+        """
+        Number of cells that are written or waiting for the canvas
+        """
+        return sum(len(stems) for _, stems in self.shards) + len(self.warmup)
+
+    def arrive(self, stem: str, channel: int) -> bool:
+        """
+        Record that a channel of a cell arrived
+        :param stem: stem of the cell
+        :param channel: index of the channel
+        :return: whether the cell has all channels now
+        """
+        if not self.required >> channel & 1:
+            return False
+        mask = self.arrived.get(stem, 0) | 1 << channel
+        if mask == self.required:
+            self.arrived.pop(stem, None)
+            return True
+        self.arrived[stem] = mask
+        return False
+
+    def add(self, stem: str, cell: _Cell) -> None:
+        """
+        Add a decoded cell, writing it unless the canvas is not known yet
+        :param stem: stem of the cell
+        :param cell: the decoded cell
+        :return:
+        """
+        for j in range(len(cell.tiles)):
+            self.estimates[j].add(cell.medians[j])
+            if self.maxima[j] is None or cell.maxima[j] > self.maxima[j]:
+                self.maxima[j] = cell.maxima[j]
+        if self.datatype is None:
+            self.datatype = cell.tiles[0].dtype
+        if self.canvas is not None:
+            self._write(stem, cell)
+            return
+        self.warmup.append((stem, cell))
+        if len(self.warmup) >= WARMUP:
+            self._writewarmup()
+
+    def _writewarmup(self) -> None:
+        """
+        Set the canvas from the cells that waited for it, and write them
+        """
+        shapes = np.array([shape for _, cell in self.warmup for shape in cell.shapes])
+        self.canvas = (int(shapes[:, 0].max()), int(shapes[:, 1].max()))
+        warmup, self.warmup = self.warmup, []
+        for stem, cell in warmup:
+            self._write(stem, cell)
+
+    def _write(self, stem: str, cell: _Cell) -> None:
+        assert self.canvas is not None and self.datatype is not None
+        for j, shape in enumerate(cell.shapes):
+            self.padded[j] |= shape[0] < self.canvas[0] or shape[1] < self.canvas[1]
+        if any(s[0] > self.canvas[0] or s[1] > self.canvas[1] for s in cell.shapes):
+            self.cropped += 1
+        fills = [
+            np.asarray(estimate.value()).astype(self.datatype)
+            for estimate in self.estimates
+        ]
+        frame = np.empty((len(self.channels), *self.canvas), dtype=self.datatype)
+        with self.stats.stage("place", str(self)):
+            _placecell(frame, cell.tiles, fills)
+        limit = max(BIGTIFFSIZE // frame.nbytes, 1)  # cells in a classic TIFF
+        shardsize = min(self.shardsize or limit, limit)
+        if self.writer is not None and len(self.shards[-1][1]) >= shardsize:
+            self.writer.close()
+            self.writer = None
+        if self.writer is None:
+            name = ShardIndex.shardname(str(self), len(self.shards))
+            outpth = ImageStreamZip.outputpath(self.folder, name, "imagej")
+            outpth.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = TiffWriter(outpth, imagej=True)
+            self.shards.append((outpth, []))
+        with self.stats.stage("write", str(self)):
+            self.writer.write(
+                frame,
+                contiguous=True,
+                photometric="minisblack",
+                resolution=(1 / self.pixelsize, 1 / self.pixelsize),
+                # placeholders, replaced in finish
+                metadata={
+                    "spacing": self.pixelsize,
+                    "unit": "um",
+                    "Labels": [str(x) for x in self.channels],
+                    "Ranges": (0, 0) * len(self.channels),
+                    "Properties": {"Medians": ""},
+                },
+            )
+        self.shards[-1][1].append(stem)
+
+    def finish(self) -> list[Path]:
+        """
+        Write the cells that wait for the canvas, and the shape, display ranges
+        and medians of each stack. Cells that never got all their channels are
+        skipped.
+        :return: the files that were written
+        """
+        for stem, mask in self.arrived.items():
+            for channel in self.channels:
+                if not mask >> channel.index & 1:
+                    self.logger.error(
+                        f"{stem} does not have {channel.index}. Skipping file."
+                    )
+        if self.warmup:
+            self._writewarmup()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if not self.shards:
+            self.logger.warning(f"No complete cells in {self}")
+            return []
+        assert self.canvas is not None
+        if self.cropped:
+            self.logger.warning(
+                f"{self.cropped} cells of {self} are larger than the canvas "
+                f"{self.canvas[0]}x{self.canvas[1]} and are cropped"
+            )
+        medians = [estimate.value() for estimate in self.estimates]
+        ranges = []
+        for j, median in enumerate(medians):
+            ranges.append(median)
+            ranges.append(
+                max(self.maxima[j], median) if self.padded[j] else self.maxima[j]
+            )
+        for outpth, stems in self.shards:
+            self._finishstack(outpth, len(stems), medians, ranges)
+        if self.shardsize is None and len(self.shards) == 1:  # an ordinary stack
+            outpth = ImageStreamZip.outputpath(self.folder, str(self), "imagej")
+            self.shards[0][0].replace(outpth)
+            written = [outpth]
+        else:
+            index = ShardIndex(
+                ShardIndex.indexpath(self.folder, str(self)),
+                str(self),
+                [str(x) for x in self.channels],
+            )
+            for outpth, stems in self.shards:
+                index.addshard(outpth.name, stems)
+            index.save()
+            written = [outpth for outpth, _ in self.shards]
+        self.stats.adddataset(str(self), self.cells, time.perf_counter() - self.start)
+        return written
+
+    def _finishstack(
+        self, outpth: Path, frames: int, medians: list[float], ranges: list[Any]
+    ) -> None:
+        """
+        Replace the placeholder metadata of a stack, now that its number of
+        frames, display ranges and medians are known
+        """
+        assert self.canvas is not None
+        shape = (frames, len(self.channels), *self.canvas)
+        description = imagej_description(
+            shape, axes="TCYX", spacing=self.pixelsize, unit="um", loop=False
+        )
+        metadata = {
+            "Labels": [str(x) for x in self.channels] * frames,
+            "Ranges": tuple(ranges),
+            "Properties": {"Medians": "\n" + ",".join(str(int(x)) for x in medians)},
+        }
+        with TiffFile(outpth, mode="r+") as tif:
+            page = tif.pages[0]
+            assert isinstance(page, TiffPage)
+            tags = page.tags
+            tags[270].overwrite(description)
+            for code, dtype, _, value, _ in imagej_metadata_tag(
+                metadata, tif.byteorder
+            ):
+                tags[code].overwrite(value, dtype=dtype)
+
+
+class LiveExport:
+    """
+    Combines the cells of an ImageStream export while it is still being
+    written, to a zipfile or to a folder with a subfolder for each dataset.
+    New members are found every interval, and each cell is decoded and added
+    to the stack of its dataset as soon as all its named channels arrived. The
+    export ends when the zipfile is complete, when the source did not grow for
+    idle seconds, or when it is cancelled. Only uncompressed imagej stacks can
+    grow like this.
+    """
+
+    def __init__(
+        self,
+        source: Path | str,
+        folder: Path | str,
+        pixelsize: float,
+        channelmap: ChannelMap | None = None,
+        logger: logging.Logger = logging.getLogger("isz"),
+        workers: int = 1,
+        median: str = "histogram",
+        canvas: tuple[int, int] | None = None,
+        shardsize: int | None = None,
+        interval: float = INTERVAL,
+        idle: float = IDLE,
+        progress: Callable[[str, int, int], None] | None = None,
+        cancel: threading.Event | None = None,
+        stats: ExportStats | None = None,
+        suffix: str = ".ome.tif",
+    ) -> None:
+        """
+        :param source: the zipfile or folder that is being written
+        :param folder: output folder
+        :param pixelsize: pixelsize in um
+        :param channelmap: names of the channels to export, which override the
+            channel maps next to the source (see ChannelMap.find). Datasets
+            without names are skipped.
+        :param logger: logger for progress and errors
+        :param workers: number of threads decoding tiles
+        :param median: how the median of each tile is computed, one of
+            median.TILEMEDIANS. The median of a dataset is always a P² estimate.
+        :param canvas: size of the frames (default the largest of the first
+            WARMUP cells of each dataset)
+        :param shardsize: write shards of this many cells, see writetiffs
+        :param interval: seconds between two looks at the source
+        :param idle: stop when the source did not grow for this many seconds
+        :param progress: called with the name of a dataset, the number of its
+            cells that are written, and that number plus the number of cells
+            that still miss a channel
+        :param cancel: stop after the current batch of cells when this is set.
+            What was written so far is finished as a valid stack.
+        :param stats: collects the time spent in each stage
+        :param suffix: suffix of the members that are cells
+        """
+        if median not in TILEMEDIANS:
+            raise ValueError(f"Unknown median: {median}")
+        if shardsize is not None and shardsize < 1:
+            raise ValueError(f"Shard size {shardsize} is smaller than 1")
+        self.source = Path(source)
+        self.folder = Path(folder)
+        self.pixelsize = pixelsize
+        self.channelmap = channelmap
+        self.logger = logger
+        self.workers = max(workers, 1)
+        self.median = median
+        self.canvas = canvas
+        self.shardsize = shardsize
+        self.interval = interval
+        self.idle = idle
+        self.progress = progress
+        self.cancel = cancel
+        self.stats = stats if stats is not None else NOSTATS
+        self.isz = ImageStreamZip(suffix)
+        self.datasets: dict[str, LiveDataset | None] = {}  # None if not exported
+        self.reader: ZipFollower | DirectoryFollower = (
+            DirectoryFollower(self.source)
+            if self.source.is_dir()
+            else ZipFollower(self.source)
+        )
+
+    def run(self) -> list[Path]:
+        """
+        Follow the source until it is complete, idle or cancelled
+        :return: the files that were written
+        """
+        logging.getLogger("tifffile").setLevel(logging.ERROR)
+        lastgrowth = time.monotonic()
+        try:
+            with self.reader, ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while True:
+                    with self.stats.stage("scan"):
+                        names = self.reader.follow()
+                    if names:
+                        lastgrowth = time.monotonic()
+                    self._addcells(pool, self._arrive(names))
+                    if self.reader.finished:
+                        self.logger.info(f"{self.source.name} is complete")
+                        break
+                    if time.monotonic() - lastgrowth > self.idle:
+                        self.logger.info(
+                            f"{self.source.name} did not grow for {self.idle} s"
+                        )
+                        break
+                    if self.cancel is not None and self.cancel.is_set():
+                        self.logger.warning(
+                            f"Live export of {self.source.name} cancelled"
+                        )
+                        break
+                    time.sleep(self.interval)
+        finally:
+            # the stacks written so far stay readable when following fails
+            written = []
+            for live in self.datasets.values():
+                if live is not None:
+                    written.extend(live.finish())
+        return written
+
+    def _arrive(self, names: list[str]) -> list[tuple[LiveDataset, str]]:
+        """
+        Record the new members
+        :param names: names of the new members
+        :return: the dataset and stem of each cell that is complete now
+        """
+        cells, _ = groupmembers(names, self.isz.suffix)
+        complete = []
+        for folder, (stems, channels) in cells.items():
+            if folder not in self.datasets:
+                self.datasets[folder] = self._newdataset(folder)
+            live = self.datasets[folder]
+            if live is None:
+                continue
+            for stem, channel in zip(stems, channels):
+                if live.arrive(stem, channel):
+                    complete.append((live, stem))
+        return complete
+
+    def _newdataset(self, name: str) -> LiveDataset | None:
+        """
+        Start a dataset that appeared in the source
+        :param name: name of the dataset
+        :return: the dataset, or None if none of its channels is named
+        """
+        channelmap = ChannelMap.find(self.source, [name], self.channelmap)
+        names = channelmap.get(name)
+        channels = [
+            Channel(index, channelname)
+            for index, channelname in sorted((names or {}).items())
+            if channelname
+        ]
+        if not channels:
+            self.logger.warning(f"No channel map for {name}, skipping it")
+            return None
+        dataset = DataSet(name)
+        dataset.setchannels(channels)
+        self.logger.info(f"Following {name}: {', '.join(map(str, channels))}")
+        return LiveDataset(
+            dataset,
+            self.folder,
+            self.pixelsize,
+            self.canvas,
+            self.shardsize,
+            self.logger,
+            self.stats,
+        )
+
+    def _addcells(
+        self, pool: ThreadPoolExecutor, complete: list[tuple[LiveDataset, str]]
+    ) -> None:
+        """
+        Decode complete cells on the pool and add them to their datasets, in
+        the order they were completed
+        """
+        tilemedian = TILEMEDIANS[self.median]
+
+        def decodecell(job: tuple[LiveDataset, str]) -> _Cell:
+            live, stem = job
+            tiles = self.isz._readcell(
+                self.reader, live.dataset, stem, live.channels, self.stats
+            )
+            with self.stats.stage("median", str(live)):
+                return _Cell.fromtiles(tiles, tilemedian)
+
+        for (live, stem), cell in zip(
+            complete, imap(pool, decodecell, complete, 4 * self.workers)
+        ):
+            live.add(stem, cell)
+            if self.progress is not None:
+                self.progress(str(live), live.cells, live.cells + len(live.arrived))
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Sequence
+from zipfile import ZipInfo
+
+from combine_imagestream_files.sources import MemberInfo
+
+
+def memberskey(infos: Sequence[ZipInfo | MemberInfo]) -> str:
+    """
+    Key that changes when a member is added, removed or changed
+    :param infos: the members
+    :return: hash of the name, size and CRC of each member
+    """
+    sha = hashlib.sha1()
+    for info in sorted(infos, key=lambda info: info.filename):
+        sha.update(f"{info.filename}\0{info.file_size}\0{info.CRC}\n".encode())
+    return sha.hexdigest()
+
+
+class Manifest:
+    """
+    Record of the export of one dataset, stored next to its output. Holds
+    what the output depends on: the members of the dataset, the selected
+    channels and the export settings. An interrupted export also records how
+    many cells of each output are written, so it can be resumed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, pth: Path, key: str, settings: dict[str, Any]) -> None:
+        """
+        :param pth: the manifest file
+        :param key: memberskey of the members of the dataset
+        :param settings: channels and settings that change the output
+        """
+        self.pth = pth
+        self.key = key
+        self.settings = settings
+        self.outputs: dict[str, int] = {}  # cells written to each output
+        self.complete = False
+        self.lock = threading.Lock()  # shards save it from many threads
+
+    @staticmethod
+    def manifestpath(folder: Path | str, datasetname: str) -> Path:
+        return Path(folder, f"{datasetname}.manifest.json")
+
+    @classmethod
+    def load(cls, pth: Path) -> "Manifest | None":
+        """
+        Load a manifest
+        :param pth: the manifest file
+        :return: the manifest, or None if it is missing or unreadable
+        """
+        try:
+            with open(pth, "r") as f:
+                data = json.load(f)
+            if data["version"] != cls.VERSION:
+                return None
+            manifest = cls(pth, data["key"], data["settings"])
+            manifest.outputs = {k: int(v) for k, v in data["outputs"].items()}
+            manifest.complete = bool(data["complete"])
+        except (OSError, KeyError, ValueError, TypeError, AttributeError):
+            return None
+        return manifest
+
+    def save(self) -> None:
+        """
+        Save the manifest, replacing the old one in one step so an interrupted
+        save leaves the old manifest
+        :return:
+        """
+        with self.lock:
+            data = {
+                "version": self.VERSION,
+                "key": self.key,
+                "settings": self.settings,
+                "outputs": dict(self.outputs),
+                "complete": self.complete,
+            }
+            tmp = self.pth.with_name(f"{self.pth.name}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.pth)
+
+    def matches(self, other: "Manifest") -> bool:
+        """
+        Is this the manifest of the same export
+        :param other: manifest of the other export
+        :return: whether the members and settings are the same
+        """
+        return self.key == other.key and self.settings == other.settings
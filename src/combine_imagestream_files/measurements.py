@@ -0,0 +1,78 @@
+import csv
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+# measured for each channel of each cell, on the tile before it is padded
+MEASUREMENTS = ("area", "mean", "integrated", "max", "median")
+
+
+def measurementspath(folder: Path | str, datasetname: str, fmt: str) -> Path:
+    return Path(folder, f"{datasetname}.measurements.{fmt}")
+
+
+def measurementtable(
+    stems: list[str],
+    stacks: list[str],
+    frames: npt.NDArray[np.intp],
+    channels: list[str],
+    shapes: npt.NDArray[np.int_],
+    sums: npt.NDArray[np.float64],
+    maxima: npt.NDArray[Any],
+    medians: npt.NDArray[np.float64],
+) -> dict[str, npt.NDArray[Any]]:
+    """
+    Table with a row for each cell
+    :param stems: stem of each cell, its ID
+    :param stacks: output file of each cell
+    :param frames: frame of each cell in its output file
+    :param channels: name of each channel
+    :param shapes: (cells, channels, 2) shape of each tile
+    :param sums: (cells, channels) sum of each tile
+    :param maxima: (cells, channels) maximum of each tile
+    :param medians: (cells, channels) median of each tile
+    :return: the columns: stem, stack, frame, and <channel>_<measurement> for
+        each channel and each of MEASUREMENTS
+    """
+    areas = shapes[..., 0] * shapes[..., 1]
+    measured = {
+        "area": areas,
+        "mean": sums / np.maximum(areas, 1),
+        "integrated": sums,
+        "max": maxima,
+        "median": medians,
+    }
+    columns: dict[str, npt.NDArray[Any]] = {
+        "stem": np.array(stems, dtype=str),
+        "stack": np.array(stacks, dtype=str),
+        "frame": np.asarray(frames),
+    }
+    for j, channel in enumerate(channels):
+        for measurement in MEASUREMENTS:
+            columns[f"{channel}_{measurement}"] = measured[measurement][:, j]
+    return columns
+
+
+def writemeasurements(pth: Path, columns: dict[str, npt.NDArray[Any]]) -> None:
+    """
+    Write a measurement table as CSV, npz or Parquet, after the suffix of pth.
+    Parquet needs pyarrow.
+    :param pth: the file
+    :param columns: the table, see measurementtable
+    :return:
+    """
+    if pth.suffix == ".npz":
+        with open(pth, "wb") as f:
+            np.savez(f, **columns)  # type: ignore[arg-type]
+    elif pth.suffix == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.table(columns), pth)
+    else:
+        with open(pth, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(zip(*(column.tolist() for column in columns.values())))
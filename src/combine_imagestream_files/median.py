@@ -0,0 +1,159 @@
+from typing import Any, Callable
+
+import numpy as np
+import numpy.typing as npt
+
+SUBSAMPLES = 1024  # number of pixels used by the subsampled median
+
+
+def exact(tile: npt.NDArray[Any]) -> float:
+    return float(np.median(tile))
+
+
+def histogram(tile: npt.NDArray[Any]) -> float:
+    """
+    Exact median from a histogram of the pixel values. Gives the same result as
+    np.median, but avoids sorting for 8 and 16 bit integer images.
+    :param tile: the image
+    :return: the median
+    """
+    if tile.dtype.kind not in "ui" or tile.dtype.itemsize > 2 or tile.size == 0:
+        return exact(tile)
+    flat = tile.ravel()
+    low = flat.min()
+    if tile.dtype.kind == "u":
+        counts = np.bincount(flat - low)
+    else:
+        counts = np.bincount(flat.astype(np.intp) - int(low))
+    cumulative = np.cumsum(counts)
+    lower = np.searchsorted(cumulative, (flat.size - 1) // 2, side="right")
+    upper = np.searchsorted(cumulative, flat.size // 2, side="right")
+    return (int(lower) + int(upper)) / 2 + int(low)
+
+
+def subsample(tile: npt.NDArray[Any]) -> float:
+    """
+    Estimate the median from at most SUBSAMPLES evenly spaced pixels
+    :param tile: the image
+    :return: the estimated median
+    """
+    flat = tile.ravel()
+    return histogram(flat[:: max(flat.size // SUBSAMPLES, 1)])
+
+
+class P2Median:
+    """
+    Streaming estimate of the median with the P² algorithm (Jain & Chlamtac,
+    1985). Uses five markers, so the values do not have to be stored.
+    """
+
+    def __init__(self) -> None:
+        self.heights: list[float] = []  # marker heights
+        self.positions = [1, 2, 3, 4, 5]  # marker positions
+        self.desired = [1.0, 2.0, 3.0, 4.0, 5.0]  # desired marker positions
+        self.increments = [0.0, 0.25, 0.5, 0.75, 1.0]
+
+    def add(self, value: float) -> None:
+        if len(self.heights) < 5:
+            self.heights.append(value)
+            self.heights.sort()
+            return
+        q = self.heights
+        n = self.positions
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= value < q[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):  # adjust the middle markers
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0 else -1
+                parabolic = q[i] + step / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:  # linear
+                    q[i] += step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+                n[i] += step
+
+    def value(self) -> float:
+        if len(self.heights) == 5:
+            return self.heights[2]
+        if len(self.heights) == 0:
+            return 0.0
+        return float(np.median(self.heights))
+
+
+# median of a single tile for each method
+TILEMEDIANS: dict[str, Callable[[npt.NDArray[Any]], float]] = {
+    "exact": exact,
+    "histogram": histogram,
+    "subsample": subsample,
+    "p2": histogram,
+}
+
+
+class DatasetMedians:
+    """
+    Median over all cells of the tile medians of each channel, collected while
+    the cells are decoded. The exact median keeps the tile medians of every
+    cell. The "p2" method keeps a P² estimate of each channel instead, so its
+    memory does not grow with the cells. Cells that are not added count as 0,
+    as skipped cells did in the original export.
+    """
+
+    def __init__(self, cells: int, channels: int, method: str, keep: bool = False):
+        """
+        :param cells: number of cells
+        :param channels: number of channels
+        :param method: "p2" for a streaming estimate, exact otherwise
+        :param keep: keep the tile medians of every cell, also for "p2"
+        """
+        self.cells = cells
+        self.table: npt.NDArray[np.float64] | None = None  # (cells, channels)
+        if method != "p2" or keep:
+            self.table = np.zeros((cells, channels), dtype=float)
+        self.estimates = [P2Median() for _ in range(channels)] if method == "p2" else []
+        self.added = 0  # cells given to the estimates, in order
+
+    def add(self, row: int, medians: list[float]) -> None:
+        """
+        Add the tile medians of a cell. The estimates need the cells in order.
+        :param row: the cell
+        :param medians: median of the tile of each channel
+        :return:
+        """
+        if self.table is not None:
+            self.table[row] = medians
+        if self.estimates:
+            self._skip(row)
+            for estimate, median in zip(self.estimates, medians):
+                estimate.add(float(median))
+            self.added = row + 1
+
+    def _skip(self, row: int) -> None:
+        for _ in range(self.added, row):
+            for estimate in self.estimates:
+                estimate.add(0.0)
+        self.added = max(self.added, row)
+
+    def value(self) -> npt.NDArray[np.float64]:
+        """
+        :return: median for each channel
+        """
+        if not self.estimates:
+            assert self.table is not None
+            exactmedians: npt.NDArray[np.float64] = np.median(self.table, axis=0)
+            return exactmedians
+        self._skip(self.cells)
+        return np.array([estimate.value() for estimate in self.estimates])
@@ -0,0 +1,140 @@
+import json
+import shutil
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import imagecodecs
+import numpy as np
+import numpy.typing as npt
+
+from combine_imagestream_files.parallel import imap
+
+# numcodecs configuration and encoder of each compression
+ZARRCOMPRESSORS: dict[
+    str, tuple[dict[str, Any], Callable[[Any], bytes | bytearray]]
+] = {
+    "zlib": ({"id": "zlib", "level": 6}, lambda x: imagecodecs.zlib_encode(x, 6)),
+    "zstd": ({"id": "zstd", "level": 5}, lambda x: imagecodecs.zstd_encode(x, 5)),
+}
+
+
+def writeomezarr(
+    outpth: Path,
+    frames: Iterable[npt.NDArray[Any]],
+    shape: tuple[int, int, int, int],
+    dtype: np.dtype[Any],
+    channelnames: list[str],
+    ranges: list[Any],
+    pixelsize: float,
+    compression: str | None,
+    pool: Executor,
+    window: int,
+) -> None:
+    """
+    Write a TCYX stack as OME-Zarr (NGFF 0.4, zarr format 2) with one chunk
+    for each channel of each cell. Chunks are compressed on the pool.
+    :param outpth: output folder, replaced if it exists
+    :param frames: the CYX frame of each cell
+    :param shape: shape of the stack
+    :param dtype: datatype of the stack
+    :param channelnames: name of each channel
+    :param ranges: display range of each channel (start, end, start, end, ...)
+    :param pixelsize: pixelsize in um
+    :param compression: None or one of ZARRCOMPRESSORS
+    :param pool: pool that compresses and writes the chunks
+    :param window: maximum number of chunks in flight
+    :return:
+    """
+    if compression is not None and compression not in ZARRCOMPRESSORS:
+        raise ValueError(f"Compression {compression} is not supported for zarr")
+    compressor, encode = ZARRCOMPRESSORS.get(compression or "", (None, None))
+    if outpth.exists():
+        shutil.rmtree(outpth)
+    array = Path(outpth, "0")
+    array.mkdir(parents=True)
+    _writejson(Path(outpth, ".zgroup"), {"zarr_format": 2})
+    _writejson(
+        Path(outpth, ".zattrs"),
+        {
+            "multiscales": [
+                {
+                    "version": "0.4",
+                    "name": outpth.name,
+                    "axes": [
+                        {"name": "t", "type": "time"},
+                        {"name": "c", "type": "channel"},
+                        {"name": "y", "type": "space", "unit": "micrometer"},
+                        {"name": "x", "type": "space", "unit": "micrometer"},
+                    ],
+                    "datasets": [
+                        {
+                            "path": "0",
+                            "coordinateTransformations": [
+                                {
+                                    "type": "scale",
+                                    "scale": [1.0, 1.0, pixelsize, pixelsize],
+                                }
+                            ],
+                        }
+                    ],
+                }
+            ],
+            "omero": {
+                "channels": [
+                    {
+                        "label": name,
+                        "color": "FFFFFF",
+                        "active": True,
+                        "window": {
+                            "start": float(ranges[2 * i]),
+                            "end": float(ranges[2 * i + 1]),
+                            "min": float(_limits(dtype)[0]),
+                            "max": float(_limits(dtype)[1]),
+                        },
+                    }
+                    for i, name in enumerate(channelnames)
+                ],
+                "rdefs": {"model": "greyscale"},
+            },
+        },
+    )
+    _writejson(
+        Path(array, ".zarray"),
+        {
+            "zarr_format": 2,
+            "shape": list(shape),
+            "chunks": [1, 1, shape[2], shape[3]],
+            "dtype": dtype.str,
+            "compressor": compressor,
+            "fill_value": 0,
+            "order": "C",
+            "filters": None,
+            "dimension_separator": "/",
+        },
+    )
+
+    def writechunk(item: tuple[int, int, npt.NDArray[Any]]) -> None:
+        t, c, plane = item
+        chunk = Path(array, str(t), str(c), "0", "0")
+        chunk.parent.mkdir(parents=True, exist_ok=True)
+        data = np.ascontiguousarray(plane)
+        chunk.write_bytes(encode(data) if encode is not None else data.tobytes())
+
+    chunks = (
+        (t, c, plane) for t, frame in enumerate(frames) for c, plane in enumerate(frame)
+    )
+    for _ in imap(pool, writechunk, chunks, window):
+        pass
+
+
+def _limits(dtype: np.dtype[Any]) -> tuple[float, float]:
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        return float(info.min), float(info.max)
+    return 0.0, 1.0
+
+
+def _writejson(pth: Path, data: dict[str, Any]) -> None:
+    with open(pth, "w") as f:
+        json.dump(data, f, indent=2)
@@ -0,0 +1,131 @@
+"""
+Choices of the export settings, and the command line options that set them.
+Kept free of numpy and tifffile, so the command line can show its help and
+list a zipfile without importing them.
+"""
+
+import argparse
+from typing import Any
+
+OUTPUTFORMATS = {"imagej": ".tif", "ometiff": ".ome.tif", "zarr": ".ome.zarr"}
+COMPRESSIONS = ("zlib", "zstd", "lzw")
+LAYOUTS = ("pad", "crop", "split", "buckets")  # handling of cells of different sizes
+MEDIANS = ("exact", "histogram", "subsample", "p2")  # see median.TILEMEDIANS
+MEASUREFORMATS = ("csv", "npz", "parquet")  # parquet needs pyarrow
+
+
+def addexportoptions(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the options of the export that the command line tools share
+    :param parser: the parser of a command line tool
+    :return:
+    """
+    parser.add_argument(
+        "-p",
+        type=float,
+        help="Pixelsize",
+        default=1.0,
+    )
+    parser.add_argument(
+        "-c",
+        type=str,
+        help="TOML or JSON file with the names of the channels to export, like "
+        "the user interface saves. Overrides <zipfile>.toml and <dataset>.toml "
+        "next to the zipfile.",
+        default="",
+    )
+    parser.add_argument(
+        "-s",
+        action="store_true",
+        help="Stream cells to the output file to limit memory use",
+    )
+    parser.add_argument(
+        "-m",
+        type=str,
+        choices=MEDIANS,
+        help="Median used for the background",
+        default="exact",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=list(OUTPUTFORMATS),
+        help="Output format",
+        default="imagej",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=COMPRESSIONS,
+        help="Compression of the output",
+        default=None,
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        choices=LAYOUTS,
+        help="Handling of cells of different sizes: pad to the largest cell, crop "
+        "to the size percentile, split the larger cells off to an _oversized "
+        "stack, or a stack for each size bucket",
+        default="pad",
+    )
+    parser.add_argument(
+        "--percentile",
+        type=float,
+        help="Size percentile that is the canvas size of the crop and split layouts",
+        default=100.0,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip datasets whose cells, channels and settings did not change "
+        "since the last export with this option, and resume interrupted exports",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of datasets that are written at the same time, each in its "
+        "own process with -j threads",
+        default=1,
+    )
+    parser.add_argument(
+        "--memory",
+        type=float,
+        help="Estimated memory in GB that the datasets written at the same time "
+        "may use together (default half the physical memory)",
+        default=None,
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Split each stack into shards of this many cells, written at the "
+        "same time, with a <dataset>.shards.json index of the cells",
+        default=None,
+    )
+    parser.add_argument(
+        "--measure",
+        choices=MEASUREFORMATS,
+        help="Also write the area, mean, integrated, maximum and median intensity "
+        "of each channel of each cell to <dataset>.measurements.<format>",
+        default=None,
+    )
+
+
+def writeoptions(args: argparse.Namespace) -> dict[str, Any]:
+    """
+    The arguments of ImageStreamZip.writetiffs from the options that
+    addexportoptions added
+    :param args: the parsed command line
+    :return: the keyword arguments
+    """
+    return {
+        "streaming": args.s,
+        "median": args.m,
+        "outputformat": args.format,
+        "compression": args.compression,
+        "incremental": args.incremental,
+        "processes": args.processes,
+        "memory": None if args.memory is None else args.memory * 2**30,
+        "shardsize": args.shards,
+        "measurements": args.measure,
+    }
@@ -0,0 +1,90 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Callable, Iterable, Iterator, Sequence, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def imap(
+    pool: Executor,
+    func: Callable[[T], R],
+    items: Iterable[T],
+    window: int,
+) -> Iterator[R]:
+    """
+    Like pool.map, but with a limited number of tasks in flight, so the results
+    of a long iterable are not all kept in memory.
+    :param pool: the pool that runs func
+    :param func: function to apply
+    :param items: items to apply func to
+    :param window: maximum number of pending results
+    :return: the results, in order of items. When this stops early, tasks in
+        flight are cancelled or waited for.
+    """
+    futures: deque[Future[R]] = deque()
+    try:
+        for item in items:
+            futures.append(pool.submit(func, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+
+def budgeted(
+    pool: Executor,
+    func: Callable[[T], R],
+    items: Sequence[T],
+    weights: Sequence[float],
+    memory: Sequence[float],
+    budget: float,
+    slots: int,
+    poll: Callable[[], bool] | None = None,
+    interval: float = 0.1,
+) -> Iterator[tuple[T, R]]:
+    """
+    Run func on items concurrently, heaviest first, with at most slots tasks in
+    flight and the memory of the tasks in flight within budget. A task that
+    does not fit the budget alone still runs, when nothing else is running.
+    :param pool: the pool that runs func
+    :param func: function to apply
+    :param items: items to apply func to
+    :param weights: weight of each item, e.g. its size in bytes
+    :param memory: memory each item needs
+    :param budget: memory of all tasks in flight together
+    :param slots: maximum number of tasks in flight
+    :param poll: called every interval seconds while waiting. No more tasks are
+        started once it returns False, the tasks in flight are finished.
+    :param interval: seconds between two calls of poll
+    :return: the items and their results, in the order they finish
+    """
+    pending = sorted(range(len(items)), key=lambda i: weights[i], reverse=True)
+    running: dict[Future[R], int] = {}
+    used = 0.0
+    stopped = False
+    try:
+        while running or (pending and not stopped):
+            for i in list(pending):
+                if stopped or len(running) >= slots:
+                    break
+                if running and used + memory[i] > budget:
+                    continue  # a lighter item may still fit
+                pending.remove(i)
+                running[pool.submit(func, items[i])] = i
+                used += memory[i]
+            done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+            if poll is not None and not poll():
+                stopped = True
+            for future in done:
+                i = running.pop(future)
+                used -= memory[i]
+                yield items[i], future.result()
+    finally:
+        for future in running:
+            future.cancel()
+        wait(running)
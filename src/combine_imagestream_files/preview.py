@@ -0,0 +1,233 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from combine_imagestream_files.dataset import Channel, DataSet
+from combine_imagestream_files.imagestreamzip import ImageStreamZip, _placecell
+from combine_imagestream_files.sources import Source
+
+CACHEBYTES = 256 * 2**20  # decoded tiles kept by a preview
+TILESIZE = 96  # tiles are cropped or padded to this size in a montage
+
+
+class TileCache:
+    """
+    Decoded tiles, least recently used first, limited by their total size.
+    Safe to use from many threads.
+    """
+
+    def __init__(self, maxbytes: int = CACHEBYTES) -> None:
+        """
+        :param maxbytes: the least recently used tiles are dropped when the
+            tiles together are larger than this
+        """
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.tiles: OrderedDict[str, npt.NDArray[Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def get(self, name: str) -> npt.NDArray[Any] | None:
+        with self.lock:
+            tile = self.tiles.get(name)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tiles.move_to_end(name)
+            return tile
+
+    def put(self, name: str, tile: npt.NDArray[Any]) -> None:
+        with self.lock:
+            old = self.tiles.pop(name, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.tiles[name] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.maxbytes and len(self.tiles) > 1:
+                _, dropped = self.tiles.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+
+    def clear(self) -> None:
+        with self.lock:
+            self.tiles.clear()
+            self.nbytes = 0
+
+
+class Preview:
+    """
+    Decodes cells of a zipfile on demand, to check the channels of a dataset
+    without exporting it. Only the requested cells and channels are read, and
+    the decoded tiles are cached, so paging back and forth is fast. The page
+    after the last requested one is decoded in the background.
+    """
+
+    def __init__(
+        self, isz: ImageStreamZip, cachebytes: int = CACHEBYTES, workers: int = 4
+    ) -> None:
+        """
+        :param isz: the loaded zipfile
+        :param cachebytes: size of the tile cache
+        :param workers: number of threads decoding tiles
+        """
+        self.isz = isz
+        self.cache = TileCache(cachebytes)
+        self.pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+        # prefetches one page at a time on its own thread, so a requested page
+        # is never queued behind prefetched pages
+        self.background = ThreadPoolExecutor(max_workers=1)
+        self.prefetched: Future[Any] | None = None
+        self.reader: Source | None = None
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "Preview":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.background.shutdown(cancel_futures=True)
+        self.pool.shutdown(cancel_futures=True)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        self.cache.clear()
+
+    def open(self) -> None:
+        """
+        List the zipfile for reading now, e.g. on a background thread, instead
+        of when the first tile is decoded
+        :return:
+        """
+        self._getreader()
+
+    def _getreader(self) -> Source:
+        with self.lock:  # the zipfile is listed on first use only
+            if self.reader is None:
+                self.reader = self.isz.opensource()
+            return self.reader
+
+    def tile(
+        self, dataset: DataSet, stem: str, channel: Channel
+    ) -> npt.NDArray[Any] | None:
+        """
+        One decoded tile
+        :param dataset: the dataset
+        :param stem: stem of the cell
+        :param channel: the channel
+        :return: the tile, or None if the cell does not have the channel
+        """
+        name = self.isz._membername(dataset, stem, channel)
+        tile = self.cache.get(name)
+        if tile is None:
+            reader = self._getreader()
+            if name not in reader.infos:
+                return None
+            tile = self.isz._readcell(reader, dataset, stem, [channel])[0]
+            self.cache.put(name, tile)
+        return tile
+
+    def cells(
+        self,
+        dataset: DataSet,
+        start: int,
+        count: int,
+        channels: list[Channel] | None = None,
+    ) -> list[list[npt.NDArray[Any] | None]]:
+        """
+        Decoded tiles of a page of cells
+        :param dataset: the dataset
+        :param start: first cell
+        :param count: number of cells
+        :param channels: channels to read (default all channels of the dataset)
+        :return: for each cell, the tile of each channel, or None if it is missing
+        """
+        if channels is None:
+            channels = dataset.getchannels()
+        stems = dataset.stems[max(start, 0) : start + count]
+        tiles = list(
+            self.pool.map(
+                lambda job: self.tile(dataset, *job),
+                [(stem, channel) for stem in stems for channel in channels],
+            )
+        )
+        return [
+            tiles[i * len(channels) : (i + 1) * len(channels)]
+            for i in range(len(stems))
+        ]
+
+    def prefetch(
+        self,
+        dataset: DataSet,
+        start: int,
+        count: int,
+        channels: list[Channel] | None = None,
+    ) -> None:
+        """
+        Decode a page of cells in the background, instead of the page that was
+        prefetched before if that did not start yet. See cells.
+        """
+        if channels is None:
+            channels = dataset.getchannels()
+        if self.prefetched is not None:
+            self.prefetched.cancel()
+        jobs = [
+            (stem, channel)
+            for stem in dataset.stems[max(start, 0) : start + count]
+            for channel in channels
+        ]
+        self.prefetched = self.background.submit(
+            lambda: [self.tile(dataset, *job) for job in jobs]
+        )
+
+    def montage(
+        self,
+        dataset: DataSet,
+        start: int,
+        count: int,
+        channels: list[Channel] | None = None,
+        tilesize: int = TILESIZE,
+    ) -> npt.NDArray[np.uint8]:
+        """
+        Montage of a page of cells, with a row for each cell and a column for
+        each channel. Tiles are centered and cropped or padded to tilesize, and
+        each channel is scaled from its 0.5 to 99.5 percentile on the page. The
+        next page is decoded in the background.
+        :param dataset: the dataset
+        :param start: first cell
+        :param count: number of cells
+        :param channels: channels to show (default all channels of the dataset)
+        :param tilesize: size of each tile in the montage
+        :return: 8-bit image of count * tilesize by channels * tilesize pixels
+        """
+        if channels is None:
+            channels = dataset.getchannels()
+        cells = self.cells(dataset, start, count, channels)
+        self.prefetch(dataset, start + count, count, channels)
+        frames = np.zeros((count, len(channels), tilesize, tilesize), np.float32)
+        for j in range(len(channels)):
+            present = [tile for cell in cells if (tile := cell[j]) is not None]
+            if not present:
+                continue
+            values = np.concatenate([tile.ravel() for tile in present])
+            lo, hi = np.percentile(values, (0.5, 99.5))
+            scale = 255 / (hi - lo) if hi > lo else 0.0
+            for i, cell in enumerate(cells):
+                tile = cell[j]
+                if tile is not None:
+                    _placecell(frames[i, j : j + 1], [tile], [np.asarray(lo)])
+                    frames[i, j] = (frames[i, j] - lo) * scale
+        montage = np.clip(frames, 0, 255).astype(np.uint8)
+        # (cells, channels, y, x) to (cells * y, channels * x)
+        return montage.transpose(0, 2, 1, 3).reshape(
+            count * tilesize, len(channels) * tilesize
+        )
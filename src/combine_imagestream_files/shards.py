@@ -0,0 +1,104 @@
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+
+class ShardIndex:
+    """
+    Where the cells of a sharded dataset are: the shards are TCYX stacks of at
+    most a fixed number of cells, and the index maps the stem of each cell to
+    its shard and frame, so a part of the dataset can be loaded without
+    opening every shard. Stored next to the shards.
+    """
+
+    VERSION = 1
+
+    def __init__(self, pth: Path, datasetname: str, channels: list[str]) -> None:
+        """
+        :param pth: the index file
+        :param datasetname: name of the dataset
+        :param channels: names of the channels of each frame
+        """
+        self.pth = pth
+        self.datasetname = datasetname
+        self.channels = channels
+        self.shards: list[str] = []  # file name of each shard
+        self.cells: dict[str, tuple[int, int]] = {}  # shard and frame of each stem
+
+    @staticmethod
+    def indexpath(folder: Path | str, datasetname: str) -> Path:
+        return Path(folder, f"{datasetname}.shards.json")
+
+    @staticmethod
+    def shardname(stackname: str, shard: int) -> str:
+        """
+        :param stackname: name of the unsharded stack, e.g. the dataset name
+        :param shard: number of the shard in the stack
+        :return: name of the shard, without extension
+        """
+        return f"{stackname}_shard{shard:04d}"
+
+    @classmethod
+    def load(cls, pth: Path | str) -> "ShardIndex | None":
+        """
+        Load an index
+        :param pth: the index file
+        :return: the index, or None if it is missing or unreadable
+        """
+        pth = Path(pth)
+        try:
+            with open(pth, "r") as f:
+                data = json.load(f)
+            if data["version"] != cls.VERSION:
+                return None
+            index = cls(pth, data["dataset"], list(data["channels"]))
+            index.shards = list(data["shards"])
+            index.cells = {
+                stem: (int(shard), int(frame))
+                for stem, (shard, frame) in data["cells"].items()
+            }
+        except (OSError, KeyError, ValueError, TypeError, AttributeError):
+            return None
+        return index
+
+    def save(self) -> None:
+        """
+        Save the index, replacing the old one in one step
+        :return:
+        """
+        data: dict[str, Any] = {
+            "version": self.VERSION,
+            "dataset": self.datasetname,
+            "channels": self.channels,
+            "shards": self.shards,
+            "cells": self.cells,
+        }
+        tmp = self.pth.with_name(f"{self.pth.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.pth)
+
+    def addshard(self, name: str, stems: list[str]) -> None:
+        """
+        Add a shard
+        :param name: file name of the shard
+        :param stems: stem of the cell of each frame of the shard
+        :return:
+        """
+        shard = len(self.shards)
+        self.shards.append(name)
+        for frame, stem in enumerate(stems):
+            self.cells[stem] = (shard, frame)
+
+    def locate(self, stems: list[str]) -> dict[Path, list[int]]:
+        """
+        The shards and frames of some cells
+        :param stems: stems of the cells
+        :return: for each shard that has any of the cells, their frames
+        """
+        frames: dict[Path, list[int]] = {}
+        for stem in stems:
+            shard, frame = self.cells[stem]
+            frames.setdefault(self.pth.with_name(self.shards[shard]), []).append(frame)
+        return frames
@@ -0,0 +1,403 @@
+import hashlib
+import io
+import mmap
+import os
+import re
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Any, Iterator, Mapping, cast
+from zipfile import ZipInfo
+
+READERS = 8  # threads reading the files of a folder
+SCANBATCH = 2**16  # members listed at a time by Source.iterscan
+
+
+class MemoryFile(io.RawIOBase):
+    """
+    Read-only, seekable file over a buffer. Reading copies only the requested
+    bytes, the buffer itself is never copied.
+    """
+
+    def __init__(self, buffer: bytes | memoryview) -> None:
+        super().__init__()
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def read(self, size: int | None = -1) -> bytes:
+        end = len(self.buffer) if size is None or size < 0 else self.pos + size
+        data = bytes(self.buffer[self.pos : end])
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buffer: Any) -> int:
+        target = memoryview(buffer).cast("B")
+        data = self.buffer[self.pos : self.pos + len(target)]
+        target[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        self.buffer.release()
+        super().close()
+
+
+class MemberInfo:
+    """
+    Name and size of a member of a folder or tarfile, like a ZipInfo
+    """
+
+    def __init__(self, filename: str, file_size: int, CRC: int) -> None:
+        """
+        :param filename: name of the member, "<dataset>/<file>"
+        :param file_size: size in bytes
+        :param CRC: changes when the member changes. These sources have no
+            CRC-32, so it is the modification time in ns.
+        """
+        self.filename = filename
+        self.file_size = file_size
+        self.compress_size = file_size
+        self.CRC = CRC
+
+
+class Source:
+    """
+    Members of an ImageStream export by name, "<dataset>/<file>". ZipReader
+    reads a zipfile, DirectorySource a folder with a subfolder for each
+    dataset and TarSource a tarfile, so the export works the same for all.
+    Safe to use from many threads.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.infos: Mapping[str, ZipInfo | MemberInfo] = {}
+
+    def __enter__(self) -> "Source":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    @classmethod
+    def key(cls, path: Path) -> str:
+        """
+        Key that changes when the source changes, see ScanIndex
+        :param path: the source
+        :return: the key
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def modified(cls, path: Path) -> float:
+        """
+        When the source last changed, to compare with the output
+        :param path: the source
+        :return: the modification time in seconds
+        """
+        return path.stat().st_mtime
+
+    @classmethod
+    def scan(cls, path: Path) -> list[str]:
+        """
+        List the members quickly, for ImageStreamZip.loadfile
+        :param path: the source
+        :return: the name of each member
+        """
+        return [name for batch in cls.iterscan(path) for name in batch]
+
+    @classmethod
+    def iterscan(cls, path: Path, batchsize: int = SCANBATCH) -> Iterator[list[str]]:
+        """
+        List the members in batches, so a scan can report progress and stop
+        :param path: the source
+        :param batchsize: members in each batch
+        :return: the names of the members of each batch
+        """
+        raise NotImplementedError
+
+    def read(self, name: str) -> bytes | memoryview:
+        """
+        Read the uncompressed data of a member
+        :param name: name of the member
+        :return: the data
+        """
+        raise NotImplementedError
+
+    def readmany(self, names: list[str]) -> list[bytes | memoryview]:
+        """
+        Read the uncompressed data of many members, e.g. all channels of a cell
+        :param names: names of the members
+        :return: the data of each member
+        """
+        return [self.read(name) for name in names]
+
+    def open(self, name: str) -> IO[bytes]:
+        """
+        Open a member as a seekable file
+        :param name: name of the member
+        :return: the opened member
+        """
+        return cast(IO[bytes], MemoryFile(self.read(name)))
+
+    def close(self) -> None:
+        pass
+
+
+class DirectorySource(Source):
+    """
+    Reads the files of a folder with a subfolder for each dataset, as the
+    instrument writes them, without zipping them first. The files of a cell are
+    read in parallel, which helps most on network drives.
+    """
+
+    def __init__(self, path: Path, readers: int = READERS) -> None:
+        super().__init__(path)
+        self.infos = {
+            name: MemberInfo(name, stat.st_size, stat.st_mtime_ns)
+            for name, stat in _walk(path)
+        }
+        self.pool = ThreadPoolExecutor(max_workers=readers)
+
+    @classmethod
+    def key(cls, path: Path) -> str:
+        sha = hashlib.sha1()
+        for name, stat in _walk(path):
+            sha.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return f"folder-{sha.hexdigest()}"
+
+    @classmethod
+    def modified(cls, path: Path) -> float:
+        """
+        :return: the modification time of the newest file or of the folder
+        """
+        return max([path.stat().st_mtime, *(stat.st_mtime for _, stat in _walk(path))])
+
+    @classmethod
+    def iterscan(cls, path: Path, batchsize: int = SCANBATCH) -> Iterator[list[str]]:
+        return _batches((name for name, _ in _walk(path)), batchsize)
+
+    def read(self, name: str) -> bytes:
+        if name not in self.infos:
+            raise KeyError(f"There is no item named {name!r} in {self.path}")
+        with open(Path(self.path, name), "rb") as f:
+            return f.read()
+
+    def readmany(self, names: list[str]) -> list[bytes | memoryview]:
+        if len(names) < 2:
+            return super().readmany(names)
+        return list(self.pool.map(self.read, names))
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+
+class DirectoryFollower(DirectorySource):
+    """
+    Reads a folder that the instrument is still writing. follow adds the files
+    whose size and modification time did not change since the previous call,
+    so a file that is being written is only added when it is done. A folder
+    has no end, so it is never finished.
+    """
+
+    def __init__(self, path: Path, readers: int = READERS) -> None:
+        Source.__init__(self, path)
+        self.infos: dict[str, MemberInfo] = {}
+        self.pending: dict[str, tuple[int, int]] = {}  # size and mtime of new files
+        self.finished = False
+        self.pool = ThreadPoolExecutor(max_workers=readers)
+
+    def follow(self) -> list[str]:
+        """
+        Add the files that did not change since the last call
+        :return: names of the new members
+        """
+        names = []
+        for name, stat in _walk(self.path):
+            if name in self.infos:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self.pending.get(name) == state:
+                del self.pending[name]
+                self.infos[name] = MemberInfo(name, *state)
+                names.append(name)
+            else:
+                self.pending[name] = state
+        return names
+
+
+class TarSource(Source):
+    """
+    Reads the members of a tarfile. An uncompressed tarfile is read straight
+    from a memory map, like a stored zipfile. A compressed tarfile can only be
+    read from the start, so it is read with one handle at a time, which is slow
+    unless the cells are read in order.
+    """
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.tar = tarfile.open(path, "r")
+        self.members = dict(_tarmembers(self.tar))
+        self.infos = {
+            name: MemberInfo(name, member.size, int(member.mtime * 10**9))
+            for name, member in self.members.items()
+        }
+        self.lock = threading.Lock()
+        self.file = open(path, "rb")
+        self.map: mmap.mmap | None = None
+        if isinstance(self.tar.fileobj, io.BufferedReader):  # not compressed
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def key(cls, path: Path) -> str:
+        stat = path.stat()
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    @classmethod
+    def iterscan(cls, path: Path, batchsize: int = SCANBATCH) -> Iterator[list[str]]:
+        with tarfile.open(path, "r") as tar:
+            members = _tarmembers(tar)
+        yield from _batches((name for name, _ in members), batchsize)
+
+    def read(self, name: str) -> bytes | memoryview:
+        member = self.members[name]
+        if self.map is not None and not member.sparse:
+            return memoryview(self.map)[
+                member.offset_data : member.offset_data + member.size
+            ]
+        with self.lock:
+            fh = self.tar.extractfile(member)
+            assert fh is not None
+            with fh:
+                return fh.read()
+
+    def close(self) -> None:
+        self.tar.close()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:  # a view is still in use, the map closes with it
+                pass
+        self.file.close()
+
+
+def sourcetype(path: Path) -> type[Source]:
+    """
+    The source that reads path
+    :param path: a zipfile, a folder or a tarfile
+    :return: ZipReader, DirectorySource or TarSource
+    """
+    from combine_imagestream_files.zipreader import ZipReader
+
+    if path.is_dir():
+        return DirectorySource
+    if zipfile.is_zipfile(path):
+        return ZipReader
+    if tarfile.is_tarfile(path):
+        return TarSource
+    raise ValueError(f"{path} is not a zipfile, a folder or a tarfile")
+
+
+def _tarname(member: tarfile.TarInfo) -> str:
+    return member.name.removeprefix("./")  # tar -C folder .
+
+
+def _tarmembers(tar: tarfile.TarFile) -> list[tuple[str, tarfile.TarInfo]]:
+    """
+    The files in a tarfile in the order of _walk, so a tarfile gives the same
+    cells in the same order as the folder it was made of. A tarfile has no
+    index, so all members are listed before the first is returned.
+    :param tar: the tarfile
+    :return: the name and member of each file
+    """
+    members = [(_tarname(member), member) for member in tar if member.isfile()]
+    members.sort(key=lambda item: [_naturalkey(part) for part in item[0].split("/")])
+    return members
+
+
+def groupmembers(
+    names: list[str], suffix: str = ".ome.tif"
+) -> tuple[dict[str, tuple[list[str], list[int]]], list[str]]:
+    """
+    Group the members of a source by dataset and cell. Only the members in a
+    subfolder of the root, with the suffix, are cells.
+    :param names: name of each member
+    :param suffix: suffix of the members that are cells
+    :return: the stems and channels of each dataset, and the names of the
+        members that are cells
+    """
+    cells: dict[str, tuple[list[str], list[int]]] = {}
+    cellnames = []
+    for file in names:
+        if file[-1] == r"/":  # it is a folder
+            continue
+        folder, _, name = file.partition(r"/")
+        if not name or r"/" in name:  # File is not in a subfolder of the root.
+            continue
+        if name.endswith(suffix):
+            stem, _, ch = name[0 : len(name) - len(suffix)].rpartition("_")
+            stems, channels = cells.setdefault(folder, ([], []))
+            stems.append(stem)
+            channels.append(int(ch[2::]))  # Ch1 Ch11
+            cellnames.append(file)
+    return cells, cellnames
+
+
+def _batches(names: Iterator[str], batchsize: int) -> Iterator[list[str]]:
+    """
+    :param names: name of each member
+    :param batchsize: members in each batch
+    :return: the names of each batch
+    """
+    batch: list[str] = []
+    for name in names:
+        batch.append(name)
+        if len(batch) == batchsize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _walk(path: Path) -> Iterator[tuple[str, os.stat_result]]:
+    """
+    The files in the subfolders of a folder, in natural order, so cell 2 comes
+    before cell 10
+    :param path: the folder
+    :return: the name ("<subfolder>/<file>") and stat of each file
+    """
+    with os.scandir(path) as entries:
+        folders = sorted(
+            (entry for entry in entries if entry.is_dir()),
+            key=lambda entry: _naturalkey(entry.name),
+        )
+    for folder in folders:
+        with os.scandir(folder.path) as entries:
+            files = sorted(
+                (entry for entry in entries if entry.is_file()),
+                key=lambda entry: _naturalkey(entry.name),
+            )
+        for entry in files:
+            yield f"{folder.name}/{entry.name}", entry.stat()
+
+
+def _naturalkey(name: str) -> list[Any]:
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
@@ -1,7 +1,12 @@
 import argparse
+import json
 from pathlib import Path
 import logging
-from .imagestreamzip import ImageStreamZip
+from typing import Any
+from .channelmap import ChannelMap
+from .options import addexportoptions, writeoptions
+from .sources import groupmembers, sourcetype
+from .stats import ExportStats
 
 
 def get_args() -> argparse.Namespace:
@@ -15,14 +20,56 @@ def get_args() -> argparse.Namespace:
     myparser.add_argument(
         "-i",
         type=str,
-        help="The input zipfile.",
+        help="The input zipfile, or a folder or tarfile with a subfolder for each "
+        "dataset.",
         default="",
     )
     myparser.add_argument(
-        "-p",
+        "-j",
+        type=int,
+        help="Number of worker threads",
+        default=1,
+    )
+    addexportoptions(myparser)
+    myparser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent in each stage, counters and peak memory as JSON",
+    )
+    myparser.add_argument(
+        "--trace",
+        type=str,
+        help="Save the timed stages to this file in the Chrome trace format",
+        default="",
+    )
+    myparser.add_argument(
+        "--list",
+        "--dry-run",
+        action="store_true",
+        help="Only list the datasets with their cells and channels as JSON, from "
+        "the listing of the zipfile without reading any cell",
+    )
+    myparser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Combine the cells while the zipfile or folder is still being "
+        "written, as soon as all named channels of a cell arrived. Writes "
+        "uncompressed imagej stacks, padded with a running median estimate.",
+    )
+    myparser.add_argument(
+        "--idle",
         type=float,
-        help="Pixelsize",
-        default=1.0,
+        help="With --follow, stop when the zipfile or folder did not grow for this "
+        "many seconds. A zipfile also stops when it is complete.",
+        default=60.0,
+    )
+    myparser.add_argument(
+        "--canvas",
+        type=int,
+        nargs=2,
+        help="With --follow, height and width of the frames (default the largest "
+        "of the first cells)",
+        default=None,
     )
     myparser.add_argument(
         "-l",
@@ -33,6 +80,27 @@ def get_args() -> argparse.Namespace:
     return myparser.parse_args()
 
 
+def listdatasets(pth: Path, suffix: str = ".ome.tif") -> dict[str, Any]:
+    """
+    The datasets in a zipfile, folder or tarfile, from its listing only
+    :param pth: the zipfile, folder or tarfile
+    :param suffix: suffix of the members that are cells
+    :return: for each dataset the number of cells, and for each channel the
+        number of cells that have it
+    """
+    cells, _ = groupmembers(sourcetype(pth).scan(pth), suffix)
+    datasets = {}
+    for folder, (stems, channels) in cells.items():
+        counts: dict[int, int] = {}
+        for ch in channels:
+            counts[ch] = counts.get(ch, 0) + 1
+        datasets[folder] = {
+            "cells": len(set(stems)),
+            "channels": {str(ch): counts[ch] for ch in sorted(counts)},
+        }
+    return datasets
+
+
 def main() -> None:
     args = get_args()
     loglevels = [logging.ERROR, logging.WARNING, logging.INFO]
@@ -41,12 +109,53 @@ def main() -> None:
     logging.info("Arguments parsed")
     logging.info(f"Loglevel: {logging.getLevelName(loglevel)}")
     zipin = Path(args.i)
-    if not zipin.exists() or not zipin.is_file():
+    if not zipin.exists():
         print(f"Cannot find zipfile: {args.i}")
+    elif args.c and not Path(args.c).is_file():
+        print(f"Cannot find channel map: {args.c}")
+    elif args.follow and args.measure:
+        print("Measurements cannot be written while following a zipfile")
+    elif args.list:
+        print(json.dumps(listdatasets(zipin), indent=2))
     else:
-        isz = ImageStreamZip()
-        isz.loadfile(zipin)
-        isz.writetiffs(zipin.parent, args.p)
+        stats = ExportStats(
+            enabled=args.profile or bool(args.trace), trace=bool(args.trace)
+        )
+        channelmap = ChannelMap.load(args.c) if args.c else None
+        if args.follow:
+            # numpy and tifffile are only imported when something is written
+            from .live import LiveExport
+
+            LiveExport(
+                zipin,
+                zipin.parent,
+                args.p,
+                channelmap,
+                workers=args.j,
+                median=args.m,
+                canvas=None if args.canvas is None else tuple(args.canvas),
+                shardsize=args.shards,
+                idle=args.idle,
+                stats=stats,
+            ).run()
+        else:
+            from .imagestreamzip import ImageStreamZip
+
+            isz = ImageStreamZip()
+            with stats.stage("scan"):
+                isz.loadfile(zipin)
+            channelmap = ChannelMap.find(zipin, list(isz.datasets), channelmap)
+            for datasetname in channelmap.apply(isz.datasets):
+                logging.warning(f"No channel map for {datasetname}")
+            for dataset in isz.datasets.values():
+                dataset.setlayout(args.layout, args.percentile)
+            isz.writetiffs(
+                zipin.parent, args.p, workers=args.j, stats=stats, **writeoptions(args)
+            )
+        if args.profile:
+            print(json.dumps(stats.report(), indent=2))
+        if args.trace:
+            stats.savetrace(args.trace)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Iterator
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+STAGES = ("scan", "inflate", "decode", "median", "place", "write")
+
+
+def peakrss() -> float:
+    """
+    Peak resident memory of this process
+    :return: peak RSS in MB, or nan where it is not available
+    """
+    if resource is None:
+        return float("nan")
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def physicalmemory() -> int | None:
+    """
+    Physical memory of this machine
+    :return: size in bytes, or None where it is not available
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # Windows
+        return None
+
+
+class ExportStats:
+    """
+    Time spent in each stage of an export, counters such as the bytes inflated
+    and tiles decoded, and a summary of each dataset. Stages run on many
+    threads at once, so their times add up to more than the elapsed time.
+    Safe to use from many threads.
+    """
+
+    def __init__(self, enabled: bool = True, trace: bool = False) -> None:
+        """
+        :param enabled: collect anything at all
+        :param trace: also keep every timed stage, for savetrace
+        """
+        self.enabled = enabled
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.started = time.time()  # to align the traces of other processes
+        self.stages: dict[str, float] = {}  # seconds in each stage
+        self.counters: dict[str, int] = {}
+        self.datasets: dict[str, dict[str, Any]] = {}
+        self.events: list[dict[str, Any]] = []  # Chrome trace events
+        self.lock = threading.Lock()
+
+    def stage(self, name: str, dataset: str = "") -> ContextManager[None]:
+        """
+        Time a stage
+        :param name: name of the stage, e.g. one of STAGES
+        :param dataset: dataset the stage works on, for the trace
+        :return: context manager that times its block
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, dataset)
+
+    @contextmanager
+    def _stage(self, name: str, dataset: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + end - start
+                if self.trace:
+                    self.events.append(
+                        {
+                            "name": name,
+                            "cat": dataset,
+                            "ph": "X",
+                            "ts": (start - self.start) * 1e6,
+                            "dur": (end - start) * 1e6,
+                            "pid": os.getpid(),
+                            "tid": threading.get_ident(),
+                        }
+                    )
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def merge(self, other: "ExportStats") -> None:
+        """
+        Add the stages, counters, datasets and trace of another export, e.g.
+        one that ran in another process
+        :param other: stats of the other export
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, t in other.stages.items():
+                self.stages[name] = self.stages.get(name, 0.0) + t
+            for name, n in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.datasets.update(other.datasets)
+            if self.trace:
+                # perf_counter is not comparable between processes
+                shift = (other.started - self.started) * 1e6
+                self.events.extend(
+                    {**event, "ts": event["ts"] + shift} for event in other.events
+                )
+
+    def count(self, name: str, n: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def adddataset(self, name: str, cells: int, seconds: float) -> None:
+        """
+        Add the summary of a dataset that was written
+        :param name: name of the dataset
+        :param cells: number of cells
+        :param seconds: time it took
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.datasets[name] = {
+                "cells": cells,
+                "seconds": round(seconds, 3),
+                "cells_per_s": round(cells / seconds, 1) if seconds > 0 else 0.0,
+                "peak_rss_mb": round(peakrss(), 1),
+            }
+
+    def report(self) -> dict[str, Any]:
+        """
+        :return: the stats as a JSON-serializable dictionary
+        """
+        seconds = time.perf_counter() - self.start
+        with self.lock:
+            cells = sum(dataset["cells"] for dataset in self.datasets.values())
+            return {
+                "seconds": round(seconds, 3),
+                "cells": cells,
+                "cells_per_s": round(cells / seconds, 1) if seconds > 0 else 0.0,
+                "peak_rss_mb": round(peakrss(), 1),
+                "stages": {name: round(t, 3) for name, t in self.stages.items()},
+                "counters": dict(self.counters),
+                "datasets": dict(self.datasets),
+            }
+
+    def savetrace(self, pth: Path | str) -> None:
+        """
+        Save the timed stages in the Chrome trace format, for chrome://tracing
+        or https://ui.perfetto.dev
+        :param pth: the JSON file
+        :return:
+        """
+        with self.lock:
+            events = list(self.events)
+        trace = {"traceEvents": events, "otherData": self.report()}
+        with open(pth, "w") as f:
+            json.dump(trace, f)
+
+
+NOSTATS = ExportStats(enabled=False)
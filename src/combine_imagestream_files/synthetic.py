@@ -0,0 +1,141 @@
+import argparse
+import io
+from pathlib import Path
+from typing import Any, Callable
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import numpy as np
+import numpy.typing as npt
+from tifffile import imwrite
+
+TileSize = tuple[int, int] | Callable[[np.random.Generator], tuple[int, int]]
+
+
+def maketile(
+    rng: np.random.Generator,
+    shape: tuple[int, int],
+    dtype: npt.DTypeLike = np.uint16,
+    channel: int = 0,
+) -> npt.NDArray[Any]:
+    """
+    Tile that looks like an ImageStream cell: a noisy background with a
+    brighter blob in the middle.
+    :param rng: random generator
+    :param shape: height and width of the tile
+    :param dtype: datatype of the tile
+    :param channel: channel number, higher channels have a brighter background
+    :return: the tile
+    """
+    h, w = shape
+    y, x = np.ogrid[:h, :w]
+    blob = ((y - h / 2) ** 2 + (x - w / 2) ** 2) < (min(h, w) / 3) ** 2
+    background = rng.normal(200 + 50 * channel, 15, (h, w))
+    tile = background + blob * rng.uniform(0, 3000)
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        tile *= info.max / 65535
+        return np.clip(tile, info.min, info.max).astype(dtype)
+    return (tile / 65535).astype(dtype)
+
+
+def makezip(
+    zipfile: Path | str,
+    datasets: int = 2,
+    cells: int = 100,
+    channels: int = 6,
+    tilesize: TileSize = (30, 120),
+    dtype: npt.DTypeLike = np.uint16,
+    compression: int = ZIP_DEFLATED,
+    missing: float = 0.0,
+    seed: int = 0,
+) -> Path:
+    """
+    Write a zipfile in the layout of an ImageStream export: a folder for each
+    dataset with a <cell>_Ch<channel>.ome.tif file for each channel of each cell.
+    :param zipfile: the zipfile, replaced if it exists
+    :param datasets: number of datasets
+    :param cells: number of cells in each dataset
+    :param channels: number of channels, numbered from 1
+    :param tilesize: (min, max) of the uniformly distributed height and width
+        of a cell, or a function that draws the shape of a cell from a generator
+    :param dtype: datatype of the tiles
+    :param compression: ZIP_STORED or ZIP_DEFLATED
+    :param missing: chance that a channel of a cell is missing
+    :param seed: seed of the random generator
+    :return: the zipfile
+    """
+    rng = np.random.default_rng(seed)
+    drawshape = tilesize if callable(tilesize) else _uniform(*tilesize)
+    zipfile = Path(zipfile)
+    with ZipFile(zipfile, "w", compression) as archive:
+        for d in range(datasets):
+            for cell in range(cells):
+                shape = drawshape(rng)
+                for ch in range(1, channels + 1):
+                    if rng.random() < missing:
+                        continue
+                    buffer = io.BytesIO()
+                    imwrite(buffer, maketile(rng, shape, dtype, ch), ome=True)
+                    archive.writestr(f"DS{d}/{cell}_Ch{ch}.ome.tif", buffer.getvalue())
+    return zipfile
+
+
+def _uniform(low: int, high: int) -> Callable[[np.random.Generator], tuple[int, int]]:
+    def drawshape(rng: np.random.Generator) -> tuple[int, int]:
+        h, w = rng.integers(low, high, 2, endpoint=True)
+        return int(h), int(w)
+
+    return drawshape
+
+
+def get_args() -> argparse.Namespace:
+    """
+    Get the arguments from the commandline
+    :return:
+    """
+    myparser = argparse.ArgumentParser(
+        description="Write a synthetic ImageStream zipfile",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    myparser.add_argument("zipfile", type=str, help="The zipfile to write")
+    myparser.add_argument("-d", type=int, help="Number of datasets", default=2)
+    myparser.add_argument("-c", type=int, help="Cells per dataset", default=100)
+    myparser.add_argument("-n", type=int, help="Number of channels", default=6)
+    myparser.add_argument(
+        "-t", type=int, nargs=2, help="Minimum and maximum tile size", default=[30, 120]
+    )
+    myparser.add_argument(
+        "--dtype",
+        type=str,
+        choices=["uint8", "uint16", "float32"],
+        help="Datatype of the tiles",
+        default="uint16",
+    )
+    myparser.add_argument(
+        "--stored", action="store_true", help="Store the members uncompressed"
+    )
+    myparser.add_argument(
+        "--missing", type=float, help="Chance that a channel is missing", default=0.0
+    )
+    myparser.add_argument("--seed", type=int, help="Random seed", default=0)
+    return myparser.parse_args()
+
+
+def main() -> None:
+    args = get_args()
+    makezip(
+        args.zipfile,
+        datasets=args.d,
+        cells=args.c,
+        channels=args.n,
+        tilesize=(args.t[0], args.t[1]),
+        dtype=args.dtype,
+        compression=ZIP_STORED if args.stored else ZIP_DEFLATED,
+        missing=args.missing,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
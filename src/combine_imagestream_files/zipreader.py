@@ -0,0 +1,613 @@
+import hashlib
+import io
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator, Mapping
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo
+
+from combine_imagestream_files.sources import SCANBATCH, MemberInfo, Source
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+LOCALHEADER = b"PK\x03\x04"
+DATADESCRIPTOR = b"PK\x07\x08"  # optional signature of a data descriptor
+EOCD = b"PK\x05\x06"  # end of central directory record
+EOCD64LOCATOR = b"PK\x06\x07"  # zip64 end of central directory locator
+CDHEADER = b"PK\x01\x02"  # central directory file header
+# signature, flags, method, CRC, sizes, name/extra/comment lengths and offset of
+# the local header
+CDENTRY = struct.Struct("<4s4xHH4xIIIHHH8xI")
+# the fixed part of a central directory entry, to parse all entries at once
+CDTABLE = [
+    ("signature", "<u4"),
+    ("version", "<u4"),
+    ("flags", "<u2"),
+    ("method", "<u2"),
+    ("datetime", "<u4"),
+    ("crc", "<u4"),
+    ("csize", "<u4"),
+    ("usize", "<u4"),
+    ("nlen", "<u2"),
+    ("elen", "<u2"),
+    ("clen", "<u2"),
+    ("disk", "<u2"),
+    ("attributes", "<u2"),
+    ("externalattributes", "<u4"),
+    ("offset", "<u4"),
+]
+# signature, flags, method, CRC, sizes and name/extra lengths of a local header
+LOCALENTRY = struct.Struct("<4s2xHH4xIIIHH")
+FOLLOWCHUNK = 2**20  # bytes inflated at a time to find the end of a member
+
+
+def centraldirectory(zipfile: Path) -> bytes:
+    """
+    Read the raw central directory of a zipfile, without parsing its entries
+    :param zipfile: the zipfile
+    :return: the central directory
+    """
+    with open(zipfile, "rb") as f:
+        size = f.seek(0, 2)
+        f.seek(max(size - 22 - 2**16, 0))  # EOCD with the longest comment
+        tail = f.read()
+        pos = tail.rfind(EOCD)
+        if pos < 0:
+            raise BadZipFile(f"{zipfile} is not a zipfile")
+        cdsize, cdoffset = struct.unpack("<II", tail[pos + 12 : pos + 20])
+        if (cdsize == 0xFFFFFFFF or cdoffset == 0xFFFFFFFF) and tail[
+            pos - 20 : pos - 16
+        ] == EOCD64LOCATOR:
+            (eocd64,) = struct.unpack("<Q", tail[pos - 12 : pos - 4])
+            f.seek(eocd64 + 40)
+            cdsize, cdoffset = struct.unpack("<QQ", f.read(16))
+        f.seek(cdoffset)
+        return f.read(cdsize)
+
+
+def centralrecords(
+    cd: bytes,
+) -> Iterator[tuple[str, int, int, int, int, int, int]]:
+    """
+    Parse the entries of a central directory, without a ZipInfo for each
+    :param cd: the central directory
+    :return: the name, flags, compression method, CRC-32, compressed and
+        uncompressed size and local header offset of each member
+    """
+    pos = 0
+    while pos + CDENTRY.size <= len(cd):
+        (
+            signature,
+            flags,
+            method,
+            crc,
+            csize,
+            usize,
+            nlen,
+            elen,
+            clen,
+            offset,
+        ) = CDENTRY.unpack_from(cd, pos)
+        if signature != CDHEADER:
+            raise BadZipFile("Bad central directory")
+        pos += CDENTRY.size
+        name = cd[pos : pos + nlen].decode("utf-8" if flags & 0x800 else "cp437")
+        if 0xFFFFFFFF in (csize, usize, offset):  # in the zip64 extra field
+            usize, csize, offset = _zip64fields(
+                cd[pos + nlen : pos + nlen + elen], usize, csize, offset
+            )
+        yield name, flags, method, crc, csize, usize, offset
+        pos += nlen + elen + clen
+
+
+def centralentries(cd: bytes, batchsize: int = SCANBATCH) -> Iterator[list[str]]:
+    """
+    Names of the members in a central directory. Much faster than ZipFile,
+    which makes a ZipInfo of every member.
+    :param cd: the central directory
+    :param batchsize: members in each batch
+    :return: the names of the members of each batch
+    """
+    names: list[str] = []
+    for record in centralrecords(cd):
+        names.append(record[0])
+        if len(names) == batchsize:
+            yield names
+            names = []
+    if names:
+        yield names
+
+
+def centralinfos(cd: bytes) -> Mapping[str, "CentralInfo"]:
+    """
+    The members in a central directory, for ZipReader. The entries are parsed
+    at once with numpy, which is many times faster than ZipFile.infolist.
+    Falls back to centralrecords if the entries do not follow each other.
+    :param cd: the central directory
+    :return: the info of each member by name
+    """
+    # numpy is imported here, as --list only needs centralentries
+    import numpy as np
+
+    table = np.dtype(CDTABLE)
+    buf = np.frombuffer(cd, dtype=np.uint8)
+    found = np.flatnonzero(
+        (buf[:-3] == CDHEADER[0])
+        & (buf[1:-2] == CDHEADER[1])
+        & (buf[2:-1] == CDHEADER[2])
+        & (buf[3:] == CDHEADER[3])
+    )
+    # a name or comment can contain the signature
+    found = found[found + table.itemsize <= len(buf)]
+    entries = buf[found[:, None] + np.arange(table.itemsize)].view(table)[:, 0]
+    nlen = entries["nlen"].astype(np.int64)
+    ends = found + table.itemsize + nlen + entries["elen"] + entries["clen"]
+    if not (
+        len(found) > 0
+        and found[0] == 0
+        and np.array_equal(ends[:-1], found[1:])
+        and ends[-1] == len(cd)
+    ):
+        return {record[0]: CentralInfo(*record) for record in centralrecords(cd)}
+    return CentralDirectory(cd, found + table.itemsize, nlen, entries)
+
+
+def _zip64sizes(extra: bytes) -> tuple[int, int] | None:
+    """
+    :param extra: extra field of a local file header
+    :return: the uncompressed and compressed size in the zip64 extra field
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from("<HH", extra, pos)
+        if tag == 0x0001 and size >= 16:
+            usize, csize = struct.unpack_from("<QQ", extra, pos + 4)
+            return int(usize), int(csize)
+        pos += 4 + size
+    return None
+
+
+def _zip64fields(
+    extra: bytes, usize: int, csize: int, offset: int
+) -> tuple[int, int, int]:
+    """
+    :param extra: extra field of a central directory entry
+    :param usize: uncompressed size in the entry
+    :param csize: compressed size in the entry
+    :param offset: local header offset in the entry
+    :return: the uncompressed size, compressed size and offset, with the ones
+        that overflowed taken from the zip64 extra field
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from("<HH", extra, pos)
+        if tag == 0x0001:
+            # only the fields that overflowed are there, in this order
+            fields = [usize, csize, offset]
+            at = pos + 4
+            for i, value in enumerate(fields):
+                if value == 0xFFFFFFFF:
+                    (fields[i],) = struct.unpack_from("<Q", extra, at)
+                    at += 8
+            return fields[0], fields[1], fields[2]
+        pos += 4 + size
+    raise BadZipFile("Missing zip64 extra field")
+
+
+class ZipHandles:
+    """
+    One ZipFile handle for each thread, so members can be read concurrently.
+    """
+
+    def __init__(self, zipfile: Path) -> None:
+        self.zipfile = zipfile
+        self.local = threading.local()
+        self.handles: list[ZipFile] = []
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "ZipHandles":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def get(self) -> ZipFile:
+        archive: ZipFile | None = getattr(self.local, "archive", None)
+        if archive is None:
+            archive = ZipFile(self.zipfile, "r")
+            self.local.archive = archive
+            with self.lock:
+                self.handles.append(archive)
+        return archive
+
+    def close(self) -> None:
+        with self.lock:
+            for archive in self.handles:
+                archive.close()
+            self.handles = []
+
+
+class CentralInfo(MemberInfo):
+    """
+    A member of a zipfile, from its central directory entry. Has the fields of a
+    ZipInfo that ZipReader uses, and is much faster to make.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        flag_bits: int,
+        compress_type: int,
+        CRC: int,
+        compress_size: int,
+        file_size: int,
+        header_offset: int,
+    ) -> None:
+        super().__init__(filename, file_size, CRC)
+        self.flag_bits = flag_bits
+        self.compress_type = compress_type
+        self.compress_size = compress_size
+        self.header_offset = header_offset
+
+
+class CentralDirectory(Mapping[str, CentralInfo]):
+    """
+    The members of a zipfile by name, from a table of its central directory. A
+    CentralInfo is only made when a member is looked up.
+    """
+
+    def __init__(
+        self,
+        cd: bytes,
+        starts: "npt.NDArray[np.int64]",
+        lengths: "npt.NDArray[np.int64]",
+        entries: "npt.NDArray[Any]",
+    ) -> None:
+        """
+        :param cd: the central directory
+        :param starts: start of the name of each entry
+        :param lengths: length of the name of each entry
+        :param entries: fixed part of each entry, see CDTABLE
+        """
+        import numpy as np
+
+        self.entries = entries
+        ends = starts + lengths
+        # most names are ASCII, which decode the same from any encoding
+        text = cd.decode("latin-1")
+        names = [text[a:b] for a, b in zip(starts.tolist(), ends.tolist())]
+        buf = np.frombuffer(cd, dtype=np.uint8)
+        high = np.flatnonzero(buf >= 0x80)
+        rows = np.searchsorted(starts, high, side="right") - 1
+        for row in np.unique(rows[(rows >= 0) & (high < ends[rows])]).tolist():
+            utf8 = int(entries["flags"][row]) & 0x800
+            names[row] = cd[starts[row] : ends[row]].decode(
+                "utf-8" if utf8 else "cp437"
+            )
+        self.rows = {name: row for row, name in enumerate(names)}
+        self.zip64: dict[int, tuple[int, int, int]] = {}  # sizes and offset
+        overflow = np.flatnonzero(
+            (entries["csize"] == 0xFFFFFFFF)
+            | (entries["usize"] == 0xFFFFFFFF)
+            | (entries["offset"] == 0xFFFFFFFF)
+        )
+        for row in overflow.tolist():
+            start = int(ends[row])
+            entry = entries[row]
+            self.zip64[row] = _zip64fields(
+                cd[start : start + int(entry["elen"])],
+                int(entry["usize"]),
+                int(entry["csize"]),
+                int(entry["offset"]),
+            )
+
+    def __getitem__(self, name: str) -> CentralInfo:
+        row = self.rows[name]
+        entry = self.entries[row]
+        usize, csize, offset = self.zip64.get(
+            row, (int(entry["usize"]), int(entry["csize"]), int(entry["offset"]))
+        )
+        return CentralInfo(
+            name,
+            int(entry["flags"]),
+            int(entry["method"]),
+            int(entry["crc"]),
+            csize,
+            usize,
+            offset,
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.rows
+
+
+class ZipReader(Source):
+    """
+    Reads members straight from a memory map of the zipfile. Stored members
+    are returned as a view on the map, deflated members are inflated in one
+    call. Other members are read with ZipFile. Safe to use from many threads.
+    """
+
+    def __init__(self, zipfile: Path) -> None:
+        super().__init__(zipfile)
+        self.zipfile = zipfile
+        self.infos: Mapping[str, CentralInfo] = centralinfos(centraldirectory(zipfile))
+        self.starts: dict[str, int] = {}  # start of the data of each member
+        self.handles = ZipHandles(zipfile)
+        self.file = open(zipfile, "rb")
+        self.map: mmap.mmap | None = None
+        if self.file.seek(0, io.SEEK_END) > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def key(cls, path: Path) -> str:
+        """
+        :return: size, modification time and hash of the central directory
+        """
+        stat = path.stat()
+        cdhash = hashlib.sha1(centraldirectory(path)).hexdigest()
+        return f"{stat.st_size}-{stat.st_mtime_ns}-{cdhash}"
+
+    @classmethod
+    def iterscan(cls, path: Path, batchsize: int = SCANBATCH) -> Iterator[list[str]]:
+        """
+        List the members from the central directory, without a ZipInfo for
+        every member
+        """
+        return centralentries(centraldirectory(path), batchsize)
+
+    def _start(self, info: CentralInfo) -> int:
+        start = self.starts.get(info.filename)
+        if start is None:
+            assert self.map is not None
+            offset = info.header_offset
+            if self.map[offset : offset + 4] != LOCALHEADER:
+                raise BadZipFile(f"Bad local file header for {info.filename}")
+            namelength, extralength = struct.unpack(
+                "<HH", self.map[offset + 26 : offset + 30]
+            )
+            start = offset + 30 + namelength + extralength
+            self.starts[info.filename] = start
+        return start
+
+    def read(self, name: str) -> bytes | memoryview:
+        """
+        Read the uncompressed data of a member
+        :param name: name of the member
+        :return: the data, a view on the zipfile for stored members
+        """
+        info = self.infos[name]
+        if (
+            self.map is None
+            or info.flag_bits & 0x1  # encrypted
+            or info.compress_type not in (ZIP_STORED, ZIP_DEFLATED)
+        ):
+            return self.handles.get().read(name)
+        start = self._start(info)
+        data = memoryview(self.map)[start : start + info.compress_size]
+        if info.compress_type == ZIP_STORED:
+            return data
+        with data:
+            return zlib.decompress(data, -zlib.MAX_WBITS, info.file_size)
+
+    def close(self) -> None:
+        self.handles.close()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:  # a view is still in use, the map closes with it
+                pass
+        self.file.close()
+
+
+class ZipFollower(Source):
+    """
+    Reads a zipfile that is still being written. The central directory is only
+    written at the end, so the members are found from their local file headers,
+    in the order they are written. follow adds the members that were completed
+    since the last call. A member whose end cannot be found from its local
+    header waits for the central directory. Safe to use from many threads.
+    """
+
+    def __init__(self, zipfile: Path) -> None:
+        super().__init__(zipfile)
+        self.infos: dict[str, ZipInfo | CentralInfo] = {}
+        self.starts: dict[str, int] = {}  # start of the data of each member
+        self.offset = 0  # of the next local file header
+        self.finished = False  # the central directory was reached
+        self.waiting = False  # for the central directory, see _central
+        self.file = open(zipfile, "rb")
+        self.lock = threading.Lock()
+
+    def _pread(self, offset: int, size: int) -> bytes:
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def follow(self) -> list[str]:
+        """
+        Add the members that were written completely since the last call
+        :return: names of the new members
+        """
+        names = []
+        size = os.fstat(self.file.fileno()).st_size
+        while not self.finished and not self.waiting:
+            entry = self._entry(size)
+            if entry is None:
+                break
+            info, start = entry
+            self.infos[info.filename] = info
+            self.starts[info.filename] = start
+            names.append(info.filename)
+        if self.waiting:
+            names.extend(self._central())
+        return names
+
+    def _central(self) -> list[str]:
+        """
+        Add the members after offset from the central directory, once the
+        zipfile is complete
+        :return: names of the new members
+        """
+        try:
+            infos = centralinfos(centraldirectory(self.path))
+        except (BadZipFile, struct.error):  # not written yet
+            return []
+        names = []
+        for info in sorted(
+            (info for info in infos.values() if info.header_offset >= self.offset),
+            key=lambda info: info.header_offset,
+        ):
+            header = self._pread(info.header_offset, LOCALENTRY.size)
+            *_, nlen, elen = LOCALENTRY.unpack(header)
+            self.infos[info.filename] = info
+            self.starts[info.filename] = (
+                info.header_offset + LOCALENTRY.size + nlen + elen
+            )
+            names.append(info.filename)
+        self.finished = True
+        return names
+
+    def _entry(self, size: int) -> tuple[ZipInfo, int] | None:
+        """
+        Parse the member at offset, and move offset to the next one
+        :param size: size of the zipfile
+        :return: the member and the start of its data, or None if the member is
+            not written completely yet
+        """
+        header = self._pread(self.offset, LOCALENTRY.size)
+        if header[:4] in (CDHEADER, EOCD):
+            self.finished = True
+            return None
+        if len(header) < LOCALENTRY.size:
+            return None
+        signature, flags, method, crc, csize, usize, nlen, elen = LOCALENTRY.unpack(
+            header
+        )
+        if signature != LOCALHEADER:
+            raise BadZipFile(f"Bad local file header at {self.offset}")
+        start = self.offset + LOCALENTRY.size + nlen + elen
+        if start > size:
+            return None
+        field = self._pread(self.offset + LOCALENTRY.size, nlen + elen)
+        name = field[:nlen].decode("utf-8" if flags & 0x800 else "cp437")
+        sizes = _zip64sizes(field[nlen:])
+        if sizes is not None and (csize == 0xFFFFFFFF or usize == 0xFFFFFFFF):
+            usize, csize = sizes
+        end = start + csize
+        if flags & 0x8:  # the sizes follow the data, in a data descriptor
+            if method == ZIP_DEFLATED:
+                length = self._deflatedlength(start)
+            elif method == ZIP_STORED:
+                length = self._storedlength(start, sizes is not None)
+            else:
+                self.waiting = True
+                return None
+            if length is None:
+                return None
+            end = start + length
+            descriptor = self._pread(end, 24)
+            skip = 4 if descriptor[:4] == DATADESCRIPTOR else 0
+            layout = "<IQQ" if sizes is not None else "<III"
+            if len(descriptor) < skip + struct.calcsize(layout):
+                return None
+            crc, csize, usize = struct.unpack_from(layout, descriptor, skip)
+            end += skip + struct.calcsize(layout)
+        # the sizes in the header can be patched after the data is written, so
+        # a member is only complete when the next header follows it
+        if end + 4 > size or self._pread(end, 4) not in (LOCALHEADER, CDHEADER, EOCD):
+            return None
+        info = ZipInfo(name)
+        info.flag_bits = flags
+        info.compress_type = method
+        info.CRC = crc
+        info.compress_size = csize
+        info.file_size = usize
+        info.header_offset = self.offset
+        self.offset = end
+        return info, start
+
+    def _deflatedlength(self, start: int) -> int | None:
+        """
+        Length of deflated data whose size is not in the local header
+        :param start: start of the data
+        :return: the length, or None if the data is not written completely yet
+        """
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        pos = start
+        while not inflater.eof:
+            chunk = self._pread(pos, FOLLOWCHUNK)
+            if not chunk:
+                return None
+            inflater.decompress(chunk)
+            pos += len(chunk)
+        return pos - start - len(inflater.unused_data)
+
+    def _storedlength(self, start: int, zip64: bool) -> int | None:
+        """
+        Length of stored data whose size is not in the local header. The data
+        ends at a data descriptor, with or without its signature, whose sizes
+        and CRC-32 match the data before it.
+        :param start: start of the data
+        :param zip64: the descriptor has 8 byte sizes
+        :return: the length, or None if the data is not written completely yet
+        """
+        descriptor = struct.Struct("<IQQ" if zip64 else "<III")
+        data = bytearray()
+        pos = 0  # where to look for the next signature
+        while True:
+            chunk = self._pread(start + len(data), FOLLOWCHUNK)
+            if not chunk:
+                return None
+            data += chunk
+            while True:
+                pos = data.find(b"PK", pos)
+                if pos < 0:
+                    pos = max(len(data) - 1, 0)  # a signature can start there
+                    break
+                if pos + 4 > len(data):
+                    break
+                signature = data[pos : pos + 4]
+                if signature == DATADESCRIPTOR:
+                    length, fields = pos, pos + 4
+                elif signature in (LOCALHEADER, CDHEADER):
+                    length = fields = pos - descriptor.size
+                else:
+                    pos += 1
+                    continue
+                if fields + descriptor.size > len(data):
+                    break
+                if length >= 0:
+                    crc, csize, usize = descriptor.unpack_from(data, fields)
+                    if csize == usize == length and zlib.crc32(data[:length]) == crc:
+                        return length
+                pos += 1
+
+    def read(self, name: str) -> bytes:
+        info = self.infos[name]
+        if info.flag_bits & 0x1 or info.compress_type not in (
+            ZIP_STORED,
+            ZIP_DEFLATED,
+        ):
+            if not self.finished:
+                raise BadZipFile(f"Cannot read {name} before the zipfile is complete")
+            with ZipFile(self.path) as zipfile:
+                return zipfile.read(name)
+        data = self._pread(self.starts[name], info.compress_size)
+        if info.compress_type == ZIP_STORED:
+            return data
+        return zlib.decompress(data, -zlib.MAX_WBITS, info.file_size)
+
+    def close(self) -> None:
+        self.file.close()
@@ -0,0 +1,124 @@
+import io
+import shutil
+import tarfile
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import pytest
+
+from combine_imagestream_files.imagestreamzip import ImageStreamZip
+from combine_imagestream_files.synthetic import makezip
+
+CHANNELS = 3
+
+
+class Unseekable(io.RawIOBase):
+    """
+    Write-only file that cannot seek, so ZipFile writes the sizes of every
+    member in a data descriptor after its data
+    """
+
+    def __init__(self, f: io.BufferedWriter) -> None:
+        self.f = f
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: bytes) -> int:  # type: ignore[override]
+        return self.f.write(b)
+
+    def flush(self) -> None:
+        self.f.flush()
+
+
+def rewrite(
+    source: Path,
+    target: Path,
+    compression: int = ZIP_DEFLATED,
+    force_zip64: bool = False,
+    descriptor: bool = False,
+) -> Path:
+    """
+    Copy the members of a zipfile to another zipfile
+    :param source: the zipfile to copy
+    :param target: the new zipfile
+    :param compression: compression of the new members
+    :param force_zip64: write zip64 extra fields for every member
+    :param descriptor: write to an unseekable file, so every member has a data
+        descriptor
+    :return: the new zipfile
+    """
+    with ZipFile(source) as archive, open(target, "wb") as f:
+        with ZipFile(Unseekable(f) if descriptor else f, "w", compression) as copy:
+            for info in archive.infolist():
+                with copy.open(info.filename, "w", force_zip64=force_zip64) as member:
+                    member.write(archive.read(info))
+    return target
+
+
+def extract(source: Path, folder: Path) -> Path:
+    with ZipFile(source) as archive:
+        archive.extractall(folder)
+    return folder
+
+
+def maketar(source: Path, target: Path, mode: str = "w") -> Path:
+    """
+    Copy the members of a zipfile to a tarfile, in reverse order
+    """
+    with ZipFile(source) as archive, tarfile.open(target, mode) as tar:
+        for info in reversed(archive.infolist()):
+            data = archive.read(info)
+            member = tarfile.TarInfo(info.filename)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    return target
+
+
+def load(source: Path, useindex: bool = False) -> ImageStreamZip:
+    """
+    Load a source and name all channels but the second
+    """
+    isz = ImageStreamZip()
+    isz.loadfile(source, useindex=useindex)
+    for dataset in isz.datasets.values():
+        for channel in dataset.channels:
+            if channel.index != 2:
+                channel.name = f"Ch{channel.index}"
+    return isz
+
+
+@pytest.fixture(scope="session")
+def zipfile(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """
+    Two datasets of 40 cells, some with a missing channel
+    """
+    folder = tmp_path_factory.mktemp("zip")
+    return makezip(
+        folder / "cells.zip",
+        datasets=2,
+        cells=40,
+        channels=CHANNELS,
+        tilesize=(8, 24),
+        missing=0.02,
+    )
+
+
+@pytest.fixture(scope="session")
+def storedzip(zipfile: Path, tmp_path_factory: pytest.TempPathFactory) -> Path:
+    folder = tmp_path_factory.mktemp("stored")
+    return rewrite(zipfile, folder / "stored.zip", ZIP_STORED)
+
+
+@pytest.fixture
+def output(tmp_path: Path) -> Path:
+    folder = tmp_path / "output"
+    folder.mkdir()
+    return folder
+
+
+def copyzip(zipfile: Path, folder: Path) -> Path:
+    """
+    Copy of a zipfile, so its scan index is not shared between tests
+    """
+    return Path(shutil.copy(zipfile, folder / zipfile.name))
@@ -0,0 +1,131 @@
+import json
+import shutil
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+from conftest import extract, load, maketar
+
+from combine_imagestream_files.batch import (
+    combineall,
+    datasetbytes,
+    findsources,
+    outputs,
+    watch,
+)
+from combine_imagestream_files.channelmap import ChannelMap
+
+
+def test_outputs(tmp_path: Path) -> None:
+    names = [
+        "DS1.tif",
+        "DS1_oversized.tif",
+        "DS1_32x64.tif",
+        "DS1_shard0000.tif",
+        "DS1_oversized_shard0001.tif",
+        "DS1.measurements.csv",
+        "DS1_notes.tif",
+        "DS10.tif",
+        "DS1_2.tif",
+    ]
+    for name in names:
+        (tmp_path / name).touch()
+    assert [pth.name for pth in outputs(tmp_path, "DS1", "imagej")] == sorted(names[:5])
+    assert outputs(tmp_path, "DS1", "ometiff") == []
+
+
+def test_findsources(zipfile: Path, tmp_path: Path) -> None:
+    inputs = tmp_path / "inputs"
+    export = extract(zipfile, inputs / "export")
+    (inputs / "nested").mkdir()
+    nested = Path(shutil.copy(zipfile, inputs / "nested" / "cells.zip"))
+    tar = maketar(zipfile, inputs / "cells.tar.gz", "w:gz")
+    (inputs / "notes.txt").touch()
+    assert findsources([str(inputs)]) == sorted([export, nested, tar])
+    assert findsources([str(export), str(inputs / "*.tar.gz")]) == [export, tar]
+    assert findsources([str(inputs / "notes.txt")]) == []
+
+
+def test_combineall(zipfile: Path, tmp_path: Path) -> None:
+    folder = extract(zipfile, tmp_path / "folder" / "cells")
+    (tmp_path / "tar").mkdir()
+    tar = maketar(zipfile, tmp_path / "tar" / "cells.tar")
+    channelmap = ChannelMap({1: "Ch1", 3: "Ch3"})
+    isz = load(zipfile)  # the same channels, so the same complete cells
+    isz.writetiffs(tmp_path, 0.5)
+    cells = sum(len(dataset.stems) for dataset in isz.datasets.values())
+    summaries = combineall([folder, tar], 0.5, channelmap=channelmap)
+    for summary, source in zip(summaries, [folder, tar]):
+        assert summary["written"] == [
+            str(source.parent / "DS0.tif"),
+            str(source.parent / "DS1.tif"),
+        ]
+        assert summary["cells"] == cells
+    summaries = combineall([folder, tar], 0.5, channelmap=channelmap)
+    assert [summary["uptodate"] for summary in summaries] == [2, 2]
+    # like a zipfile that changed, a cell that is added makes the folder outdated
+    for pth in (folder / "DS1").glob("0_Ch*.ome.tif"):
+        shutil.copy(pth, pth.with_name(f"40{pth.name[1:]}"))
+    summary = combineall([folder], 0.5, channelmap=channelmap)[0]
+    assert summary["uptodate"] == 0
+    assert summary["cells"] == cells + 1
+
+
+def test_combineall_errors(zipfile: Path, tmp_path: Path) -> None:
+    (tmp_path / "bad").mkdir()
+    bad = tmp_path / "bad" / "cells.zip"
+    bad.write_bytes(zipfile.read_bytes()[: zipfile.stat().st_size // 2])  # truncated
+    (tmp_path / "good").mkdir()
+    good = Path(shutil.copy(zipfile, tmp_path / "good" / "cells.zip"))
+    channelmap = ChannelMap({1: "Ch1", 3: "Ch3"})
+    summaries = combineall([bad, good], 0.5, channelmap=channelmap)
+    assert "error" in summaries[0] and summaries[0]["written"] == []
+    assert "error" not in summaries[1] and len(summaries[1]["written"]) == 2
+
+
+class Stop(Exception):
+    pass
+
+
+def test_watch(
+    zipfile: Path,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    (tmp_path / "bad.zip").write_bytes(b"not a zipfile")
+    shutil.copy(zipfile, tmp_path / "good.zip")
+    scans = iter(range(2))
+
+    def sleep(seconds: float) -> None:
+        if next(scans, None) is None:
+            raise Stop()
+
+    monkeypatch.setattr(time, "sleep", sleep)
+    with pytest.raises(Stop):
+        watch(tmp_path, 0.0, pixelsize=0.5, channelmap=ChannelMap({1: "Ch1"}))
+    summaries = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    # the first scan waits for the sizes to settle, the bad zipfile is retried
+    assert [Path(summary["zipfile"]).name for summary in summaries] == [
+        "bad.zip",
+        "good.zip",
+        "bad.zip",
+    ]
+    assert ["error" in summary for summary in summaries] == [True, False, True]
+
+
+def test_datasetbytes(zipfile: Path) -> None:
+    isz = load(zipfile)
+    with ZipFile(zipfile) as archive:
+        sizes = {
+            d: sum(
+                i.compress_size
+                for i in archive.infolist()
+                if i.filename.startswith(f"{d}/")
+            )
+            for d in ["DS0", "DS1"]
+        }
+    assert datasetbytes(isz, ["DS1"]) == sizes["DS1"]
+    assert datasetbytes(isz, ["DS0", "DS1"]) == sum(sizes.values())
+    assert datasetbytes(isz, []) == 0
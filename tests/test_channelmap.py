@@ -0,0 +1,51 @@
+from pathlib import Path
+
+import pytest
+
+from combine_imagestream_files.channelmap import ChannelMap
+from combine_imagestream_files.dataset import DataSet
+
+
+def test_load(tmp_path: Path) -> None:
+    pth = tmp_path / "map.toml"
+    pth.write_text(
+        '[channels]\n1 = "BF"\n2 = "--"\n[datasets.DS1.channels]\n3 = "PE"\n'
+    )
+    channelmap = ChannelMap.load(pth)
+    assert channelmap.channels == {1: "BF", 2: ""}
+    assert channelmap.get("DS0") == {1: "BF", 2: ""}
+    assert channelmap.get("DS1") == {3: "PE"}
+    json = tmp_path / "map.json"
+    json.write_text('{"channels": {"1": "BF", "2": "--"}}')
+    assert ChannelMap.load(json).channels == {1: "BF", 2: ""}
+    pth.write_text("channels = 1\n")
+    with pytest.raises(ValueError):
+        ChannelMap.load(pth)
+
+
+def test_find(tmp_path: Path) -> None:
+    source = tmp_path / "cells.zip"
+    (tmp_path / "cells.toml").write_text('[channels]\n1 = "zip"\n')
+    (tmp_path / "DS1.toml").write_text('[channels]\n1 = "dataset"\n')
+    channelmap = ChannelMap.find(source, ["DS0", "DS1"], None)
+    assert channelmap.get("DS0") == {1: "zip"}
+    assert channelmap.get("DS1") == {1: "dataset"}
+    # the explicit channel map overrides the files next to the zipfile
+    explicit = ChannelMap({1: "explicit"})
+    channelmap = ChannelMap.find(source, ["DS0", "DS1"], explicit)
+    assert channelmap.get("DS0") == {1: "explicit"}
+    assert channelmap.get("DS1") == {1: "explicit"}
+    explicit = ChannelMap(datasets={"DS0": {1: "explicit"}})
+    channelmap = ChannelMap.find(source, ["DS0", "DS1"], explicit)
+    assert channelmap.get("DS0") == {1: "explicit"}
+    assert channelmap.get("DS1") == {1: "dataset"}
+
+
+def test_apply() -> None:
+    dataset = DataSet("DS0")
+    dataset.addfiles(["1", "1"], [1, 2])
+    other = DataSet("DS1")
+    other.addfiles(["1"], [1])
+    channelmap = ChannelMap(datasets={"DS0": {1: "BF", 3: "PE"}})
+    assert channelmap.apply({"DS0": dataset, "DS1": other}) == ["DS1"]
+    assert [channel.name for channel in dataset.channels] == ["BF", ""]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from combine_imagestream_files.dataset import Channel, DataSet
+
+
+def makedataset() -> DataSet:
+    dataset = DataSet("DS0")
+    dataset.addfiles(["1", "1", "2", "3", "2"], [1, 2, 1, 2, 11])
+    return dataset
+
+
+def test_addfiles() -> None:
+    dataset = makedataset()
+    assert dataset.stems == ["1", "2", "3"]
+    assert [channel.index for channel in dataset.channels] == [1, 2, 11]
+    dataset.addfile("4_Ch3")
+    assert dataset.stems[-1] == "4"
+    assert [channel.index for channel in dataset.channels] == [1, 2, 3, 11]
+    with pytest.raises(ValueError):
+        dataset.addfiles(["5"], [64])
+
+
+def test_groupedfiles() -> None:
+    dataset = makedataset()
+    grouped = dataset.groupedfiles
+    assert dict(grouped) == {"1": [1, 2], "2": [1, 11], "3": [2]}
+    assert "2" in grouped and "4" not in grouped
+    grouped["3"] = [1, 2]
+    grouped["4"] = [11]
+    assert grouped["3"] == [1, 2]
+    assert grouped["4"] == [11]
+    del grouped["1"]
+    assert list(grouped) == ["2", "3", "4"]
+    assert len(grouped) == 3
+    assert grouped["2"] == [1, 11]
+
+
+def test_completecells() -> None:
+    dataset = makedataset()
+    channels = [Channel(1, "a"), Channel(2, "b")]
+    assert dataset.completecells(channels).tolist() == [True, False, False]
+    assert not dataset.checkchannels(channels)
+    assert dataset.missingcells() == {1: 1, 2: 1, 11: 2}
+    dataset.removecells(~dataset.completecells(channels))
+    assert dataset.stems == ["1"]
+    assert dataset.checkchannels(channels)
+
+
+def test_getlayout() -> None:
+    dataset = DataSet("DS0")
+    # (cells, channels, 2): 9 cells of 10x20 and one of 100x40
+    shapes = np.array([[[10, 20], [8, 20]]] * 9 + [[[100, 40], [100, 40]]])
+    ((suffix, cells, size),) = dataset.getlayout(shapes)
+    assert (suffix, size) == ("", (100, 40))
+    assert cells.tolist() == list(range(10))
+    dataset.setlayout("crop", 50)
+    ((suffix, cells, size),) = dataset.getlayout(shapes)
+    assert size == (10, 20)
+    dataset.setlayout("split", 50)
+    fit, oversized = dataset.getlayout(shapes)
+    assert (fit[0], fit[1].tolist(), fit[2]) == ("", list(range(9)), (10, 20))
+    assert (oversized[0], oversized[1].tolist()) == ("_oversized", [9])
+    dataset.setlayout("buckets")
+    assert [stack[0] for stack in dataset.getlayout(shapes)] == [
+        "_32x32",
+        "_128x64",
+    ]
+    with pytest.raises(ValueError):
+        dataset.setlayout("stretch")
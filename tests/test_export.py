@@ -0,0 +1,224 @@
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+from typing import Any
+from zipfile import ZipFile
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+import tifffile
+from conftest import copyzip, extract, load, maketar, rewrite
+
+from combine_imagestream_files.index import ScanIndex
+from combine_imagestream_files.shards import ShardIndex
+from combine_imagestream_files.zipreader import ZipReader
+
+
+def reference(zipfile: Path, datasetname: str) -> npt.NDArray[Any]:
+    """
+    The stack of a dataset as the original export made it: the cells that have
+    every named channel, each tile centred on a canvas of the largest tile and
+    padded with the median over all cells of the tile medians, where the cells
+    without every channel count as 0
+    """
+    isz = load(zipfile)
+    dataset = isz.datasets[datasetname]
+    channels = dataset.getvalidchannels()
+    with ZipReader(zipfile) as reader:
+        cells = [
+            [
+                tifffile.imread(
+                    io.BytesIO(
+                        bytes(reader.read(f"{datasetname}/{stem}_Ch{ch.index}.ome.tif"))
+                    )
+                )
+                for ch in channels
+            ]
+            for stem, complete in zip(dataset.stems, dataset.completecells(channels))
+            if complete
+        ]
+    medians = np.zeros((len(dataset.stems), len(channels)))
+    medians[: len(cells)] = [[np.median(tile) for tile in cell] for cell in cells]
+    medians = np.median(medians, axis=0)
+    height = max(tile.shape[0] for cell in cells for tile in cell)
+    width = max(tile.shape[1] for cell in cells for tile in cell)
+    dtype = cells[0][0].dtype
+    stack = np.zeros((len(cells), len(channels), height, width), dtype)
+    for i, cell in enumerate(cells):
+        for j, tile in enumerate(cell):
+            stack[i, j] = np.asarray(medians[j]).astype(dtype)
+            h, w = tile.shape
+            y, x = (height - h) // 2, (width - w) // 2
+            stack[i, j, y : y + h, x : x + w] = tile
+    return stack
+
+
+def export(
+    source: Path, folder: Path, useindex: bool = False, **kwargs: Any
+) -> dict[str, str]:
+    """
+    Export all datasets of a source
+    :return: md5 of each file that was written
+    """
+    written = load(source, useindex).writetiffs(folder, 0.5, **kwargs)
+    return {pth.name: hashlib.md5(pth.read_bytes()).hexdigest() for pth in written}
+
+
+@pytest.fixture(scope="module")
+def baseline(zipfile: Path, tmp_path_factory: pytest.TempPathFactory) -> dict[str, str]:
+    return export(zipfile, tmp_path_factory.mktemp("baseline"))
+
+
+def test_reference(zipfile: Path, output: Path) -> None:
+    written = load(zipfile).writetiffs(output, 0.5)
+    assert [pth.name for pth in written] == ["DS0.tif", "DS1.tif"]
+    for pth in written:
+        with tifffile.TiffFile(pth) as tif:
+            assert tif.is_imagej
+            stack = tif.asarray()
+        assert np.array_equal(stack, reference(zipfile, pth.stem))
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"workers": 4},
+        {"streaming": True, "workers": 2},
+        {"median": "histogram"},
+        {"processes": 2},
+    ],
+    ids=str,
+)
+def test_identical(
+    zipfile: Path, output: Path, baseline: dict[str, str], kwargs: dict[str, Any]
+) -> None:
+    assert export(zipfile, output, **kwargs) == baseline
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("layout", ["pad", "crop", "split"])
+def test_ranges(tmp_path: Path, layout: str, streaming: bool) -> None:
+    zf = tmp_path / "cells.zip"
+    with ZipFile(zf, "w") as archive:
+        for cell, size in enumerate([10, 10, 10, 10, 30]):
+            tile = np.full((size, size), 100 + cell, np.uint16)
+            if size == 30:
+                tile[0, 0] = 60000  # cut off by the crop layout
+            buffer = io.BytesIO()
+            tifffile.imwrite(buffer, tile)
+            archive.writestr(f"DS0/{cell}_Ch1.ome.tif", buffer.getvalue())
+    isz = load(zf)
+    isz.datasets["DS0"].setlayout(layout, 50.0)
+    for pth in isz.writetiffs(tmp_path, 0.5, streaming=streaming):
+        with tifffile.TiffFile(pth) as tif:
+            stack = tif.asarray()
+            ranges = tif.imagej_metadata["Ranges"]
+        # the maximum of the pixels that were written, also when cropped
+        assert ranges[1] == stack.max()
+    assert (ranges[1] == 104) == (layout == "crop")
+
+
+def test_zarrcompression(zipfile: Path, output: Path) -> None:
+    done: list[int] = []
+    with pytest.raises(ValueError, match="lzw is not supported for zarr"):
+        load(zipfile).writetiffs(
+            output,
+            0.5,
+            outputformat="zarr",
+            compression="lzw",
+            progress=lambda _, cells, __: done.append(cells),
+        )
+    assert not done  # rejected before any cell is decoded
+    assert not any(output.iterdir())
+
+
+def test_sources(
+    zipfile: Path, storedzip: Path, tmp_path: Path, baseline: dict[str, str]
+) -> None:
+    sources = [
+        storedzip,
+        rewrite(zipfile, tmp_path / "zip64.zip", force_zip64=True),
+        rewrite(zipfile, tmp_path / "descriptor.zip", descriptor=True),
+        extract(zipfile, tmp_path / "folder"),
+        maketar(zipfile, tmp_path / "cells.tar"),
+    ]
+    for i, source in enumerate(sources):
+        assert export(source, tmp_path / f"output{i}") == baseline
+
+
+def test_scanindex(zipfile: Path, tmp_path: Path, baseline: dict[str, str]) -> None:
+    zf = copyzip(zipfile, tmp_path)
+    pth = ScanIndex.indexpath(zf)
+    assert export(zf, tmp_path / "first", useindex=True) == baseline
+    assert pth.exists()
+    index = ScanIndex.load(pth, ZipReader.key(zf))
+    assert index is not None
+    assert index.getcells().keys() == {"DS0", "DS1"}
+    assert export(zf, tmp_path / "second", useindex=True) == baseline
+    assert ScanIndex.load(pth, "another key") is None
+
+
+def test_incremental(zipfile: Path, tmp_path: Path) -> None:
+    # written through a memory map, so only the data offset differs
+    default = load(zipfile).writetiffs(tmp_path / "default", 0.5)
+    written = load(zipfile).writetiffs(tmp_path / "output", 0.5, incremental=True)
+    for pth, other in zip(written, default):
+        with tifffile.TiffFile(pth) as tif, tifffile.TiffFile(other) as othertif:
+            assert np.array_equal(tif.asarray(), othertif.asarray())
+            assert tif.imagej_metadata == othertif.imagej_metadata
+    assert load(zipfile).writetiffs(tmp_path / "output", 0.5, incremental=True) == []
+
+
+def test_incremental_changed(zipfile: Path, tmp_path: Path) -> None:
+    folder = extract(zipfile, tmp_path / "cells")
+    output = tmp_path / "output"
+    assert len(load(folder).writetiffs(output, 0.5, incremental=True)) == 2
+    # only the dataset of a member that changed is written again
+    os.utime(folder / "DS1" / "0_Ch1.ome.tif", (0, 0))
+    written = load(folder).writetiffs(output, 0.5, incremental=True)
+    assert [pth.name for pth in written] == ["DS1.tif"]
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_resume(zipfile: Path, tmp_path: Path, streaming: bool) -> None:
+    kwargs: dict[str, Any] = {"incremental": True, "streaming": streaming}
+    complete = export(zipfile, tmp_path / "complete", **kwargs)
+    cancel = threading.Event()
+
+    def cancelhalfway(datasetname: str, done: int, total: int) -> None:
+        if datasetname == "DS1" and done > total // 2:
+            cancel.set()
+
+    output = tmp_path / "output"
+    first = export(zipfile, output, progress=cancelhalfway, cancel=cancel, **kwargs)
+    assert list(first) == ["DS0.tif"]
+    resumed: list[int] = []
+    second = export(
+        zipfile, output, progress=lambda _, done, __: resumed.append(done), **kwargs
+    )
+    assert second == {"DS1.tif": complete["DS1.tif"]}  # DS0 did not change
+    # the cells that were written before are skipped in the second pass
+    assert len(resumed) < resumed[-1]
+    assert export(zipfile, output, **kwargs) == {}
+
+
+def test_shards(zipfile: Path, output: Path) -> None:
+    written = load(zipfile).writetiffs(output, 0.5, shardsize=16)
+    assert [pth.name for pth in written] == [
+        f"DS{d}_shard{s:04d}.tif" for d in range(2) for s in range(3)
+    ]
+    stack = reference(zipfile, "DS0")
+    shards = [tifffile.imread(pth) for pth in written[:3]]
+    assert np.array_equal(np.concatenate(shards), stack)
+    index = ShardIndex.load(ShardIndex.indexpath(output, "DS0"))
+    assert index is not None
+    assert index.channels == ["Ch1", "Ch3"]
+    assert len(index.cells) == len(stack)
+    stems = list(index.cells)
+    assert index.locate(stems[15:17]) == {
+        output / "DS0_shard0000.tif": [15],
+        output / "DS0_shard0001.tif": [0],
+    }
@@ -0,0 +1,47 @@
+from pathlib import Path
+
+from combine_imagestream_files.manifest import Manifest, memberskey
+from combine_imagestream_files.shards import ShardIndex
+from combine_imagestream_files.sources import MemberInfo
+
+
+def test_shardindex(tmp_path: Path) -> None:
+    pth = ShardIndex.indexpath(tmp_path, "DS0")
+    index = ShardIndex(pth, "DS0", ["Ch1", "Ch3"])
+    assert ShardIndex.shardname("DS0", 1) == "DS0_shard0001"
+    index.addshard("DS0_shard0000.tif", ["1", "2"])
+    index.addshard("DS0_shard0001.tif", ["3"])
+    index.save()
+    loaded = ShardIndex.load(pth)
+    assert loaded is not None
+    assert loaded.channels == ["Ch1", "Ch3"]
+    assert loaded.cells == {"1": (0, 0), "2": (0, 1), "3": (1, 0)}
+    assert loaded.locate(["3", "2"]) == {
+        tmp_path / "DS0_shard0001.tif": [0],
+        tmp_path / "DS0_shard0000.tif": [1],
+    }
+    pth.write_text("{")
+    assert ShardIndex.load(pth) is None
+    assert ShardIndex.load(tmp_path / "missing.json") is None
+
+
+def test_manifest(tmp_path: Path) -> None:
+    infos = [
+        MemberInfo("DS0/1_Ch1.ome.tif", 10, 1),
+        MemberInfo("DS0/2_Ch1.ome.tif", 12, 2),
+    ]
+    key = memberskey(infos)
+    assert memberskey(infos[::-1]) == key
+    assert memberskey([infos[0], MemberInfo("DS0/2_Ch1.ome.tif", 12, 3)]) != key
+    pth = Manifest.manifestpath(tmp_path, "DS0")
+    manifest = Manifest(pth, key, {"pixelsize": 0.5})
+    manifest.outputs["DS0.tif"] = 1
+    manifest.save()
+    loaded = Manifest.load(pth)
+    assert loaded is not None
+    assert loaded.matches(manifest)
+    assert loaded.outputs == {"DS0.tif": 1}
+    assert not loaded.complete
+    assert not loaded.matches(Manifest(pth, key, {"pixelsize": 1.0}))
+    pth.write_text("[]")
+    assert Manifest.load(pth) is None
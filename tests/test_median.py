@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from combine_imagestream_files.median import (
+    DatasetMedians,
+    P2Median,
+    exact,
+    histogram,
+    subsample,
+)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16, np.float32])
+def test_histogram(dtype: type) -> None:
+    rng = np.random.default_rng(0)
+    for shape in [(1, 1), (2, 3), (15, 20), (64, 64)]:
+        tile = (rng.normal(100, 20, shape)).astype(dtype)
+        assert histogram(tile) == exact(tile)
+
+
+def test_subsample() -> None:
+    rng = np.random.default_rng(0)
+    tile = rng.normal(1000, 100, (200, 200)).astype(np.uint16)
+    assert abs(subsample(tile) - exact(tile)) < 10
+    small = tile[:20, :20]
+    assert subsample(small) == exact(small)
+
+
+def test_p2median() -> None:
+    rng = np.random.default_rng(0)
+    values = rng.normal(500, 50, 5000)
+    estimate = P2Median()
+    assert estimate.value() == 0.0
+    for value in values[:3]:
+        estimate.add(value)
+    assert estimate.value() == np.median(values[:3])
+    for value in values[3:]:
+        estimate.add(value)
+    assert abs(estimate.value() - np.median(values)) < 5
+
+
+def test_datasetmedians() -> None:
+    rng = np.random.default_rng(0)
+    medians = rng.normal([100, 1000], [10, 100], (2000, 2))
+    medians[::10] = 0  # skipped cells count as 0
+    exact = DatasetMedians(len(medians), 2, "exact")
+    p2 = DatasetMedians(len(medians), 2, "p2")
+    assert p2.table is None
+    for row, cellmedians in enumerate(medians):
+        if row % 10:
+            exact.add(row, cellmedians.tolist())
+            p2.add(row, cellmedians.tolist())
+    assert np.array_equal(exact.value(), np.median(medians, axis=0))
+    assert np.allclose(p2.value(), np.median(medians, axis=0), 0.02)
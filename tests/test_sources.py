@@ -0,0 +1,73 @@
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+from conftest import extract, maketar
+
+from combine_imagestream_files.sources import (
+    DirectorySource,
+    TarSource,
+    groupmembers,
+    sourcetype,
+)
+from combine_imagestream_files.zipreader import ZipReader
+
+
+def test_groupmembers() -> None:
+    names = [
+        "DS0/",
+        "DS0/1_Ch1.ome.tif",
+        "DS0/1_Ch11.ome.tif",
+        "DS0/a_b_Ch2.ome.tif",
+        "DS0/notes.txt",
+        "DS0/sub/1_Ch1.ome.tif",
+        "root_Ch1.ome.tif",
+        "DS1/1_Ch3.ome.tif",
+    ]
+    cells, cellnames = groupmembers(names)
+    assert cells == {"DS0": (["1", "1", "a_b"], [1, 11, 2]), "DS1": (["1"], [3])}
+    assert cellnames == [
+        "DS0/1_Ch1.ome.tif",
+        "DS0/1_Ch11.ome.tif",
+        "DS0/a_b_Ch2.ome.tif",
+        "DS1/1_Ch3.ome.tif",
+    ]
+
+
+def test_directorysource(zipfile: Path, tmp_path: Path) -> None:
+    folder = extract(zipfile, tmp_path / "cells")
+    assert sourcetype(folder) is DirectorySource
+    names = DirectorySource.scan(folder)
+    with ZipFile(zipfile) as archive:
+        assert sorted(names) == sorted(archive.namelist())
+        with DirectorySource(folder) as source:
+            for name in names:
+                assert bytes(source.read(name)) == archive.read(name)
+    # natural order, so cell 2 comes before cell 10
+    stems = [name.split("/")[1].split("_")[0] for name in names if "DS0" in name]
+    assert stems == sorted(stems, key=int)
+    batches = list(DirectorySource.iterscan(folder, 10))
+    assert [name for batch in batches for name in batch] == names
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_tarsource(zipfile: Path, tmp_path: Path, mode: str) -> None:
+    tar = maketar(zipfile, tmp_path / "cells.tar", mode)
+    assert sourcetype(tar) is TarSource
+    names = TarSource.scan(tar)
+    # in the order of the folder, although the tarfile is in reverse order
+    assert names == DirectorySource.scan(extract(zipfile, tmp_path / "cells"))
+    with ZipFile(zipfile) as archive:
+        source = TarSource(tar)
+        assert (source.map is not None) == (mode == "w")
+        for name in names:
+            assert bytes(source.read(name)) == archive.read(name)
+        source.close()
+
+
+def test_sourcetype(zipfile: Path, tmp_path: Path) -> None:
+    assert sourcetype(zipfile) is ZipReader
+    other = tmp_path / "other.txt"
+    other.write_text("not a source")
+    with pytest.raises(ValueError):
+        sourcetype(other)
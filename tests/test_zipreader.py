@@ -0,0 +1,161 @@
+import struct
+from pathlib import Path
+from zipfile import ZIP_BZIP2, ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile
+
+import pytest
+from conftest import rewrite
+
+from combine_imagestream_files.zipreader import (
+    ZipFollower,
+    ZipReader,
+    _zip64fields,
+    _zip64sizes,
+    centraldirectory,
+    centralentries,
+    centralinfos,
+)
+
+
+def infolist(zipfile: Path) -> dict[str, tuple[int, int, int, int, int, int]]:
+    with ZipFile(zipfile) as archive:
+        return {
+            info.filename: (
+                info.flag_bits,
+                info.compress_type,
+                info.CRC,
+                info.compress_size,
+                info.file_size,
+                info.header_offset,
+            )
+            for info in archive.infolist()
+        }
+
+
+def centrallist(zipfile: Path) -> dict[str, tuple[int, int, int, int, int, int]]:
+    return {
+        name: (
+            info.flag_bits,
+            info.compress_type,
+            info.CRC,
+            info.compress_size,
+            info.file_size,
+            info.header_offset,
+        )
+        for name, info in centralinfos(centraldirectory(zipfile)).items()
+    }
+
+
+def zips(zipfile: Path, folder: Path) -> list[Path]:
+    """
+    The zipfile as written by makezip, stored, with zip64 extra fields and
+    with data descriptors
+    """
+    return [
+        zipfile,
+        rewrite(zipfile, folder / "stored.zip", ZIP_STORED),
+        rewrite(zipfile, folder / "zip64.zip", force_zip64=True),
+        rewrite(zipfile, folder / "descriptor.zip", descriptor=True),
+        rewrite(zipfile, folder / "storeddescriptor.zip", ZIP_STORED, descriptor=True),
+    ]
+
+
+def test_centralentries(zipfile: Path, tmp_path: Path) -> None:
+    for zf in zips(zipfile, tmp_path):
+        with ZipFile(zf) as archive:
+            names = archive.namelist()
+        batches = list(centralentries(centraldirectory(zf), 7))
+        assert [name for batch in batches for name in batch] == names
+        assert all(len(batch) == 7 for batch in batches[:-1])
+
+
+def test_centralinfos(zipfile: Path, tmp_path: Path) -> None:
+    for zf in zips(zipfile, tmp_path):
+        assert centrallist(zf) == infolist(zf)
+
+
+def test_centralinfos_names(tmp_path: Path) -> None:
+    zf = tmp_path / "names.zip"
+    with ZipFile(zf, "w") as archive:
+        # a name that contains the signature of a central directory entry
+        for name in ["DS0/é_Ch1.ome.tif", "DS0/PK\x01\x02_Ch1.ome.tif", "DS0/a.txt"]:
+            archive.writestr(name, name.encode())
+        archive.comment = b"PK\x01\x02"
+    assert centrallist(zf) == infolist(zf)
+
+
+def test_zip64fields() -> None:
+    extra = struct.pack("<HHH", 0x7075, 2, 0)  # another field first
+    extra += struct.pack("<HHQQ", 0x0001, 16, 2**33, 2**34)
+    assert _zip64fields(extra, 0xFFFFFFFF, 10, 0xFFFFFFFF) == (2**33, 10, 2**34)
+    assert _zip64fields(extra, 0xFFFFFFFF, 0xFFFFFFFF, 5) == (2**33, 2**34, 5)
+    with pytest.raises(BadZipFile):
+        _zip64fields(b"", 0xFFFFFFFF, 0, 0)
+
+
+def test_zip64sizes() -> None:
+    extra = struct.pack("<HHQQ", 0x0001, 16, 100, 60)
+    assert _zip64sizes(extra) == (100, 60)
+    assert _zip64sizes(struct.pack("<HHH", 0x7075, 2, 0)) is None
+    assert _zip64sizes(b"") is None
+
+
+def test_zipreader(zipfile: Path, tmp_path: Path) -> None:
+    for zf in zips(zipfile, tmp_path):
+        with ZipFile(zf) as archive, ZipReader(zf) as reader:
+            for name in archive.namelist():
+                assert bytes(reader.read(name)) == archive.read(name)
+
+
+def follow(zf: Path) -> ZipFollower:
+    follower = ZipFollower(zf)
+    names = []
+    while not follower.finished:
+        new = follower.follow()
+        assert new or follower.finished
+        names.extend(new)
+    with ZipFile(zf) as archive:
+        assert names == archive.namelist()
+        for name in names:
+            assert follower.read(name) == archive.read(name)
+    return follower
+
+
+@pytest.mark.parametrize(
+    "compression, descriptor, force_zip64",
+    [
+        (ZIP_DEFLATED, False, False),
+        (ZIP_STORED, False, False),
+        (ZIP_DEFLATED, True, False),
+        (ZIP_STORED, True, False),
+        (ZIP_STORED, True, True),
+        (ZIP_BZIP2, True, False),  # read once the central directory is written
+    ],
+)
+def test_zipfollower(
+    zipfile: Path,
+    tmp_path: Path,
+    compression: int,
+    descriptor: bool,
+    force_zip64: bool,
+) -> None:
+    zf = rewrite(zipfile, tmp_path / "follow.zip", compression, force_zip64, descriptor)
+    follow(zf).close()
+
+
+@pytest.mark.parametrize("compression", [ZIP_DEFLATED, ZIP_STORED])
+def test_zipfollower_growing(zipfile: Path, tmp_path: Path, compression: int) -> None:
+    zf = rewrite(zipfile, tmp_path / "follow.zip", compression, descriptor=True)
+    data = zf.read_bytes()
+    partial = tmp_path / "partial.zip"
+    with ZipFile(zf) as archive:
+        infos = archive.infolist()
+    # cut the zipfile in the middle of the fifth member
+    partial.write_bytes(data[: (infos[4].header_offset + infos[5].header_offset) // 2])
+    follower = ZipFollower(partial)
+    assert follower.follow() == [info.filename for info in infos[:4]]
+    assert not follower.finished
+    with open(partial, "ab") as f:
+        f.write(data[partial.stat().st_size :])
+    assert follower.follow() == [info.filename for info in infos[4:]]
+    assert follower.finished
+    follower.close()